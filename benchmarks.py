@@ -0,0 +1,465 @@
+"""Benchmarks of the hot paths of the scripts, with stored baselines.
+
+Each benchmark times one path on the inputs in data/, measurements/ and
+psfgen/, or on synthetic inputs scaled up from them:
+
+- jobgen: jobgen.py --nruns 40 end to end, in a copy of the scripts with HOME
+  in the work directory, its output piped to sh. qsub, qrstat and vmd are
+  local stand-ins, so nothing is submitted. jobgen_batch is the same with
+  --batch.
+- create_fep: rendering fep.tcl for a pdb and writing it to a run directory.
+- simeta: simeta.steps on a synthetic NAMD log of --log-gb GB.
+- populate_df: loader.populate_df of the csv series in measurements/.
+- measure: measure.measure of the default quantities on a trajectory of
+  --frames frames, made from psfgen/namdrun_run.namdout.dcd with noise.
+
+The best time of --repeat runs is reported with the throughput, and the peak
+memory of a separate run: memory allocated by python and numpy (tracemalloc)
+for benchmarks run in this process, maximum resident size for jobgen.
+
+Results are compared to the baselines of this host in benchmarks.json, and
+stored as the new baselines with --save. Only runs with the same parameters
+(sizes) are compared. The exit status is 1 if a benchmark fails, or is slower
+than its baseline by more than --tolerance.
+
+Synthetic inputs are kept in --workdir (default: a temporary directory that
+is removed at the end), pass it to reuse them between runs.
+
+Usage: python benchmarks.py
+       python benchmarks.py simeta measure --log-gb 4 --frames 100000 --save
+"""
+
+import sys
+import os
+import glob
+import json
+import time
+import shutil
+import socket
+import argparse
+import tempfile
+import tracemalloc
+import subprocess
+from collections import OrderedDict
+import numpy as np
+
+if sys.version_info[0] < 3:
+    print('Needs python3. Load it using: module load python/3.4.3')
+    sys.exit(0)
+
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+BASELINES = os.path.join(SCRIPT_DIR, 'benchmarks.json')
+
+PDB = os.path.join(SCRIPT_DIR, 'data', '2mx4_p1_s8.pdb')
+TEMPLATE = os.path.join(SCRIPT_DIR, 'fep.tcl')
+TRAJECTORY = os.path.join(SCRIPT_DIR, 'psfgen', 'namdrun_run.namdout.dcd')
+PSF = os.path.join(SCRIPT_DIR, 'data', '2mx4_p1_p2.psf')
+MEASUREMENTS = os.path.join(SCRIPT_DIR, 'measurements')
+PREFIXES = ['p1_s10', 'p1_extended_s10', 'up1_s10', 'up1_extended_s10']
+
+# Stand-ins for the grid engine and VMD. qrstat prints an AR on one host
+# with 32 slots, like qrstat -ar on anthill.
+QSUB = """#!/bin/sh
+echo "Your job $$ (\\"$1\\") has been submitted"
+"""
+
+QRSTAT = """#!/bin/sh
+cat <<EOF
+--------------------------------------------------------------------------------
+id                             77
+name                           bench
+owner                          $USER
+state                          r
+start_time                     01/01/2020 00:00:00
+end_time                       01/01/2100 00:00:00
+duration                       700000:00:00
+resource_list                  hostname=node1,h_rt=360000,virtual_free=2G
+granted_parallel_environment   smp slots 32
+EOF
+"""
+
+VMD = """#!/bin/sh
+exit 0
+"""
+
+# NAMD log lines, see simeta.LogTail. One ENERGY line every 100 steps.
+ETITLE = ('ETITLE:      TS           BOND          ANGLE          DIHED          IMPRP'
+          '               ELECT            VDW       BOUNDARY           MISC        KINETIC'
+          '               TOTAL           TEMP      POTENTIAL         TOTAL3        TEMPAVG'
+          '            PRESSURE      GPRESSURE         VOLUME       PRESSAVG      GPRESSAVG\n')
+ENERGY = ('ENERGY: %7d    287.4932       785.2364       457.3041        25.4166'
+          '          -9453.8821       1032.6593         0.0000         0.0000      1702.4508'
+          '          -5163.3217       299.2617     -6865.7725     -5149.1741       300.6539'
+          '            -38.6151        -30.6612     21402.8496       -11.9373        -9.3498\n')
+TIMING = ('TIMING: %d  CPU: %.1f, 0.0153/step  Wall: %.1f, 0.0153/step, '
+          '0.5 hours remaining, 615.1 MB of memory in use.\n')
+WRITING = 'WRITING COORDINATES TO DCD FILE namdrun.dcd AT STEP %d\n'
+
+
+def _maxrss(usage):
+    """Return ru_maxrss in bytes (it is in kB on linux, bytes on macOS)."""
+    return usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+
+
+def run_child(cmd, cwd, env, stdin=None):
+    """Run a command and return its output and peak resident memory in bytes."""
+    # stdin and stderr go through temporary files, so only stdout is a pipe
+    # and the child can not block on a full pipe we are not reading.
+    with tempfile.TemporaryFile() as inp, tempfile.TemporaryFile() as err:
+        if stdin is not None:
+            inp.write(stdin)
+            inp.seek(0)
+        proc = subprocess.Popen(cmd, cwd=cwd, env=env, stdin=inp, stdout=subprocess.PIPE, stderr=err)
+        out = proc.stdout.read()
+        proc.stdout.close()
+        # Reap the child ourselves to get its own resource usage.
+        _, status, usage = os.wait4(proc.pid, 0)
+        if os.WIFEXITED(status):
+            proc.returncode = os.WEXITSTATUS(status)
+        else:
+            proc.returncode = -os.WTERMSIG(status)
+        if proc.returncode != 0:
+            err.seek(0)
+            raise RuntimeError('%s failed (exit %d): %s' % (' '.join(cmd), proc.returncode,
+                                                            err.read().decode(errors='replace').strip()))
+    return out, _maxrss(usage)
+
+
+def stand_ins(workdir):
+    """Write the qsub, qrstat and vmd stand-ins and return their directory."""
+    bin = os.path.join(workdir, 'bin')
+    os.makedirs(bin, exist_ok=True)
+    for name, script in [('qsub', QSUB), ('qrstat', QRSTAT), ('vmd', VMD)]:
+        fname = os.path.join(bin, name)
+        with open(fname, 'w') as f:
+            f.write(script)
+        os.chmod(fname, 0o755)
+    return bin
+
+
+def bench_jobgen(workdir, args, batch=False):
+    """jobgen.py --nruns args.nruns in a fresh copy of the scripts."""
+    root = os.path.join(workdir, 'jobgen_batch' if batch else 'jobgen')
+    home = os.path.join(root, 'home')
+    scripts = os.path.join(root, 'scripts')
+    env = dict(os.environ, HOME=home, PATH=stand_ins(workdir) + os.pathsep + os.environ['PATH'])
+    base = PDB[:-4]
+    cmd = [sys.executable, 'jobgen.py', '--nruns', str(args.nruns), '--fep', 'fep.tcl',
+           '--pdb', os.path.join('data', os.path.basename(PDB)), '--arid', '77', '--runs-per-ar', '4']
+    if batch:
+        cmd.append('--batch')
+
+    def setup():
+        # jobgen writes run dirs next to itself and jobs in ~/jobs.
+        if os.path.exists(root):
+            shutil.rmtree(root)
+        os.makedirs(os.path.join(scripts, 'data'))
+        os.makedirs(home)
+        for fname in glob.glob(os.path.join(SCRIPT_DIR, '*.py')) + [TEMPLATE]:
+            shutil.copy(fname, scripts)
+        for suffix in ['.pdb', '.psf', '_alch.pdb', '_fixed.pdb']:
+            shutil.copy(base + suffix, os.path.join(scripts, 'data'))
+
+    def run():
+        out, peak = run_child(cmd, scripts, env)
+        submitted, _ = run_child(['sh'], scripts, env, stdin=out)
+        if submitted.count(b'has been submitted') != out.count(b'qsub'):
+            raise RuntimeError('not all jobs were submitted')
+        return peak
+
+    return {'setup': setup, 'run': run, 'items': args.nruns, 'unit': 'runs',
+            'params': {'nruns': args.nruns, 'pdb': os.path.basename(PDB)}, 'child': True}
+
+
+def bench_jobgen_batch(workdir, args):
+    """jobgen.py --nruns args.nruns --batch in a fresh copy of the scripts."""
+    return bench_jobgen(workdir, args, batch=True)
+
+
+def bench_create_fep(workdir, args):
+    """create_fep for args.feps run directories, rendering the template each time."""
+    import cell
+    import jobgen
+    root = os.path.join(workdir, 'create_fep')
+    pdb = os.path.join(root, os.path.basename(PDB))
+    dirs = [os.path.join(root, 'run%d' % i) for i in range(args.feps)]
+
+    def setup():
+        if os.path.exists(root):
+            shutil.rmtree(root)
+        for dir in dirs:
+            os.makedirs(dir)
+        shutil.copy(PDB, pdb)
+        # Cold cell cache, outside of the home directory.
+        cell.CACHE_DIR = os.path.join(root, 'cache')
+        cell._cache.clear()
+
+    def run():
+        for i, dir in enumerate(dirs):
+            jobgen.create_fep(TEMPLATE, dir, pdb, jobgen.random_seed(i))
+
+    return {'setup': setup, 'run': run, 'items': args.feps, 'unit': 'feps',
+            'params': {'feps': args.feps, 'pdb': os.path.basename(PDB)}}
+
+
+def _log_block(first, nsteps):
+    """Return NAMD log lines for steps first to first + nsteps."""
+    lines = []
+    for step in range(first, first + nsteps, 100):
+        lines.append(ENERGY % step)
+        if step % 5000 == 0:
+            lines.append(TIMING % (step, step * 0.0153, step * 0.0153))
+            lines.append(WRITING % step)
+    return ''.join(lines).encode()
+
+
+def synthetic_log(fname, size, block_steps=500000):
+    """Write a NAMD log of about size bytes, unless it exists.
+
+    Returns
+    -------
+    step : int
+        step of the last WRITING COORDINATES line.
+    """
+    # The same block is written repeatedly, only the last one has its real
+    # steps: the steps before do not matter to a reader of the end of the log.
+    block = _log_block(0, block_steps)
+    nblocks = max(1, int(size // len(block)))
+    last = _log_block((nblocks - 1) * block_steps, block_steps)
+    first = (nblocks - 1) * block_steps
+    step = first + block_steps - 5000
+    if os.path.exists(fname) and os.path.getsize(fname) == len(ETITLE) + (nblocks - 1) * len(block) + len(last):
+        return step
+    tmp = fname + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(ETITLE.encode())
+        for i in range(nblocks - 1):
+            f.write(block)
+        f.write(last)
+    os.replace(tmp, fname)
+    return step
+
+
+def bench_simeta(workdir, args):
+    """simeta.steps of a log of args.log_gb GB."""
+    import simeta
+    fname = os.path.join(workdir, 'namd_%gGB.stdout' % args.log_gb)
+    size = int(args.log_gb * (1 << 30))
+    state = {}
+
+    def setup():
+        state['last'] = synthetic_log(fname, size)
+
+    def run():
+        step = simeta.steps(fname)
+        if step != state['last']:
+            raise RuntimeError('simeta.steps returned %d, expected %d' % (step, state['last']))
+
+    return {'setup': setup, 'run': run, 'items': size / 1e6, 'unit': 'MB',
+            'params': {'log_gb': args.log_gb}}
+
+
+def bench_populate_df(workdir, args):
+    """loader.populate_df of the csv files of PREFIXES."""
+    from loader import populate_df
+    prefixes = [os.path.join(MEASUREMENTS, prefix) for prefix in PREFIXES]
+    size = sum(os.path.getsize(csv) for prefix in prefixes for csv in glob.glob(prefix + '_*.csv'))
+
+    def run():
+        for prefix in prefixes:
+            populate_df(prefix, store=False)
+
+    return {'run': run, 'items': size / 1e6, 'unit': 'MB', 'params': {'prefixes': PREFIXES}}
+
+
+def synthetic_trajectory(fname, n_frames, seed=0):
+    """Write a trajectory of n_frames frames of DCD with noise, unless it exists."""
+    from dcd import DCD, DCDWriter
+    if os.path.exists(fname):
+        with DCD(fname) as traj:
+            if len(traj) == n_frames:
+                return
+    rng = np.random.default_rng(seed)
+    tmp = fname + '.tmp'
+    with DCD(TRAJECTORY) as source:
+        xyz = np.array(source.xyz)
+        with DCDWriter(tmp, source.n_atoms, nsavc=source.nsavc, delta=source.delta) as out:
+            for start in range(0, n_frames, 1000):
+                n = min(1000, n_frames - start)
+                frames = xyz[np.arange(start, start + n) % len(xyz)]
+                out.write(frames + rng.normal(0, 0.05, frames.shape).astype(np.float32))
+    os.replace(tmp, fname)
+
+
+def bench_measure(workdir, args):
+    """measure.measure of the default quantities on args.frames frames."""
+    from measure import measure, DEFAULT_QUANTITIES
+    fname = os.path.join(workdir, 'namdrun_%d.dcd' % args.frames)
+
+    def setup():
+        synthetic_trajectory(fname, args.frames)
+
+    def run():
+        measure(fname, PSF, DEFAULT_QUANTITIES)
+
+    return {'setup': setup, 'run': run, 'items': args.frames, 'unit': 'frames',
+            'params': {'frames': args.frames}}
+
+
+BENCHMARKS = OrderedDict([('jobgen', bench_jobgen),
+                          ('jobgen_batch', bench_jobgen_batch),
+                          ('create_fep', bench_create_fep),
+                          ('simeta', bench_simeta),
+                          ('populate_df', bench_populate_df),
+                          ('measure', bench_measure)])
+
+
+def run_benchmark(bench, repeat=3):
+    """Time a benchmark and measure its peak memory.
+
+    Returns
+    -------
+    result : dict
+        best time in seconds, throughput in items per second, peak memory in
+        MB and the parameters of the benchmark.
+    """
+    setup = bench.get('setup')
+    times = []
+    peaks = []
+    for i in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        peak = bench['run']()
+        times.append(time.perf_counter() - start)
+        peaks.append(peak or 0)
+    if not bench.get('child'):
+        # tracemalloc slows down allocations, so it is not used for the timings.
+        if setup:
+            setup()
+        tracemalloc.start()
+        try:
+            bench['run']()
+            peaks.append(tracemalloc.get_traced_memory()[1])
+        finally:
+            tracemalloc.stop()
+    seconds = min(times)
+    return {'seconds': seconds, 'throughput': bench['items'] / seconds, 'unit': bench['unit'] + '/s',
+            'peak_mb': max(peaks) / 1e6, 'params': bench['params']}
+
+
+def load_baselines(fname):
+    """Return the baselines of all hosts in a json file, or an empty dict."""
+    if not os.path.exists(fname):
+        return {}
+    with open(fname) as f:
+        return json.load(f)
+
+
+def save_baselines(fname, baselines):
+    tmp = fname + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(baselines, f, indent=1, sort_keys=True)
+    os.replace(tmp, fname)
+
+
+def compare(result, baseline):
+    """Return the relative throughput change to a baseline, or None if they are not comparable."""
+    if not baseline or baseline.get('params') != result['params']:
+        return None
+    return result['throughput'] / baseline['throughput'] - 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the hot paths of the scripts and compare '
+                                     'them to stored baselines.')
+    parser.add_argument('names',
+                        type=str,
+                        nargs='*',
+                        help='Benchmarks to run. Default: all of %s.' % ', '.join(BENCHMARKS))
+    parser.add_argument('--repeat',
+                        type=int,
+                        default=3,
+                        help='Number of timed runs of each benchmark, the best is reported. Default 3.')
+    parser.add_argument('--nruns',
+                        type=int,
+                        default=40,
+                        help='Runs generated by jobgen. Default 40.')
+    parser.add_argument('--feps',
+                        type=int,
+                        default=200,
+                        help='fep files created by create_fep. Default 200.')
+    parser.add_argument('--log-gb',
+                        type=float,
+                        default=2.0,
+                        help='Size of the synthetic NAMD log in GB. Default 2.')
+    parser.add_argument('--frames',
+                        type=int,
+                        default=100000,
+                        help='Frames of the synthetic trajectory. Default 100000.')
+    parser.add_argument('--workdir',
+                        type=str,
+                        default=None,
+                        help='Directory for synthetic inputs and outputs, kept after the run. '
+                        'Default: a temporary directory.')
+    parser.add_argument('--baselines',
+                        type=str,
+                        default=BASELINES,
+                        help='Json file with the baselines. Default: benchmarks.json next to this script.')
+    parser.add_argument('--save',
+                        action='store_true',
+                        help='Store the results as the baselines of this host.')
+    parser.add_argument('--tolerance',
+                        type=float,
+                        default=0.2,
+                        help='Relative throughput loss reported as a regression. Default 0.2.')
+
+    args = parser.parse_args()
+
+    for name in args.names:
+        if name not in BENCHMARKS:
+            parser.error('Unknown benchmark %s, choose from %s' % (name, ', '.join(BENCHMARKS)))
+    names = args.names or list(BENCHMARKS)
+    workdir = args.workdir or tempfile.mkdtemp(prefix='benchmarks-')
+    os.makedirs(workdir, exist_ok=True)
+    host = socket.gethostname()
+    baselines = load_baselines(args.baselines)
+    previous = baselines.get(host, {})
+
+    print('%-14s %10s %16s %10s %10s  %s' % ('benchmark', 'seconds', 'throughput', '', 'peak MB',
+                                              'vs baseline'))
+    failed = 0
+    try:
+        for name in names:
+            try:
+                result = run_benchmark(BENCHMARKS[name](workdir, args), args.repeat)
+            except Exception as e:
+                failed += 1
+                print('%-14s failed: %s' % (name, e))
+                continue
+            change = compare(result, previous.get(name))
+            if change is None:
+                status = 'no baseline'
+            else:
+                status = '%+.1f%%' % (100 * change)
+                if change < -args.tolerance:
+                    status += ' REGRESSION'
+                    failed += 1
+            print('%-14s %10.3f %16.1f %-10s %10.1f  %s' % (name, result['seconds'], result['throughput'],
+                                                            result['unit'], result['peak_mb'], status))
+            if args.save:
+                previous[name] = result
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.save:
+        baselines[host] = previous
+        save_baselines(args.baselines, baselines)
+        print('Baselines of %s saved in %s' % (host, args.baselines))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,134 @@
+"""Periodic cell of a solvated structure, computed directly from its pdb file.
+
+This computes the same cell as get_cell in VMD (used by getsize.sh): the cell
+basis vectors are the size of the bounding box of all atoms, and the cell
+origin is the geometric center of all atoms. Results are cached by the
+content hash of the pdb file, in memory and in CACHE_DIR, so a pdb is only
+parsed once no matter how many runs use it.
+
+Usage: python cell.py data/2mx4_p1_s10.pdb
+"""
+
+import sys
+import os
+import json
+import hashlib
+import argparse
+import numpy as np
+
+from topology import iter_pdb_coords
+
+if sys.version_info[0] < 3:
+    print('Needs python3. Load it using: module load python/3.4.3')
+    sys.exit(0)
+
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'disorder', 'cell')
+
+# Cells computed in this process, by content hash of the pdb.
+_cache = {}
+
+
+def file_hash(fname, blocksize=1 << 20):
+    """Return the sha1 hex digest of the content of a file."""
+    sha = hashlib.sha1()
+    with open(fname, 'rb') as fp:
+        for block in iter(lambda: fp.read(blocksize), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def compute_cell(pdb):
+    """Return bounding box and center of all atoms in a pdb file.
+
+    The file is parsed in chunks, so memory use does not grow with its size.
+
+    Returns
+    -------
+    cell : dict
+        'min', 'max' and 'center' lists with x, y, z values.
+    """
+    lo = np.full(3, np.inf)
+    hi = np.full(3, -np.inf)
+    total = np.zeros(3)
+    n = 0
+    for xyz in iter_pdb_coords(pdb):
+        lo = np.minimum(lo, xyz.min(axis=0))
+        hi = np.maximum(hi, xyz.max(axis=0))
+        total += xyz.sum(axis=0)
+        n += len(xyz)
+    if n == 0:
+        raise ValueError('No atoms found in pdb file %s' % pdb)
+    return {'min': lo.tolist(), 'max': hi.tolist(), 'center': (total / n).tolist()}
+
+
+def get_cell(pdb, cache=True):
+    """Return the cell of a pdb file, using the cache if possible.
+
+    Parameters
+    ----------
+    pdb : string
+        pdb file path.
+    cache : bool, optional, default True
+        use and update the cache.
+
+    Returns
+    -------
+    vectors : numpy.ndarray
+        lengths of the three (orthogonal) cell basis vectors.
+    origin : numpy.ndarray
+        cell origin.
+    """
+    cell = None
+    if cache:
+        key = file_hash(pdb)
+        cell = _cache.get(key)
+        fname = os.path.join(CACHE_DIR, key + '.json')
+        if cell is None and os.path.exists(fname):
+            with open(fname, 'r') as fp:
+                cell = json.load(fp)
+    if cell is None:
+        cell = compute_cell(pdb)
+        if cache:
+            try:
+                os.makedirs(CACHE_DIR, exist_ok=True)
+                tmp = '%s.%d.tmp' % (fname, os.getpid())
+                with open(tmp, 'w') as fp:
+                    json.dump(cell, fp)
+                os.replace(tmp, fname)
+            except OSError:
+                # The cache is only an optimization.
+                pass
+    if cache:
+        _cache[key] = cell
+    vectors = np.array(cell['max']) - np.array(cell['min'])
+    return vectors, np.array(cell['center'])
+
+
+def format_cell(vectors, origin):
+    """Return cell vectors and origin as NAMD configuration lines."""
+    lines = ['cellBasisVector1 %s 0 0' % vectors[0],
+             'cellBasisVector2 0 %s 0' % vectors[1],
+             'cellBasisVector3 0 0 %s' % vectors[2],
+             'cellOrigin %s %s %s' % tuple(origin)]
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Print NAMD cell vectors for a solvated pdb.')
+    parser.add_argument('pdb',
+                        type=str,
+                        help='PDB file.')
+    parser.add_argument('--no-cache',
+                        action='store_true',
+                        help='Do not use the cache.')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.pdb):
+        raise IOError('File %s not found.' % args.pdb)
+
+    print(format_cell(*get_cell(args.pdb, cache=not args.no_cache)))
+
+
+if __name__ == "__main__":
+    main()
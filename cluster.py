@@ -0,0 +1,459 @@
+"""Conformational clustering of trajectory frames by RMSD.
+
+The frames of a DCD trajectory are clustered on the coordinates of a selection
+of atoms (by default the protein, all atoms except water), after optimal
+superposition. The RMSD after superposition is computed from the 3x3
+covariance matrices of frame pairs with the quaternion characteristic
+polynomial method (QCP), for blocks of frame pairs at once, without rotating
+any coordinates. Blocks are sized so the covariance matrices and temporaries
+stay under a memory limit, whatever the number of frames. superpose does the
+batched Kabsch rotation when coordinates are needed.
+
+Two methods scale to 100k+ frames, reading the trajectory in chunks:
+
+- leader: a single pass over the frames. A frame farther than a cutoff from
+  every leader becomes a new leader, the others join their nearest leader.
+- kmedoids: mini-batch k-medoids. Medoids are refined on random batches of
+  frames, then every frame is assigned to its nearest medoid.
+
+Output, for a prefix:
+- <prefix>_cluster.csv: cluster of every frame, in the format of the other
+  measurements, so loader.populate_df and stats.py read it as series
+  'cluster'. Clusters are numbered by decreasing population.
+- <prefix>_clusters.tsv: representative frame, population and mean RMSD to
+  the representative of every cluster.
+
+Usage: python cluster.py --psf data/2mx4_up1_extended_s10.psf --dcd run/namd.dcd --prefix up1_extended_s10 --method kmedoids -k 4
+       python cluster.py --psf data/2mx4_up1_extended_s10.psf --dcd run/namd.dcd --prefix up1_extended_s10 --cutoff 3
+"""
+
+import sys
+import os
+import argparse
+import numpy as np
+
+from dcd import open_trajectory
+from topology import load_topology
+
+if sys.version_info[0] < 3:
+    print('Needs python3. Load it using: module load python/3.4.3')
+    sys.exit(0)
+
+
+DEFAULT_SELECTION = 'not water'
+
+# Memory limit in bytes for the computations on a block of frame pairs.
+MAX_BYTES = 1 << 27
+
+
+def center(xyz):
+    """Return frames with their centroid moved to the origin, as float64.
+
+    Parameters
+    ----------
+    xyz : numpy.ndarray
+        coordinates, shape (n_frames, n_atoms, 3).
+    """
+    xyz = np.asarray(xyz, dtype=np.float64)
+    return xyz - xyz.mean(axis=1, keepdims=True)
+
+
+def _max_eigenvalue(h, e0, iterations=50):
+    # Largest eigenvalue of the 4x4 quaternion matrix of each covariance
+    # matrix H (QCP, Theobald, Acta Cryst. A 2005). Newton iterations on its
+    # characteristic polynomial x^4 + c2 x^2 + c1 x + c0, starting from the
+    # upper bound e0 = (|a|^2 + |b|^2) / 2, converge in a few steps.
+    sxx, sxy, sxz = h[:, 0, 0], h[:, 0, 1], h[:, 0, 2]
+    syx, syy, syz = h[:, 1, 0], h[:, 1, 1], h[:, 1, 2]
+    szx, szy, szz = h[:, 2, 0], h[:, 2, 1], h[:, 2, 2]
+    sxx2, syy2, szz2 = sxx * sxx, syy * syy, szz * szz
+    sxy2, syz2, sxz2 = sxy * sxy, syz * syz, sxz * sxz
+    syx2, szy2, szx2 = syx * syx, szy * szy, szx * szx
+
+    c2 = -2 * (sxx2 + syy2 + szz2 + sxy2 + syx2 + sxz2 + szx2 + syz2 + szy2)
+    c1 = 8 * (sxx * syz * szy + syy * szx * sxz + szz * sxy * syx
+              - sxx * syy * szz - syz * szx * sxy - szy * syx * sxz)
+
+    syzszy_syyszz = 2 * (syz * szy - syy * szz)
+    diag = syy2 + szz2 - sxx2 + syz2 + szy2
+    off = sxy2 + sxz2 - syx2 - szx2
+    sxz_p, syz_p, sxy_p = sxz + szx, syz + szy, sxy + syx
+    sxz_m, syz_m, sxy_m = sxz - szx, syz - szy, sxy - syx
+    sxx_p, sxx_m = sxx + syy, sxx - syy
+    c0 = (off * off
+          + (diag + syzszy_syyszz) * (diag - syzszy_syyszz)
+          + (-sxz_p * syz_m + sxy_m * (sxx_m - szz)) * (-sxz_m * syz_p + sxy_m * (sxx_m + szz))
+          + (-sxz_p * syz_p - sxy_p * (sxx_p - szz)) * (-sxz_m * syz_m - sxy_p * (sxx_p + szz))
+          + (sxy_p * syz_p + sxz_p * (sxx_m + szz)) * (-sxy_m * syz_m + sxz_p * (sxx_p + szz))
+          + (sxy_p * syz_m + sxz_m * (sxx_m - szz)) * (-sxy_m * syz_p + sxz_m * (sxx_p - szz)))
+
+    x = e0.copy()
+    for _ in range(iterations):
+        x2 = x * x
+        b = (x2 + c2) * x
+        a = b + c1
+        with np.errstate(invalid='ignore', divide='ignore'):
+            step = (a * x + c0) / (2 * x2 * x + b + a)
+        step[~np.isfinite(step)] = 0
+        x -= step
+        if np.all(np.abs(step) <= 1e-11 * np.abs(x)):
+            break
+    return x
+
+
+def _rmsd_block(a, b, norms_a, norms_b):
+    # Covariance matrices of all pairs with one matrix product:
+    # H[f, g] = a[f].T b[g].
+    fa, n = a.shape[:2]
+    fb = len(b)
+    h = np.dot(a.transpose(0, 2, 1).reshape(fa * 3, n), b.transpose(1, 0, 2).reshape(n, fb * 3))
+    h = h.reshape(fa, 3, fb, 3).transpose(0, 2, 1, 3).reshape(fa * fb, 3, 3)
+    e0 = ((norms_a[:, None] + norms_b[None, :]) / 2).ravel()
+    msd = 2 * (e0 - _max_eigenvalue(h, e0)).reshape(fa, fb) / n
+    return np.sqrt(np.maximum(msd, 0))
+
+
+def pairwise_rmsd(a, b, max_bytes=MAX_BYTES):
+    """Return RMSD after optimal superposition between all frames of a and b.
+
+    Parameters
+    ----------
+    a, b : numpy.ndarray
+        centered coordinates (see center), shapes (n_a, n_atoms, 3) and
+        (n_b, n_atoms, 3).
+    max_bytes : int, optional, default MAX_BYTES
+        memory limit for the covariance matrices of a block of pairs.
+
+    Returns
+    -------
+    rmsd : numpy.ndarray
+        shape (n_a, n_b), in the units of the coordinates.
+    """
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    norms_a = (a * a).sum(axis=(1, 2))
+    norms_b = (b * b).sum(axis=(1, 2))
+    out = np.empty((len(a), len(b)))
+    # Each pair needs a 3x3 matrix and about 40 temporaries for the eigenvalue.
+    pairs = max(1, max_bytes // (8 * 64))
+    cols = max(1, min(len(b), pairs))
+    rows = max(1, pairs // cols)
+    for j in range(0, len(b), cols):
+        for i in range(0, len(a), rows):
+            out[i:i+rows, j:j+cols] = _rmsd_block(a[i:i+rows], b[j:j+cols],
+                                                  norms_a[i:i+rows], norms_b[j:j+cols])
+    return out
+
+
+def rmsd(xyz, ref):
+    """Return RMSD after optimal superposition of every frame of xyz to ref.
+
+    Parameters
+    ----------
+    xyz : numpy.ndarray
+        coordinates, shape (n_frames, n_atoms, 3).
+    ref : numpy.ndarray
+        reference coordinates, shape (n_atoms, 3).
+    """
+    return pairwise_rmsd(center(xyz), center(np.asarray(ref)[None]))[:, 0]
+
+
+def superpose(xyz, ref):
+    """Return frames of xyz rotated and translated onto ref (Kabsch), for all frames at once."""
+    x = center(xyz)
+    r = np.asarray(ref, dtype=np.float64)
+    r_mean = r.mean(axis=0)
+    h = np.einsum('fni,nj->fij', x, r - r_mean)
+    u, s, vt = np.linalg.svd(h)
+    d = np.sign(np.linalg.det(np.matmul(u, vt)))
+    u[:, :, 2] *= d[:, None]
+    rot = np.matmul(u, vt)
+    return np.matmul(x, rot) + r_mean
+
+
+class Frames(object):
+    """Centered coordinates of selected atoms of a trajectory.
+
+    Parameters
+    ----------
+    traj : dcd.DCD
+        opened trajectory.
+    atoms : array of ints
+        positions of the selected atoms.
+    start, stop, stride : int, optional
+        frames to cluster, as in a slice.
+    """
+
+    def __init__(self, traj, atoms, start=0, stop=None, stride=1):
+        self.traj = traj
+        self.atoms = atoms
+        self.indices = np.arange(traj.n_frames)[start:stop:stride]
+
+    def __len__(self):
+        return len(self.indices)
+
+    def get(self, positions):
+        """Return centered coordinates of frames at positions (into self.indices)."""
+        frames = self.indices[np.sort(positions)]
+        order = np.argsort(np.argsort(positions))
+        xyz = self.traj.xyz[frames][:, self.atoms]
+        return center(xyz)[order]
+
+    def chunks(self, size=1000):
+        """Iterate over (positions, centered coordinates) of blocks of frames."""
+        for i in range(0, len(self.indices), size):
+            positions = np.arange(i, min(i + size, len(self.indices)))
+            yield positions, self.get(positions)
+
+
+def leader(frames, cutoff, chunk=1000, max_bytes=MAX_BYTES):
+    """Cluster frames with the leader algorithm in a single pass.
+
+    Parameters
+    ----------
+    frames : Frames
+        frames to cluster.
+    cutoff : float
+        RMSD (A) within which a frame joins a leader.
+
+    Returns
+    -------
+    labels : numpy.ndarray
+        cluster of every frame.
+    centers : numpy.ndarray
+        position of the leader frame of every cluster.
+    distances : numpy.ndarray
+        RMSD of every frame to the leader of its cluster.
+    """
+    labels = np.empty(len(frames), dtype=np.int64)
+    distances = np.empty(len(frames))
+    centers = []
+    leaders = np.zeros((0, len(frames.atoms), 3))
+    for positions, xyz in frames.chunks(chunk):
+        if len(leaders):
+            d = pairwise_rmsd(xyz, leaders, max_bytes)
+            nearest = d.argmin(axis=1)
+            dist = d[np.arange(len(d)), nearest]
+        else:
+            nearest = np.zeros(len(xyz), dtype=np.int64)
+            dist = np.full(len(xyz), np.inf)
+        pending = np.flatnonzero(dist > cutoff)
+        # Frames of this chunk not near any leader: the first one becomes a
+        # leader, and the frames near it join it, until none are left.
+        while len(pending):
+            first = pending[0]
+            centers.append(positions[first])
+            leaders = np.concatenate([leaders, xyz[first][None]])
+            d = pairwise_rmsd(xyz[pending], xyz[first][None], max_bytes)[:, 0]
+            closer = d < dist[pending]
+            nearest[pending[closer]] = len(leaders) - 1
+            dist[pending[closer]] = d[closer]
+            pending = pending[d > cutoff]
+        labels[positions] = nearest
+        distances[positions] = dist
+    return labels, np.array(centers, dtype=np.int64), distances
+
+
+def assign(frames, medoids, chunk=1000, max_bytes=MAX_BYTES):
+    """Return nearest medoid and RMSD to it for every frame.
+
+    Parameters
+    ----------
+    frames : Frames
+        frames to assign.
+    medoids : numpy.ndarray
+        centered coordinates of the medoids.
+    """
+    labels = np.empty(len(frames), dtype=np.int64)
+    distances = np.empty(len(frames))
+    for positions, xyz in frames.chunks(chunk):
+        d = pairwise_rmsd(xyz, medoids, max_bytes)
+        labels[positions] = d.argmin(axis=1)
+        distances[positions] = d[np.arange(len(d)), labels[positions]]
+    return labels, distances
+
+
+def kmedoids(frames, k, batch=2000, iterations=20, seed=0, chunk=1000, max_bytes=MAX_BYTES):
+    """Cluster frames with mini-batch k-medoids.
+
+    Medoids are initialized with k-medoids++ on a random batch. In every
+    iteration a new random batch is assigned to the nearest medoids, and the
+    medoid of each cluster is replaced by the batch member (or the current
+    medoid) with the smallest sum of RMSDs to the batch members of the
+    cluster. Iterations stop early when no medoid changes.
+
+    Parameters
+    ----------
+    frames : Frames
+        frames to cluster.
+    k : int
+        number of clusters.
+    batch : int, optional, default 2000
+        frames per batch.
+    iterations : int, optional, default 20
+        maximum number of batches.
+    seed : int, optional, default 0
+        random seed.
+
+    Returns
+    -------
+    labels, centers, distances : numpy.ndarray
+        see leader. centers are the positions of the medoid frames.
+    """
+    n = len(frames)
+    if k > n:
+        raise ValueError('Cannot make %d clusters of %d frames.' % (k, n))
+    rng = np.random.RandomState(seed)
+    batch = min(batch, n)
+
+    sample = rng.choice(n, batch, replace=False)
+    xyz = frames.get(sample)
+    centers = [sample[rng.randint(batch)]]
+    nearest = pairwise_rmsd(xyz, frames.get(centers), max_bytes)[:, 0]
+    for _ in range(1, k):
+        p = nearest ** 2
+        p = p / p.sum() if p.sum() > 0 else None
+        i = rng.choice(batch, p=p)
+        centers.append(sample[i])
+        nearest = np.minimum(nearest, pairwise_rmsd(xyz, xyz[i][None], max_bytes)[:, 0])
+    centers = np.array(centers, dtype=np.int64)
+
+    for _ in range(iterations):
+        sample = np.setdiff1d(rng.choice(n, batch, replace=False), centers)
+        xyz = frames.get(sample)
+        medoids = frames.get(centers)
+        labels = pairwise_rmsd(xyz, medoids, max_bytes).argmin(axis=1)
+        changed = False
+        for c in range(k):
+            members = np.flatnonzero(labels == c)
+            if len(members) == 0:
+                continue
+            candidates = np.concatenate([medoids[c][None], xyz[members]])
+            cost = pairwise_rmsd(candidates, xyz[members], max_bytes).sum(axis=1)
+            best = cost.argmin()
+            if best > 0:
+                centers[c] = sample[members[best - 1]]
+                changed = True
+        if not changed:
+            break
+
+    labels, distances = assign(frames, frames.get(centers), chunk, max_bytes)
+    return labels, centers, distances
+
+
+def order_clusters(labels, centers, distances):
+    """Renumber clusters by decreasing population.
+
+    Returns
+    -------
+    labels, centers : numpy.ndarray
+        renumbered clusters of the frames, and their centers.
+    population : numpy.ndarray
+        number of frames in each cluster.
+    mean_distance : numpy.ndarray
+        mean RMSD to the center of the frames in each cluster.
+    """
+    population = np.bincount(labels, minlength=len(centers))
+    order = np.argsort(-population, kind='stable')
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    sums = np.bincount(labels, weights=distances, minlength=len(centers))
+    with np.errstate(invalid='ignore'):
+        mean_distance = sums / population
+    return rank[labels], centers[order], population[order], mean_distance[order]
+
+
+def write_clusters(fname, frames, centers, population, mean_distance):
+    """Write representative frame, population and mean RMSD of every cluster to a tsv file."""
+    fraction = population / max(population.sum(), 1)
+    with open(fname, 'w') as fp:
+        fp.write('cluster\tframe\tpopulation\tfraction\tmean_rmsd\n')
+        for c in range(len(centers)):
+            fp.write('%d\t%d\t%d\t%.4f\t%.3f\n' % (c, frames[centers[c]], population[c], fraction[c],
+                                                   mean_distance[c]))
+    return fname
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cluster trajectory frames by RMSD and write '
+                                     'the cluster of every frame and representative frames.')
+    parser.add_argument('--psf',
+                        type=str,
+                        required=True,
+                        help='PSF file.')
+    parser.add_argument('--dcd',
+                        type=str,
+                        required=True,
+                        help='DCD trajectory file, or compressed trajectory (.trjz, see trajzip.py).')
+    parser.add_argument('--prefix',
+                        type=str,
+                        required=True,
+                        help='Prefix of the output files.')
+    parser.add_argument('--select',
+                        type=str,
+                        default=DEFAULT_SELECTION,
+                        help='Atoms to superpose and compare, see topology.py. Default: %s'
+                        % DEFAULT_SELECTION)
+    parser.add_argument('--method',
+                        type=str,
+                        choices=['leader', 'kmedoids'],
+                        default='leader',
+                        help='Clustering method. Default leader.')
+    parser.add_argument('--cutoff',
+                        type=float,
+                        default=2.0,
+                        help='RMSD cutoff (A) of the leader method. Default 2.')
+    parser.add_argument('-k',
+                        type=int,
+                        default=4,
+                        help='Number of clusters of the kmedoids method. Default 4.')
+    parser.add_argument('--batch',
+                        type=int,
+                        default=2000,
+                        help='Frames per batch of the kmedoids method. Default 2000.')
+    parser.add_argument('--seed',
+                        type=int,
+                        default=0,
+                        help='Random seed of the kmedoids method. Default 0.')
+    parser.add_argument('--stride',
+                        type=int,
+                        default=1,
+                        help='Cluster every n-th frame. Default 1.')
+    parser.add_argument('--vmd',
+                        action='store_true',
+                        help='Number frames like VMD with the structure loaded as frame 0, '
+                        'so dcd frames start at 1.')
+
+    args = parser.parse_args()
+
+    for fname in [args.psf, args.dcd]:
+        if not os.path.exists(fname):
+            raise IOError('File %s not found.' % fname)
+
+    top = load_topology(args.psf)
+    atoms = top.select(args.select)
+    if len(atoms) == 0:
+        raise ValueError('No atoms in selection: %s' % args.select)
+
+    with open_trajectory(args.dcd) as traj:
+        if traj.n_atoms != len(top):
+            raise ValueError('Trajectory %s has %d atoms, psf %s has %d atoms.'
+                             % (args.dcd, traj.n_atoms, args.psf, len(top)))
+        frames = Frames(traj, atoms, stride=args.stride)
+        if args.method == 'leader':
+            result = leader(frames, args.cutoff)
+        else:
+            result = kmedoids(frames, args.k, batch=args.batch, seed=args.seed)
+        numbers = frames.indices + 1 if args.vmd else frames.indices
+
+    labels, centers, population, mean_distance = order_clusters(*result)
+    fname = args.prefix + '_cluster.csv'
+    # Same format as measure.write_csvs, with integer clusters.
+    np.savetxt(fname, np.column_stack([numbers, labels]), fmt='%d', delimiter='\t')
+    print(fname)
+    print(write_clusters(args.prefix + '_clusters.tsv', numbers, centers, population, mean_distance))
+    print('frames = %s' % list(int(f) for f in numbers[centers]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,394 @@
+"""Indexed queries over D2P2 post-translational modification (PTM) sites.
+
+Reads the D2P2 PTM dumps (D2P2_PTM_*.txt, tab separated with '\\r' line
+endings) and the site lists derived from them (measurements/*_phos.csv,
+comma separated) into compact columns:
+
+- seqid, genome and ptm: categorical codes into small tables of unique
+  values. The HTML of the Genome field is stripped,
+  '<i>Homo sapiens</i> <release>63_37</release>' -> 'Homo sapiens 63_37'.
+- locus (int32), aa (S1), disordered (bool).
+- context: the +-7 sequence context as S15, aligned so that the site is
+  always at position 7. Contexts cut by the end of the protein are padded
+  with '-'. Modified residues are lower case in the data.
+
+Sites are indexed by Seqid, and by the 3-mers of their (upper case)
+contexts. A motif query looks up the rarest 3-mer of the motif and only
+checks the sites containing it, instead of scanning every context.
+
+Motifs use one letter per residue and x or . for any residue, e.g. RxxS.
+With site=i, position i of the motif must be the site, e.g. RxxS with site=3
+finds sites with an arginine 3 residues before them. Without site, the motif
+can be anywhere in the context.
+
+Parsed columns and indexes are cached in <file>.npz, like topology.py.
+
+Usage: python d2p2.py measurements/hc_dis_ser_phos.csv --motif RxxS --site 3
+       python d2p2.py D2P2_PTM_unverified.txt --ptm PHOSPHORYLATION --seqid ENSP00000225603
+       python d2p2.py D2P2_PTM_unverified.txt --motif PxSP --count
+"""
+
+import sys
+import os
+import re
+import argparse
+import numpy as np
+
+if sys.version_info[0] < 3:
+    print('Needs python3. Load it using: module load python/3.4.3')
+    sys.exit(0)
+
+
+COLUMNS = ['Seqid', 'Genome', 'Locus', 'Amino Acid', 'Is Disordered?', 'PTM Type', 'Sequence Context']
+
+# Residues on each side of the site in a context.
+FLANK = 7
+WIDTH = 2 * FLANK + 1
+GAP = b'-'
+
+# Length of the indexed context substrings. Letters are coded in 5 bits.
+K = 3
+ALPHABET = 32
+
+CACHE_VERSION = 1
+
+
+def _letter_codes(chars):
+    """Return 1..26 for the letters A..Z (any case), 0 for anything else."""
+    upper = chars & 0xDF
+    return np.where((upper >= ord('A')) & (upper <= ord('Z')), upper - ord('A') + 1, 0).astype(np.int64)
+
+
+def _categorical(values):
+    table, codes = np.unique(values, return_inverse=True)
+    return table, codes.astype(np.int32)
+
+
+def align_contexts(contexts, locus, aa):
+    """Return contexts as S15 with the site at position FLANK.
+
+    Parameters
+    ----------
+    contexts : list of bytes
+        sequence contexts, usually 15 residues with the site in the middle.
+        Near the ends of a protein they are shorter.
+    locus : numpy.ndarray
+        1-based position of each site in its protein.
+    aa : list of bytes
+        residue of each site.
+
+    Returns
+    -------
+    aligned : numpy.ndarray
+        S15 array, padded with '-'.
+    """
+    out = np.full(len(contexts), GAP * WIDTH, dtype='S%d' % WIDTH)
+    for i, (context, site, residue) in enumerate(zip(contexts, locus, aa)):
+        if len(context) == WIDTH:
+            out[i] = context
+            continue
+        # Expected position of the site: the context starts at the protein
+        # start for the first residues. Otherwise use the matching residue
+        # closest to it.
+        offset = min(int(site) - 1, FLANK)
+        matches = [j for j, c in enumerate(context.upper()) if c == residue.upper()[0]]
+        if matches and offset not in matches:
+            offset = min(matches, key=lambda j: abs(j - offset))
+        if offset > FLANK:
+            context, offset = context[offset-FLANK:], FLANK
+        out[i] = (GAP * (FLANK - offset) + context + GAP * WIDTH)[:WIDTH]
+    return out
+
+
+def parse_sites(fname):
+    """Return columns of a D2P2 PTM file.
+
+    Both the tab separated dumps and comma separated site lists are read,
+    with any line endings.
+
+    Returns
+    -------
+    columns : dict
+        numpy arrays, see module doc.
+    """
+    with open(fname, 'rb') as fp:
+        data = fp.read()
+    lines = data.replace(b'\r\n', b'\n').replace(b'\r', b'\n').split(b'\n')
+    sep = b'\t' if b'\t' in lines[0] else b','
+    header = [h.strip().decode('ascii', 'replace') for h in lines[0].split(sep)]
+    if header != COLUMNS:
+        raise ValueError('%s is not a D2P2 PTM file, header: %s' % (fname, ', '.join(header)))
+    rows = [line.split(sep) for line in lines[1:] if line.strip()]
+    for i, row in enumerate(rows):
+        if len(row) != len(COLUMNS):
+            raise ValueError('%s line %d has %d fields, expected %d'
+                             % (fname, i + 2, len(row), len(COLUMNS)))
+    fields = list(zip(*rows)) if rows else [()] * len(COLUMNS)
+
+    genomes = [re.sub(br'\s+', b' ', re.sub(br'<[^>]*>', b' ', g)).strip() for g in fields[1]]
+    columns = {}
+    columns['seqid_table'], columns['seqid'] = _categorical(np.array(fields[0], dtype=bytes))
+    columns['genome_table'], columns['genome'] = _categorical(np.array(genomes, dtype=bytes))
+    columns['ptm_table'], columns['ptm'] = _categorical(np.array(fields[5], dtype=bytes))
+    columns['locus'] = np.array(fields[2], dtype=np.int32)
+    columns['aa'] = np.array(fields[3], dtype='S1')
+    columns['disordered'] = np.array([d == b'Disordered' for d in fields[4]], dtype=bool)
+    columns['context'] = align_contexts(fields[6], columns['locus'], fields[3])
+    return columns
+
+
+def build_indexes(columns):
+    """Add the Seqid and context k-mer indexes to the columns of parse_sites.
+
+    Both are sorted arrays with offsets: the sites of seqid code c are
+    seqid_order[seqid_start[c]:seqid_start[c+1]], and the sites (and
+    positions in the context) containing k-mer code m are
+    kmer_site[kmer_start[m]:kmer_start[m+1]] (and kmer_pos[...]).
+    """
+    seqid = columns['seqid']
+    n_seqids = len(columns['seqid_table'])
+    columns['seqid_order'] = np.argsort(seqid, kind='stable').astype(np.int32)
+    columns['seqid_start'] = np.concatenate([[0], np.cumsum(np.bincount(seqid, minlength=n_seqids))])
+
+    n = len(seqid)
+    chars = columns['context'].view(np.uint8).reshape(n, WIDTH)
+    letters = _letter_codes(chars)
+    npos = WIDTH - K + 1
+    kmers = np.zeros((n, npos), dtype=np.int64)
+    valid = np.ones((n, npos), dtype=bool)
+    for j in range(K):
+        kmers = kmers * ALPHABET + letters[:, j:j+npos]
+        valid &= letters[:, j:j+npos] > 0
+    sites = np.broadcast_to(np.arange(n)[:, None], kmers.shape)[valid]
+    positions = np.broadcast_to(np.arange(npos)[None, :], kmers.shape)[valid]
+    kmers = kmers[valid]
+    order = np.argsort(kmers, kind='stable')
+    columns['kmer_site'] = sites[order].astype(np.int32)
+    columns['kmer_pos'] = positions[order].astype(np.int8)
+    columns['kmer_start'] = np.concatenate([[0], np.cumsum(np.bincount(kmers, minlength=ALPHABET ** K))])
+    return columns
+
+
+def _cache_name(fname):
+    return fname + '.npz'
+
+
+def load_sites(fname, cache=True):
+    """Return the Sites of a D2P2 PTM file, using its .npz cache if possible."""
+    stat = os.stat(fname)
+    cache_file = _cache_name(fname)
+    if cache and os.path.exists(cache_file):
+        try:
+            with np.load(cache_file, allow_pickle=False) as data:
+                arrays = dict(data)
+        except (OSError, ValueError):
+            arrays = {}
+        if (arrays.pop('version', None) == CACHE_VERSION and arrays.pop('size', None) == stat.st_size
+                and arrays.pop('mtime', None) == stat.st_mtime_ns):
+            return Sites(arrays)
+
+    arrays = build_indexes(parse_sites(fname))
+    if cache:
+        tmp = '%s.%d.tmp.npz' % (cache_file, os.getpid())
+        try:
+            np.savez(tmp, version=CACHE_VERSION, size=stat.st_size, mtime=stat.st_mtime_ns, **arrays)
+            os.replace(tmp, cache_file)
+        except OSError:
+            # The cache is only an optimization, e.g. the directory is read only.
+            if os.path.exists(tmp):
+                os.remove(tmp)
+    return Sites(arrays)
+
+
+def parse_motif(motif):
+    """Return the residues of a motif as bytes, with 0 for any residue (x or .)."""
+    codes = np.frombuffer(motif.upper().encode('ascii'), dtype=np.uint8).copy()
+    wildcard = (codes == ord('X')) | (codes == ord('.'))
+    codes[wildcard] = 0
+    if not len(codes) or len(codes) > WIDTH:
+        raise ValueError('Motif %s must have 1 to %d residues.' % (motif, WIDTH))
+    if _letter_codes(codes[~wildcard]).min(initial=1) == 0:
+        raise ValueError('Invalid motif %s, use letters and x or . for any residue.' % motif)
+    return codes
+
+
+class Sites(object):
+    """PTM sites in columns, with indexes.
+
+    Parameters
+    ----------
+    arrays : dict
+        columns and indexes, see parse_sites and build_indexes.
+
+    Attributes
+    ----------
+    seqid, genome, ptm : numpy.ndarray
+        int32 codes into seqid_table, genome_table and ptm_table.
+    locus, aa, disordered, context : numpy.ndarray
+        columns of the sites.
+    """
+
+    def __init__(self, arrays):
+        for name, values in arrays.items():
+            setattr(self, name, values)
+        self._seqid_codes = {s.decode('ascii'): i for i, s in enumerate(self.seqid_table)}
+
+    def __len__(self):
+        return len(self.seqid)
+
+    def _code(self, table, value):
+        matches = np.flatnonzero(table == value.encode('ascii'))
+        return matches[0] if len(matches) else -1
+
+    def by_seqid(self, seqid):
+        """Return indices of the sites of a protein."""
+        code = self._seqid_codes.get(seqid)
+        if code is None:
+            return np.zeros(0, dtype=np.int32)
+        return np.sort(self.seqid_order[self.seqid_start[code]:self.seqid_start[code+1]])
+
+    def where(self, seqid=None, genome=None, ptm=None, aa=None, disordered=None):
+        """Return indices of the sites matching all given values."""
+        if seqid is not None:
+            rows = self.by_seqid(seqid)
+        else:
+            rows = np.arange(len(self))
+        mask = np.ones(len(rows), dtype=bool)
+        if genome is not None:
+            mask &= self.genome[rows] == self._code(self.genome_table, genome)
+        if ptm is not None:
+            mask &= self.ptm[rows] == self._code(self.ptm_table, ptm.upper())
+        if aa is not None:
+            mask &= self.aa[rows] == aa.upper().encode('ascii')
+        if disordered is not None:
+            mask &= self.disordered[rows] == disordered
+        return rows[mask]
+
+    def _candidates(self, codes, site):
+        """Return (sites, motif start in the context) that may match a motif, using the k-mer index."""
+        letters = _letter_codes(codes)
+        best = None
+        for j in range(len(codes) - K + 1):
+            if (letters[j:j+K] == 0).any():
+                continue
+            kmer = 0
+            for c in letters[j:j+K]:
+                kmer = kmer * ALPHABET + int(c)
+            count = self.kmer_start[kmer+1] - self.kmer_start[kmer]
+            if best is None or count < best[0]:
+                best = (count, kmer, j)
+        if best is None:
+            # No k-mer without wildcards: every site and start is a candidate.
+            starts = np.arange(WIDTH - len(codes) + 1) if site is None else np.array([FLANK - site])
+            sites = np.repeat(np.arange(len(self)), len(starts))
+            return sites, np.tile(starts, len(self))
+        count, kmer, j = best
+        lo, hi = self.kmer_start[kmer], self.kmer_start[kmer+1]
+        sites = self.kmer_site[lo:hi]
+        starts = self.kmer_pos[lo:hi].astype(np.int64) - j
+        if site is not None:
+            keep = starts == FLANK - site
+            sites, starts = sites[keep], starts[keep]
+        return sites, starts
+
+    def motif(self, motif, site=None, rows=None):
+        """Return indices of the sites whose context matches a motif.
+
+        Parameters
+        ----------
+        motif : string
+            residues, x or . for any residue, e.g. RxxS. Case insensitive.
+        site : int, optional, default None
+            position of the site in the motif. Default: anywhere.
+        rows : numpy.ndarray, optional
+            only search these sites, e.g. from where.
+        """
+        codes = parse_motif(motif)
+        if site is not None and not (0 <= site < len(codes) and FLANK - site + len(codes) <= WIDTH):
+            raise ValueError('Site %d of motif %s does not fit in the +-%d context.' % (site, motif, FLANK))
+        sites, starts = self._candidates(codes, site)
+        ok = (starts >= 0) & (starts + len(codes) <= WIDTH)
+        sites, starts = sites[ok], starts[ok]
+
+        chars = self.context.view(np.uint8).reshape(len(self), WIDTH) & 0xDF
+        fixed = np.flatnonzero(codes)
+        match = np.ones(len(sites), dtype=bool)
+        for j in fixed:
+            match &= chars[sites, starts + j] == codes[j]
+        found = np.unique(sites[match])
+        if rows is not None:
+            found = np.intersect1d(found, rows)
+        return found
+
+    def to_dataframe(self, rows=None):
+        """Return sites as a pandas DataFrame with the columns of the D2P2 files."""
+        import pandas as pd
+        rows = np.arange(len(self)) if rows is None else rows
+        decode = np.char.decode
+        return pd.DataFrame({'Seqid': decode(self.seqid_table[self.seqid[rows]], 'ascii'),
+                             'Genome': decode(self.genome_table[self.genome[rows]], 'ascii'),
+                             'Locus': self.locus[rows],
+                             'Amino Acid': decode(self.aa[rows], 'ascii'),
+                             'Is Disordered?': self.disordered[rows],
+                             'PTM Type': decode(self.ptm_table[self.ptm[rows]], 'ascii'),
+                             'Sequence Context': decode(self.context[rows], 'ascii')},
+                            columns=COLUMNS, index=rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Query PTM sites of D2P2 files by protein, type '
+                                     'and sequence context motif.')
+    parser.add_argument('files',
+                        type=str,
+                        nargs='+',
+                        help='D2P2 PTM files, e.g. D2P2_PTM_unverified.txt or '
+                        'measurements/hc_dis_ser_phos.csv.')
+    parser.add_argument('--motif',
+                        type=str,
+                        default=None,
+                        help='Context motif, x or . for any residue, e.g. RxxS.')
+    parser.add_argument('--site',
+                        type=int,
+                        default=None,
+                        help='Position of the site in the motif (0-based). Default: anywhere.')
+    parser.add_argument('--seqid',
+                        type=str,
+                        default=None,
+                        help='Only sites of this protein.')
+    parser.add_argument('--ptm',
+                        type=str,
+                        default=None,
+                        help='Only sites of this PTM type, e.g. PHOSPHORYLATION.')
+    parser.add_argument('--aa',
+                        type=str,
+                        default=None,
+                        help='Only sites of this residue, e.g. S.')
+    parser.add_argument('--count',
+                        action='store_true',
+                        help='Only print the number of matching sites.')
+
+    args = parser.parse_args()
+
+    for fname in args.files:
+        if not os.path.exists(fname):
+            raise IOError('File %s not found.' % fname)
+
+    for fname in args.files:
+        sites = load_sites(fname)
+        rows = sites.where(seqid=args.seqid, ptm=args.ptm, aa=args.aa)
+        if args.motif:
+            rows = sites.motif(args.motif, args.site, rows)
+        if args.count:
+            print('%s\t%d' % (fname, len(rows)))
+            continue
+        for i in rows:
+            print('\t'.join([sites.seqid_table[sites.seqid[i]].decode('ascii'),
+                             sites.genome_table[sites.genome[i]].decode('ascii'),
+                             str(sites.locus[i]), sites.aa[i].decode('ascii'),
+                             'Disordered' if sites.disordered[i] else '',
+                             sites.ptm_table[sites.ptm[i]].decode('ascii'),
+                             sites.context[i].decode('ascii')]))
+
+
+if __name__ == "__main__":
+    main()
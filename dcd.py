@@ -0,0 +1,342 @@
+"""Memory-mapped reader and streaming writer for CHARMM/NAMD DCD trajectories.
+
+Frames are exposed as a zero-copy numpy view of shape (n_frames, n_atoms, 3),
+so any frame (or every n-th frame) can be accessed without reading the rest
+of the trajectory into memory. DCDWriter writes blocks of frames in the
+format NAMD writes (CHARMM, little-endian), e.g. a protein-only copy of a
+trajectory, see trajzip.py.
+
+Usage: python dcd.py psfgen/namdrun_run.namdout.dcd
+"""
+
+import sys
+import os
+import argparse
+import numpy as np
+
+if sys.version_info[0] < 3:
+    print('Needs python3. Load it using: module load python/3.4.3')
+    sys.exit(0)
+
+
+# Size of the fortran record markers around every block in a DCD file.
+MARKER = 4
+
+
+class DCD(object):
+    """A DCD trajectory file opened for random frame access.
+
+    The file is memory-mapped, nothing but the header is read when the object
+    is created. Coordinates of a frame are only read from disk when they are
+    accessed.
+
+    Parameters
+    ----------
+    fname : string
+        path of the dcd file.
+
+    Attributes
+    ----------
+    n_frames : int
+        number of complete frames in the file. This is computed from the file
+        size, so it is correct even if the simulation was killed before NAMD
+        updated the header.
+    n_atoms : int
+        number of atoms in each frame.
+    istart : int
+        timestep of the first frame.
+    nsavc : int
+        number of timesteps between frames (dcdfreq).
+    delta : float
+        timestep in AKMA units.
+    title : list of strings
+        title (REMARKS) lines in the header.
+    xyz : numpy.ndarray
+        float32 view of shape (n_frames, n_atoms, 3) into the file.
+    unitcell : numpy.ndarray or None
+        float64 view of shape (n_frames, 6) into the file with the unit cell
+        (A, gamma, B, beta, alpha, C) of every frame, or None if the file has
+        no unit cell blocks.
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        self._read_header()
+        self._map()
+
+    def _read_header(self):
+        with open(self.fname, 'rb') as fp:
+            head = fp.read(MARKER)
+            if len(head) < MARKER:
+                raise ValueError('File %s is not a dcd file.' % self.fname)
+            # The first record is always 84 bytes long, use it to detect byte order.
+            for endian in ['<', '>']:
+                if np.frombuffer(head, dtype=endian + 'i4')[0] == 84:
+                    break
+            else:
+                raise ValueError('File %s is not a dcd file.' % self.fname)
+            self.endian = endian
+            i4 = np.dtype(endian + 'i4')
+
+            block = fp.read(84 + MARKER)
+            if block[:4] != b'CORD':
+                raise ValueError('File %s is not a coordinate dcd file.' % self.fname)
+            icntrl = np.frombuffer(block[4:84], dtype=i4)
+            self.istart = int(icntrl[1])
+            self.nsavc = int(icntrl[2])
+            self.nfixed = int(icntrl[8])
+            if icntrl[19] != 0:
+                # CHARMM format stores delta as float32 and has extra flags.
+                self.delta = float(np.frombuffer(block[40:44], dtype=endian + 'f4')[0])
+                self.has_unitcell = icntrl[10] != 0
+                has_4d = icntrl[11] != 0
+            else:
+                # X-PLOR format stores delta as float64.
+                self.delta = float(np.frombuffer(block[40:48], dtype=endian + 'f8')[0])
+                self.has_unitcell = False
+                has_4d = False
+            if has_4d:
+                raise ValueError('4D dcd files are not supported: %s' % self.fname)
+            if self.nfixed:
+                raise ValueError('dcd files with fixed atoms are not supported: %s' % self.fname)
+
+            size = int(np.frombuffer(fp.read(MARKER), dtype=i4)[0])
+            block = fp.read(size + MARKER)
+            ntitle = int(np.frombuffer(block[:4], dtype=i4)[0])
+            self.title = [block[4+80*i:4+80*(i+1)].decode('ascii', 'replace').strip()
+                          for i in range(ntitle)]
+
+            block = fp.read(MARKER + 4 + MARKER)
+            self.n_atoms = int(np.frombuffer(block[4:8], dtype=i4)[0])
+            self.header_size = fp.tell()
+
+        cellsize = 2*MARKER + 48 if self.has_unitcell else 0
+        self.frame_size = cellsize + 3 * (2*MARKER + 4*self.n_atoms)
+        filesize = os.path.getsize(self.fname)
+        self.n_frames = (filesize - self.header_size) // self.frame_size
+
+    def _map(self):
+        if self.n_frames == 0:
+            self._mmap = None
+            self.xyz = np.zeros((0, self.n_atoms, 3), dtype=self.endian + 'f4')
+            self.unitcell = np.zeros((0, 6)) if self.has_unitcell else None
+            return
+        self._mmap = np.memmap(self.fname, dtype=np.uint8, mode='r', offset=0,
+                               shape=(self.header_size + self.n_frames * self.frame_size,))
+        offset = self.header_size
+        if self.has_unitcell:
+            self.unitcell = np.ndarray(shape=(self.n_frames, 6), dtype=self.endian + 'f8',
+                                       buffer=self._mmap, offset=offset + MARKER,
+                                       strides=(self.frame_size, 8))
+            offset += 2*MARKER + 48
+        else:
+            self.unitcell = None
+        # X, Y and Z are stored as separate blocks for each frame. Stride over
+        # them so we get (frame, atom, xyz) indexing without a copy.
+        self.xyz = np.ndarray(shape=(self.n_frames, self.n_atoms, 3), dtype=self.endian + 'f4',
+                              buffer=self._mmap, offset=offset + MARKER,
+                              strides=(self.frame_size, 4, 2*MARKER + 4*self.n_atoms))
+
+    @property
+    def timestep(self):
+        """Timestep in femtoseconds."""
+        return self.delta * 48.88821
+
+    def __len__(self):
+        return self.n_frames
+
+    def __getitem__(self, index):
+        """Return coordinates for a frame, or a view for a slice of frames."""
+        return self.xyz[index]
+
+    def frames(self, start=0, stop=None, stride=1):
+        """Return a view of frames start:stop:stride with shape (n, n_atoms, 3)."""
+        return self.xyz[start:stop:stride]
+
+    def chunks(self, size=1000, start=0, stop=None, stride=1, atoms=None):
+        """Iterate over blocks of frames.
+
+        Parameters
+        ----------
+        size : int, optional, default 1000
+            maximum number of frames in each block.
+        start, stop, stride : int, optional
+            frame range to iterate over, as in a slice.
+        atoms : array of ints, optional, default None
+            only read coordinates of these atoms.
+
+        Yields
+        ------
+        frames : numpy.ndarray
+            frame indices in this block.
+        xyz : numpy.ndarray
+            float32 array of shape (len(frames), n_atoms, 3) with coordinates
+            of these frames. This is a copy, not a view into the file.
+        """
+        indices = np.arange(self.n_frames)[start:stop:stride]
+        for i in range(0, len(indices), size):
+            frames = indices[i:i+size]
+            xyz = self.xyz[frames[0]:frames[-1]+1:stride]
+            if atoms is not None:
+                xyz = xyz[:, atoms]
+            yield frames, np.asarray(xyz, dtype=np.float32)
+
+    def close(self):
+        """Release the memory map of the file."""
+        self.xyz = None
+        self.unitcell = None
+        self._mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class DCDWriter(object):
+    """A DCD trajectory file written a block of frames at a time.
+
+    The number of frames in the header is updated when the file is closed.
+
+    Parameters
+    ----------
+    fname : string
+        path of the dcd file. It is replaced if it exists.
+    n_atoms : int
+        number of atoms in each frame.
+    istart : int, optional, default 0
+        timestep of the first frame.
+    nsavc : int, optional, default 1
+        number of timesteps between frames (dcdfreq).
+    delta : float, optional, default 1 fs
+        timestep in AKMA units.
+    unitcell : bool, optional, default False
+        write the unit cell of every frame.
+    title : list of strings, optional
+        title (REMARKS) lines, at most 80 characters each.
+    """
+
+    def __init__(self, fname, n_atoms, istart=0, nsavc=1, delta=1 / 48.88821, unitcell=False,
+                 title=None):
+        self.fname = fname
+        self.n_atoms = n_atoms
+        self.istart = istart
+        self.nsavc = nsavc
+        self.delta = delta
+        self.has_unitcell = unitcell
+        self.n_frames = 0
+        self._fp = open(fname, 'wb')
+        self._fp.write(self._header(title or ['REMARKS FILENAME=%s' % os.path.basename(fname)]))
+
+    def _header(self, title):
+        icntrl = np.zeros(20, dtype='<i4')
+        icntrl[0] = self.n_frames
+        icntrl[1] = self.istart
+        icntrl[2] = self.nsavc
+        icntrl[3] = self.n_frames * self.nsavc
+        icntrl[10] = int(self.has_unitcell)
+        icntrl[19] = 24
+        block = bytearray(b'CORD' + icntrl.tobytes())
+        block[40:44] = np.array([self.delta], dtype='<f4').tobytes()
+        lines = b''.join(line.encode('ascii', 'replace')[:80].ljust(80) for line in title)
+        records = [bytes(block), np.array([len(title)], dtype='<i4').tobytes() + lines,
+                   np.array([self.n_atoms], dtype='<i4').tobytes()]
+        return b''.join(_record(r) for r in records)
+
+    def write(self, xyz, unitcell=None):
+        """Append frames.
+
+        Parameters
+        ----------
+        xyz : numpy.ndarray
+            coordinates of shape (n_frames, n_atoms, 3), or (n_atoms, 3) for
+            a single frame.
+        unitcell : numpy.ndarray, optional
+            unit cell (A, gamma, B, beta, alpha, C) of each frame, shape
+            (n_frames, 6). Required when the file has unit cells.
+        """
+        xyz = np.asarray(xyz, dtype='<f4')
+        if xyz.ndim == 2:
+            xyz = xyz[None]
+        frames = len(xyz)
+        if xyz.shape[1:] != (self.n_atoms, 3):
+            raise ValueError('Frames have shape %s, expected (n, %d, 3).' % (xyz.shape, self.n_atoms))
+        if self.has_unitcell and unitcell is None:
+            raise ValueError('%s needs the unit cell of every frame.' % self.fname)
+
+        # Build all records of the frames in one buffer: the unit cell, then
+        # the X, Y and Z blocks, each between size markers.
+        cellsize = 2*MARKER + 48 if self.has_unitcell else 0
+        coordsize = 2*MARKER + 4*self.n_atoms
+        buf = np.empty((frames, cellsize + 3*coordsize), dtype=np.uint8)
+        if self.has_unitcell:
+            cell = np.asarray(unitcell, dtype='<f8').reshape(frames, 6)
+            buf[:, :MARKER] = buf[:, MARKER+48:cellsize] = _marker(48)
+            buf[:, MARKER:MARKER+48] = cell.view(np.uint8).reshape(frames, 48)
+        for k in range(3):
+            start = cellsize + k*coordsize
+            buf[:, start:start+MARKER] = _marker(4*self.n_atoms)
+            coords = np.ascontiguousarray(xyz[:, :, k])
+            buf[:, start+MARKER:start+coordsize-MARKER] = coords.view(np.uint8).reshape(frames, -1)
+            buf[:, start+coordsize-MARKER:start+coordsize] = _marker(4*self.n_atoms)
+        self._fp.write(buf.tobytes())
+        self.n_frames += frames
+
+    def close(self):
+        """Write the number of frames in the header and close the file."""
+        if self._fp is None:
+            return
+        icntrl = np.array([self.n_frames, self.istart, self.nsavc, self.n_frames * self.nsavc],
+                          dtype='<i4')
+        self._fp.seek(MARKER + 4)
+        self._fp.write(icntrl.tobytes())
+        self._fp.close()
+        self._fp = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _marker(size):
+    return np.frombuffer(np.array([size], dtype='<i4').tobytes(), dtype=np.uint8)
+
+
+def _record(data):
+    marker = np.array([len(data)], dtype='<i4').tobytes()
+    return marker + data + marker
+
+
+def open_trajectory(fname):
+    """Return a DCD, or a CompressedTrajectory for a trajzip.py file (same interface)."""
+    import trajzip
+    if fname.endswith(trajzip.EXTENSION):
+        return trajzip.CompressedTrajectory(fname)
+    return DCD(fname)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Print information about a dcd file.')
+    parser.add_argument('dcd',
+                        type=str,
+                        help='DCD file.')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.dcd):
+        raise IOError('File %s not found.' % args.dcd)
+
+    with DCD(args.dcd) as dcd:
+        for line in dcd.title:
+            print(line)
+        print('atoms: %d' % dcd.n_atoms)
+        print('frames: %d' % dcd.n_frames)
+        print('first step: %d, steps per frame: %d, timestep: %.3f fs'
+              % (dcd.istart, dcd.nsavc, dcd.timestep))
+        print('unit cell: %s' % ('yes' if dcd.has_unitcell else 'no'))
+
+
+if __name__ == "__main__":
+    main()
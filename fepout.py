@@ -0,0 +1,522 @@
+"""Script to estimate free energy changes from NAMD fepout files.
+
+The fepout file is read in large chunks, and the samples of each lambda window
+are converted to numpy arrays without creating python objects for each line.
+Samples before '#STARTING COLLECTION OF ENSEMBLE AVERAGE' (alchEquilSteps) are
+skipped. The free energy change is estimated with exponential averaging (EXP)
+of the forward energies, and, if the backward energies were written
+(alchLambdaIDWS, added by jobgen.py --idws, needs NAMD 2.12 or newer), also
+with BAR and MBAR. Without backward energies only the forward EXP is
+reported. For alchType ti output, TI is used. Errors are the standard deviation
+over block bootstrap samples.
+
+Several fepout files are analysed in parallel in a process pool. With
+--versus, the difference of the mean free energy of the two sets of runs
+is printed, e.g. for phosphorylated vs unphosphorylated runs.
+
+Usage: python fepout.py p1_run*/namdrun.fepout --versus up1_run*/namdrun.fepout
+"""
+
+import sys
+import os
+import re
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+if sys.version_info[0] < 3:
+    print('Needs python3. Load it using: module load python/3.4.3')
+    sys.exit(0)
+
+
+# Boltzmann constant in kcal/mol/K, as used by NAMD.
+BOLTZMANN = 0.001987191
+
+# Temperature in the template tcl files.
+TEMPERATURE = 298.15
+
+CHUNK_SIZE = 1 << 24
+
+# Prefix of data lines: forward, backward (IDWS) and TI energies.
+RECORDS = {'forward': b'FepEnergy:', 'backward': b'FepE_back:', 'ti': b'TI:'}
+
+# Columns of FepEnergy and FepE_back lines.
+FEP_COLUMNS = ['step', 'elec_l', 'elec_l2', 'vdw_l', 'vdw_l2', 'dE', 'dE_avg', 'temperature', 'dG']
+
+# Columns of TI lines.
+TI_COLUMNS = ['step', 'bond1', 'avgbond1', 'elect1', 'avgelect1', 'vdw1', 'avgvdw1',
+              'bond2', 'avgbond2', 'elect2', 'avgelect2', 'vdw2', 'avgvdw2']
+
+MARKER = re.compile(rb'^#(NEW (?:FEP|TI) WINDOW|STARTING COLLECTION)[^\n]*\n?', re.M)
+WINDOW = re.compile(rb'LAMBDA(?: SET TO)? (\S+)(?: LAMBDA2 (\S+))?(?: LAMBDA_IDWS (\S+))?')
+
+
+def _parse_records(text, record):
+    """Return rows of numbers on lines of text starting with record."""
+    # Drop every other line in one regex pass, then parse all numbers at once.
+    lines = re.sub(rb'(?m)^(?!' + re.escape(record) + rb').*\n?', b'', text)
+    if not lines:
+        return None
+    ncols = len(lines[:lines.find(b'\n') if b'\n' in lines else len(lines)].split()) - 1
+    values = np.fromstring(lines.replace(record, b' '), sep=' ')
+    return values.reshape(-1, ncols)
+
+
+def read_fepout(fname, chunksize=CHUNK_SIZE):
+    """Read the lambda windows in a fepout file.
+
+    Parameters
+    ----------
+    fname : string
+        fepout file path.
+    chunksize : int, optional
+        number of bytes read at a time.
+
+    Returns
+    -------
+    windows : list of dicts
+        one dict for each lambda window, in file order, with consecutive
+        windows at the same lambda (a window continued after a restart)
+        merged. Each has:
+        'lambda': (lambda, lambda2) for FEP, or (lambda,) for TI windows.
+        'idws': lambda of the backward energies, or None.
+        'forward', 'backward', 'ti': arrays of collected samples (rows are
+        lines with FEP_COLUMNS or TI_COLUMNS) or None.
+    """
+    windows = []
+    pending = {}
+    collecting = [True]
+
+    def add(text):
+        if not windows:
+            # Data before the first window marker belongs to an unnamed window.
+            windows.append({'lambda': (), 'idws': None})
+        for kind, record in RECORDS.items():
+            if text.find(record) == -1:
+                continue
+            rows = _parse_records(text, record)
+            if rows is not None and collecting[0]:
+                pending.setdefault((len(windows) - 1, kind), []).append(rows)
+
+    with open(fname, 'rb') as fp:
+        rest = b''
+        while True:
+            chunk = fp.read(chunksize)
+            text = rest + chunk
+            if chunk:
+                end = text.rfind(b'\n') + 1
+                text, rest = text[:end], text[end:]
+            pos = 0
+            for m in MARKER.finditer(text):
+                add(text[pos:m.start()])
+                pos = m.end()
+                if m.group(1).startswith(b'NEW'):
+                    values = WINDOW.search(m.group(0)).groups()
+                    window = {'lambda': tuple(float(v) for v in values[:2] if v is not None),
+                              'idws': float(values[2]) if values[2] is not None else None}
+                    # A window continued in a restarted run (jobgen.py --chain) is merged.
+                    if not windows or windows[-1] != window:
+                        windows.append(window)
+                    # alchEquilSteps samples come before the collection marker.
+                    collecting[0] = False
+                else:
+                    collecting[0] = True
+            add(text[pos:])
+            if not chunk:
+                break
+
+    for i, window in enumerate(windows):
+        for kind in RECORDS:
+            rows = pending.get((i, kind))
+            window[kind] = np.concatenate(rows) if rows else None
+    return [w for w in windows if any(w[kind] is not None for kind in RECORDS)]
+
+
+def block_bootstrap(n, block, nboot, rng):
+    """Return counts of each sample in moving block bootstrap replicates.
+
+    Returns
+    -------
+    counts : numpy.ndarray
+        float array of shape (nboot, n). Row r is how many times each sample
+        is used in replicate r, scaled to n samples in total.
+    """
+    block = max(1, min(block, n))
+    nblocks = int(np.ceil(n / block))
+    starts = rng.integers(0, n - block + 1, size=(nboot, nblocks))
+    # Each block adds 1 from its start to its end: accumulate the +1/-1 steps
+    # of all blocks in one bincount and integrate them with cumsum.
+    rows = np.arange(nboot)[:, None] * (n + 1)
+    steps = np.bincount((rows + starts).ravel(), minlength=nboot * (n + 1)) \
+        - np.bincount((rows + starts + block).ravel(), minlength=nboot * (n + 1))
+    counts = np.cumsum(steps.reshape(nboot, n + 1)[:, :n], axis=1)
+    return counts * (n / (nblocks * block))
+
+
+def bootstrap(estimator, samples, block, nboot, rng, batch=1 << 22):
+    """Return estimator values for block bootstrap replicates of samples.
+
+    Parameters
+    ----------
+    estimator : callable
+        estimator(samples, weights) returns a value, or an array of values
+        for each replicate if weights are given.
+    samples : list of numpy.ndarray
+        independent sets of samples, e.g. works in each lambda window.
+    block : int
+        number of consecutive samples in a bootstrap block.
+    nboot : int
+        number of replicates.
+    batch : int, optional
+        replicates are evaluated in batches of about this many weights, to
+        bound memory use.
+
+    Returns
+    -------
+    values : numpy.ndarray
+        shape (nboot,).
+    """
+    size = max(1, batch // max(len(x) for x in samples))
+    values = []
+    for first in range(0, nboot, size):
+        m = min(size, nboot - first)
+        weights = [block_bootstrap(len(x), block, m, rng) for x in samples]
+        values.append(estimator(samples, weights))
+    return np.concatenate(values)
+
+
+def _logsumexp(x, weights=None, axis=-1):
+    m = np.max(x, axis=axis, keepdims=True)
+    e = np.exp(x - m)
+    if weights is not None:
+        e = e * weights
+    return np.log(e.sum(axis=axis)) + np.squeeze(m, axis=axis)
+
+
+def exp_average(w, weights=None):
+    """Return free energy (kT units) from works w (kT units) by exponential averaging.
+
+    Parameters
+    ----------
+    w : numpy.ndarray
+        works, shape (n,).
+    weights : numpy.ndarray, optional
+        sample weights (bootstrap counts), shape (..., n).
+
+    Returns
+    -------
+    df : float or numpy.ndarray
+        -ln <exp(-w)>, with shape weights.shape[:-1] if weights are given.
+    """
+    if weights is None:
+        return -(_logsumexp(-w) - np.log(len(w)))
+    return -(_logsumexp(-w[None], weights) - np.log(weights.sum(axis=-1)))
+
+
+def bar(wF, wR, weightsF=None, weightsR=None, tol=1e-10, maxiter=100):
+    """Return free energy (kT units) by Bennett acceptance ratio.
+
+    Solves sum_F f(M + wF - df) = sum_R f(-M + wR + df) with f the Fermi
+    function and M = ln(nF/nR), by Newton iterations safeguarded with
+    bisection. Vectorized over bootstrap replicates.
+
+    Parameters
+    ----------
+    wF : numpy.ndarray
+        forward works (kT), U(lambda2) - U(lambda) on samples from lambda.
+    wR : numpy.ndarray
+        backward works (kT), U(lambda) - U(lambda2) on samples from lambda2.
+    weightsF, weightsR : numpy.ndarray, optional
+        sample weights (bootstrap counts) of shape (nboot, nF), (nboot, nR).
+
+    Returns
+    -------
+    df : float or numpy.ndarray
+        free energy change from lambda to lambda2, shape (nboot,) if weights
+        are given.
+    """
+    single = weightsF is None
+    if single:
+        weightsF = np.ones((1, len(wF)))
+        weightsR = np.ones((1, len(wR)))
+    nF = weightsF.sum(axis=-1)
+    nR = weightsR.sum(axis=-1)
+    M = np.log(nF / nR)
+
+    lo = np.full(len(nF), min(wF.min(), -wR.max()))
+    hi = np.full(len(nF), max(wF.max(), -wR.min()))
+    df = 0.5 * (exp_average(wF, weightsF) - exp_average(wR, weightsR))
+    df = np.clip(df, lo, hi)
+    for _ in range(maxiter):
+        fF = 1 / (1 + np.exp(np.clip(M[:, None] + wF[None] - df[:, None], -500, 500)))
+        fR = 1 / (1 + np.exp(np.clip(-M[:, None] + wR[None] + df[:, None], -500, 500)))
+        g = (weightsF * fF).sum(axis=-1) - (weightsR * fR).sum(axis=-1)
+        dg = (weightsF * fF * (1 - fF)).sum(axis=-1) + (weightsR * fR * (1 - fR)).sum(axis=-1)
+        # g increases with df, keep the root bracketed.
+        lo = np.where(g < 0, df, lo)
+        hi = np.where(g > 0, df, hi)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            new = df - g / dg
+        bad = ~np.isfinite(new) | (new <= lo) | (new >= hi)
+        new = np.where(bad, 0.5 * (lo + hi), new)
+        converged = np.abs(new - df).max() < tol
+        df = new
+        if converged:
+            break
+    return df[0] if single else df
+
+
+def mbar(u_kn, N_k, weights=None, tol=1e-10, maxiter=100):
+    """Return reduced free energies of K states by MBAR.
+
+    The MBAR equations are solved by Newton iterations, falling back to a
+    self-consistent iteration where a Newton step does not reduce the
+    gradient. Vectorized over bootstrap replicates.
+
+    Parameters
+    ----------
+    u_kn : numpy.ndarray
+        reduced potential of each of the N samples in each of the K states,
+        shape (K, N). Samples are ordered by the state they come from.
+    N_k : array of ints
+        number of samples from each state.
+    weights : numpy.ndarray, optional
+        sample weights (bootstrap counts), shape (nboot, N).
+
+    Returns
+    -------
+    f_k : numpy.ndarray
+        free energies relative to state 0, shape (K,) or (nboot, K).
+    """
+    single = weights is None
+    K, N = u_kn.shape
+    if single:
+        weights = np.ones((1, N))
+    state = np.repeat(np.arange(K), N_k)
+    # Weighted number of samples from each state, per replicate.
+    Nw = np.stack([weights[:, state == k].sum(axis=-1) for k in range(K)], axis=-1)
+    logN = np.log(Nw)
+
+    def evaluate(f):
+        # p[b, k, n]: probability that sample n comes from state k.
+        logp = logN[:, :, None] + f[:, :, None] - u_kn[None]
+        log_denom = _logsumexp(logp, axis=1)
+        p = np.exp(logp - log_denom[:, None, :])
+        grad = Nw - (weights[:, None, :] * p).sum(axis=-1)
+        return p, grad, log_denom
+
+    f = np.zeros((len(weights), K))
+    p, grad, log_denom = evaluate(f)
+    for _ in range(maxiter):
+        wp = weights[:, None, :] * p
+        hess = np.einsum('bkn,bln->bkl', wp, p) - np.eye(K) * wp.sum(axis=-1)[:, :, None]
+        # f_0 = 0 is fixed, solve for the other states.
+        step = np.zeros_like(f)
+        step[:, 1:] = np.linalg.solve(hess[:, 1:, 1:], grad[:, 1:, None])[..., 0]
+        newton = f - step
+        self_consistent = -_logsumexp(-u_kn[None] - log_denom[:, None, :], weights[:, None, :])
+        self_consistent -= self_consistent[:, :1]
+        p_new, grad_new, log_denom_new = evaluate(newton)
+        bad = ~(np.abs(grad_new).sum(axis=1) < np.abs(grad).sum(axis=1))
+        if bad.any():
+            new = np.where(bad[:, None], self_consistent, newton)
+            p_new, grad_new, log_denom_new = evaluate(new)
+        else:
+            new = newton
+        converged = np.abs(new - f).max() < tol
+        f, p, grad, log_denom = new, p_new, grad_new, log_denom_new
+        if converged:
+            break
+    return f[0] if single else f
+
+
+def ti(lambdas, dudl, weights=None):
+    """Return free energy by trapezoidal integration of <dU/dlambda>."""
+    if weights is None:
+        means = np.array([d.mean() for d in dudl])
+    else:
+        means = np.stack([(w * d[None]).sum(axis=-1) / w.sum(axis=-1)
+                          for d, w in zip(dudl, weights)], axis=-1)
+    return np.trapezoid(means, lambdas, axis=-1) if hasattr(np, 'trapezoid') \
+        else np.trapz(means, lambdas, axis=-1)
+
+
+def analyze(fname, temperature=TEMPERATURE, nboot=100, block=200, seed=0):
+    """Return free energy estimates for a fepout file.
+
+    BAR and MBAR need the backward energies written with alchLambdaIDWS set
+    to the previous lambda (jobgen.py --idws). Without them, only EXP of the
+    forward energies is returned.
+
+    Parameters
+    ----------
+    fname : string
+        fepout file path.
+    temperature : float, optional, default 298.15
+        temperature in K.
+    nboot : int, optional, default 100
+        number of bootstrap replicates for the errors.
+    block : int, optional, default 200
+        number of consecutive samples in a bootstrap block. Samples written
+        every few steps are correlated, blocks should be longer than the
+        correlation time.
+    seed : int, optional, default 0
+        random seed for the bootstrap.
+
+    Returns
+    -------
+    results : dict
+        (dG, error) in kcal/mol for each method that could be used:
+        EXP, EXP_back, BAR, MBAR, TI.
+    """
+    kT = BOLTZMANN * temperature
+    windows = read_fepout(fname)
+    if not windows:
+        raise ValueError('No samples found in %s' % fname)
+    results = {}
+
+    def estimate(method, estimator, samples):
+        value = estimator(samples, [None] * len(samples))
+        # The same replicates for every method, so their errors are comparable.
+        boot = bootstrap(estimator, samples, block, nboot, np.random.default_rng(seed))
+        results[method] = (kT * value, kT * np.std(boot))
+
+    fep = sorted([w for w in windows if w['forward'] is not None], key=lambda w: w['lambda'])
+    if fep:
+        wF = [w['forward'][:, 5] / kT for w in fep]
+        estimate('EXP', lambda s, c: sum(exp_average(x, w) for x, w in zip(s, c)), wF)
+
+        # Backward energies of window i evaluate the lambda of window i-1.
+        wR = [w['backward'][:, 5] / kT for w in fep[1:]
+              if w['backward'] is not None and w['idws'] is not None]
+        matched = all(np.isclose(w['idws'], prev['lambda'][0]) for w, prev in zip(fep[1:], fep)
+                      if w['idws'] is not None)
+        if fep[1:] and len(wR) == len(fep) - 1 and matched:
+            n = len(wR)
+            # Windows are paired (forward i, backward i+1). The last window
+            # has no backward pair and uses exponential averaging.
+            samples = wF[:n] + wR + wF[n:]
+
+            def exp_back(s, c):
+                return (-sum(exp_average(x, w) for x, w in zip(s[n:2*n], c[n:2*n]))
+                        + exp_average(s[-1], c[-1]))
+
+            def bar_pairs(s, c):
+                return (sum(bar(s[i], s[n+i], c[i], c[n+i]) for i in range(n))
+                        + exp_average(s[-1], c[-1]))
+
+            def mbar_pairs(s, c):
+                total = exp_average(s[-1], c[-1])
+                for i in range(n):
+                    nF, nR = len(s[i]), len(s[n+i])
+                    u_kn = np.zeros((2, nF + nR))
+                    u_kn[1, :nF] = s[i]
+                    u_kn[0, nF:] = s[n+i]
+                    weights = None if c[i] is None else np.concatenate([c[i], c[n+i]], axis=-1)
+                    total = total + mbar(u_kn, [nF, nR], weights)[..., 1]
+                return total
+
+            estimate('EXP_back', exp_back, samples)
+            estimate('BAR', bar_pairs, samples)
+            estimate('MBAR', mbar_pairs, samples)
+
+    tiwins = sorted([w for w in windows if w['ti'] is not None], key=lambda w: w['lambda'])
+    if tiwins:
+        lambdas = [w['lambda'][0] for w in tiwins]
+        # dU/dlambda is the difference of the appearing and vanishing partitions.
+        dudl = [(w['ti'][:, [1, 3, 5]].sum(axis=1) - w['ti'][:, [7, 9, 11]].sum(axis=1)) / kT
+                for w in tiwins]
+        estimate('TI', lambda s, c: ti(lambdas, s, None if c[0] is None else c), dudl)
+    return results
+
+
+def _analyze(job):
+    fname, kwargs = job
+    return analyze(fname, **kwargs)
+
+
+def analyze_files(files, workers=None, **kwargs):
+    """Analyze many fepout files in a process pool, see analyze.
+
+    Returns
+    -------
+    results : list of dicts
+        results of analyze for each file, in order.
+    """
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(_analyze, [(f, kwargs) for f in files]))
+
+
+def combine(results):
+    """Return mean and error of the mean of each method over runs."""
+    out = {}
+    for method in results[0]:
+        if all(method in r for r in results):
+            dg = np.array([r[method][0] for r in results])
+            err = np.array([r[method][1] for r in results])
+            out[method] = (dg.mean(), np.sqrt((err ** 2).sum()) / len(err))
+    return out
+
+
+def print_results(name, results):
+    print('%s: %s' % (name, ', '.join('%s %.3f +/- %.3f' % (method, dg, err)
+                                       for method, (dg, err) in sorted(results.items()))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Estimate free energy changes (kcal/mol) '
+                                     'from NAMD fepout files.')
+    parser.add_argument('files',
+                        type=str,
+                        nargs='+',
+                        help='fepout files.')
+    parser.add_argument('--versus',
+                        type=str,
+                        nargs='+',
+                        default=None,
+                        help='fepout files of runs to compare against. Prints ddG = dG(files) - '
+                        'dG(versus).')
+    parser.add_argument('--temperature',
+                        type=float,
+                        default=TEMPERATURE,
+                        help='Temperature in K. Default %s.' % TEMPERATURE)
+    parser.add_argument('--nboot',
+                        type=int,
+                        default=100,
+                        help='Number of bootstrap replicates. Default 100.')
+    parser.add_argument('--block',
+                        type=int,
+                        default=200,
+                        help='Samples in a bootstrap block. Default 200.')
+    parser.add_argument('--workers',
+                        type=int,
+                        default=None,
+                        help='Number of processes. Default: number of cores.')
+
+    args = parser.parse_args()
+
+    files = args.files + (args.versus or [])
+    for fname in files:
+        if not os.path.exists(fname):
+            raise IOError('File %s not found.' % fname)
+
+    results = analyze_files(files, workers=args.workers, temperature=args.temperature,
+                            nboot=args.nboot, block=args.block)
+    for fname, result in zip(files, results):
+        print_results(fname, result)
+
+    dg = combine(results[:len(args.files)])
+    if len(args.files) > 1:
+        print_results('mean', dg)
+    if args.versus:
+        ref = combine(results[len(args.files):])
+        if len(args.versus) > 1:
+            print_results('mean versus', ref)
+        ddg = {method: (dg[method][0] - ref[method][0], np.hypot(dg[method][1], ref[method][1]))
+               for method in dg if method in ref}
+        print_results('ddG', ddg)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,432 @@
+"""Streaming histograms of measured series, e.g. Ramachandran plots and distance distributions.
+
+Histograms are accumulated chunk by chunk while streaming through
+measurement stores (.mstore), csv measurement files or trajectories, so the
+series of many runs never have to be in memory at once. Histograms of
+different runs are computed in parallel and merged by adding their counts.
+Angles are binned periodically, and free energy surfaces -kT ln P are
+computed from the merged counts.
+
+Usage: python histograms.py --rama phi35 psi36 --dist bond3 --out p1_s8.npz
+           measurements/2mx4_p1_s8 measurements/p1_s10.mstore
+       python histograms.py --rama phi2 psi2 --psf data/2mx4_p1_p2.psf --out p1_p2.npz
+           psfgen/namdrun_run.namdout.dcd
+"""
+
+import sys
+import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+from fepout import BOLTZMANN, TEMPERATURE
+
+if sys.version_info[0] < 3:
+    print('Needs python3. Load it using: module load python/3.4.3')
+    sys.exit(0)
+
+
+# Frames read at a time from a source.
+CHUNK = 100000
+
+
+class Histogram(object):
+    """Histogram with uniform bins in one or more dimensions, filled incrementally.
+
+    Parameters
+    ----------
+    ranges : list of (lo, hi) tuples
+        range of each dimension.
+    bins : list of ints
+        number of bins of each dimension.
+    periodic : list of bools
+        values of a periodic dimension are wrapped into its range, e.g.
+        angles into [-180, 180).
+
+    Attributes
+    ----------
+    counts : numpy.ndarray
+        (weighted) counts with shape bins.
+    outside : float
+        (weighted) number of values outside the range of a non periodic
+        dimension, or NaN.
+    """
+
+    def __init__(self, ranges, bins, periodic):
+        self.ranges = [(float(lo), float(hi)) for lo, hi in ranges]
+        self.bins = [int(b) for b in bins]
+        self.periodic = [bool(p) for p in periodic]
+        self.counts = np.zeros(self.bins)
+        self.outside = 0.0
+
+    @property
+    def edges(self):
+        """Bin edges of each dimension."""
+        return [np.linspace(lo, hi, n + 1) for (lo, hi), n in zip(self.ranges, self.bins)]
+
+    @property
+    def centers(self):
+        """Bin centers of each dimension."""
+        return [(e[1:] + e[:-1]) / 2 for e in self.edges]
+
+    def add(self, *values, weights=None):
+        """Add values (one array per dimension) to the histogram."""
+        if len(values) != len(self.bins):
+            raise ValueError('Expected %d arrays of values, got %d' % (len(self.bins), len(values)))
+        flat = np.zeros(len(values[0]), dtype=np.int64)
+        inside = np.ones(len(values[0]), dtype=bool)
+        for x, (lo, hi), n, periodic in zip(values, self.ranges, self.bins, self.periodic):
+            x = np.asarray(x, dtype=np.float64)
+            with np.errstate(invalid='ignore'):
+                # NaN values give an arbitrary index, they are not inside.
+                index = np.floor((x - lo) * (n / (hi - lo))).astype(np.int64)
+            if periodic:
+                index %= n
+            else:
+                # The upper edge belongs to the last bin, like np.histogram.
+                index[x == hi] = n - 1
+                inside &= (index >= 0) & (index < n)
+            inside &= np.isfinite(x)
+            flat = flat * n + np.where(inside, index, 0)
+        if weights is None:
+            self.outside += len(inside) - np.count_nonzero(inside)
+            counts = np.bincount(flat[inside], minlength=self.counts.size)
+        else:
+            weights = np.asarray(weights, dtype=np.float64)
+            self.outside += weights[~inside].sum()
+            counts = np.bincount(flat[inside], weights=weights[inside], minlength=self.counts.size)
+        self.counts += counts.reshape(self.bins)
+        return self
+
+    def merge(self, other):
+        """Add the counts of a histogram with the same bins."""
+        if other.ranges != self.ranges or other.bins != self.bins or other.periodic != self.periodic:
+            raise ValueError('Cannot merge histograms with different bins.')
+        self.counts += other.counts
+        self.outside += other.outside
+        return self
+
+    def __iadd__(self, other):
+        return self.merge(other)
+
+    @property
+    def total(self):
+        return self.counts.sum()
+
+    def probability(self):
+        """Return probability of each bin."""
+        total = self.total
+        return self.counts / total if total > 0 else np.zeros_like(self.counts)
+
+    def density(self):
+        """Return probability density, normalized over the range."""
+        volume = np.prod([(hi - lo) / n for (lo, hi), n in zip(self.ranges, self.bins)])
+        return self.probability() / volume
+
+    def free_energy(self, temperature=TEMPERATURE):
+        """Return free energy -kT ln P in kcal/mol, 0 at the most populated bin, inf in empty bins."""
+        p = self.probability()
+        with np.errstate(divide='ignore'):
+            g = -BOLTZMANN * temperature * np.log(p)
+        finite = np.isfinite(g)
+        if finite.any():
+            g -= g[finite].min()
+        return g
+
+    def to_dict(self, prefix=''):
+        """Return arrays describing the histogram, e.g. for np.savez."""
+        out = {prefix + 'counts': self.counts,
+               prefix + 'ranges': np.array(self.ranges),
+               prefix + 'periodic': np.array(self.periodic),
+               prefix + 'outside': np.array(self.outside)}
+        for i, e in enumerate(self.edges):
+            out[prefix + 'edges%d' % i] = e
+        return out
+
+    @classmethod
+    def from_dict(cls, data, prefix=''):
+        counts = np.asarray(data[prefix + 'counts'])
+        hist = cls(data[prefix + 'ranges'].tolist(), counts.shape, data[prefix + 'periodic'].tolist())
+        hist.counts = counts.astype(np.float64)
+        hist.outside = float(data[prefix + 'outside'])
+        return hist
+
+
+def ramachandran(bins=72):
+    """Return an empty periodic phi/psi histogram, bins x bins over [-180, 180)."""
+    return Histogram([(-180, 180), (-180, 180)], [bins, bins], [True, True])
+
+
+def distribution(lo=0, hi=30, bins=120):
+    """Return an empty (non periodic) distance histogram."""
+    return Histogram([(lo, hi)], [bins], [False])
+
+
+def iter_store(fname, names, chunk=CHUNK):
+    """Iterate over chunks of series in a measurement store.
+
+    Yields
+    ------
+    chunk : dict
+        numpy.ndarray of values of each name.
+    """
+    from store import MeasurementStore
+    ms = MeasurementStore(fname)
+    columns = {name: ms[name] for name in names}
+    for start in range(0, len(ms), chunk):
+        yield {name: np.asarray(values[start:start+chunk]) for name, values in columns.items()}
+
+
+def iter_csvs(prefix, names, chunk=CHUNK):
+    """Iterate over chunks of series in the <prefix>_*.csv files of a run.
+
+    Runs measured in parts are read part by part, without the repeated
+    first frame of later parts, like loader.read_series.
+
+    Yields
+    ------
+    chunk : dict
+        numpy.ndarray of values of each name.
+    """
+    import pandas as pd
+    from loader import find_series
+
+    series = find_series(prefix)
+    for name in names:
+        if name not in series:
+            raise ValueError('No series %s for prefix %s' % (name, prefix))
+    nparts = len(series[names[0]])
+    if any(len(series[name]) != nparts for name in names):
+        raise ValueError('Series %s of %s have different parts' % (', '.join(names), prefix))
+    for part in range(nparts):
+        readers = [pd.read_csv(series[name][part], sep='\t', header=None, names=['frame', name],
+                               chunksize=chunk, dtype={name: np.float32}) for name in names]
+        first = True
+        for frames in zip(*readers):
+            if any(len(f) != len(frames[0]) or not (f['frame'].values == frames[0]['frame'].values).all()
+                   for f in frames[1:]):
+                raise ValueError('Series %s of %s have different frames' % (', '.join(names), prefix))
+            skip = 1 if first and part > 0 else 0
+            first = False
+            yield {name: f[name].values[skip:] for name, f in zip(names, frames)}
+
+
+def iter_trajectory(dcd, psf, quantities, offset=0, chunk=1000):
+    """Iterate over chunks of quantities measured on the frames of a trajectory.
+
+    Parameters
+    ----------
+    dcd : string
+        DCD trajectory, or compressed trajectory (.trjz, see trajzip.py).
+    psf : string
+        psf file of the trajectory.
+    quantities : list of strings
+        quantities to measure, NAME=ATOMS, phiN or psiN, see measure.py.
+    offset : int, optional, default 0
+        added to every resid in quantities.
+    chunk : int, optional, default 1000
+        frames read at a time.
+
+    Yields
+    ------
+    chunk : dict
+        numpy.ndarray of values of each quantity, keyed as given.
+    """
+    from dcd import open_trajectory
+    from measure import parse_quantity, distances, dihedrals
+    from topology import load_topology
+
+    atoms = load_topology(psf).atoms
+    indices = [parse_quantity(atoms, q, offset)[1] for q in quantities]
+    # Only the atoms used in some quantity are read from the trajectory.
+    used = np.unique(np.concatenate(indices).astype(int))
+    remap = np.zeros(len(atoms), dtype=int)
+    remap[used] = np.arange(len(used))
+    indices = [remap[np.array([i], dtype=int)] for i in indices]
+    with open_trajectory(dcd) as traj:
+        if traj.n_atoms != len(atoms):
+            raise ValueError('Trajectory %s has %d atoms, psf %s has %d atoms.'
+                             % (dcd, traj.n_atoms, psf, len(atoms)))
+        for frames, xyz in traj.chunks(chunk, atoms=used):
+            out = {}
+            for q, i in zip(quantities, indices):
+                if i.shape[1] == 2:
+                    out[q] = distances(xyz, i)[:, 0]
+                else:
+                    out[q] = dihedrals(xyz, i)[:, 0]
+            yield out
+
+
+def is_trajectory(source):
+    """Return True for a DCD or compressed trajectory file."""
+    from trajzip import EXTENSION
+    return source.endswith('.dcd') or source.endswith(EXTENSION)
+
+
+def iter_source(source, names, chunk=CHUNK, psf=None, offset=0):
+    """Iterate over chunks of series of a store file, csv prefix or trajectory.
+
+    The series of a trajectory are measured on the fly, with names being
+    the quantities of measure.py, and need the psf file of the trajectory.
+    """
+    if is_trajectory(source):
+        if psf is None:
+            raise ValueError('Trajectory %s needs a psf file.' % source)
+        return iter_trajectory(source, psf, names, offset)
+    if source.endswith('.mstore'):
+        return iter_store(source, names, chunk)
+    return iter_csvs(source, names, chunk)
+
+
+def accumulate(source, rama=(), dist=(), bins=72, dist_range=(0, 30), dist_bins=120, chunk=CHUNK,
+               psf=None, offset=0):
+    """Return histograms of the series of one source.
+
+    Parameters
+    ----------
+    source : string
+        measurement store file, csv prefix or trajectory.
+    rama : list of (phi, psi) tuples
+        names of series pairs for Ramachandran histograms.
+    dist : list of strings
+        names of series for distance histograms.
+    psf : string, optional
+        psf file of a trajectory source.
+    offset : int, optional, default 0
+        added to every resid in the quantities measured on a trajectory.
+
+    Returns
+    -------
+    histograms : dict
+        Histogram for each 'phi:psi' pair and distance name.
+    """
+    histograms = {}
+    for phi, psi in rama:
+        histograms['%s:%s' % (phi, psi)] = ramachandran(bins)
+    for name in dist:
+        histograms[name] = distribution(dist_range[0], dist_range[1], dist_bins)
+    names = sorted(set([n for pair in rama for n in pair] + list(dist)))
+    for values in iter_source(source, names, chunk, psf, offset):
+        for phi, psi in rama:
+            histograms['%s:%s' % (phi, psi)].add(values[phi], values[psi])
+        for name in dist:
+            histograms[name].add(values[name])
+    return histograms
+
+
+def _accumulate(job):
+    source, kwargs = job
+    return accumulate(source, **kwargs)
+
+
+def accumulate_many(sources, workers=None, **kwargs):
+    """Return merged histograms of many sources, accumulated in a process pool.
+
+    See accumulate for the parameters.
+    """
+    merged = None
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for histograms in pool.map(_accumulate, [(s, kwargs) for s in sources]):
+            if merged is None:
+                merged = histograms
+            else:
+                for key, hist in histograms.items():
+                    merged[key].merge(hist)
+    return merged
+
+
+def save(fname, histograms, temperature=TEMPERATURE):
+    """Save histograms and their free energies to a .npz file."""
+    arrays = {}
+    for key, hist in histograms.items():
+        arrays.update(hist.to_dict(key + '/'))
+        arrays[key + '/free_energy'] = hist.free_energy(temperature)
+    np.savez(fname, **arrays)
+    return fname
+
+
+def load(fname):
+    """Load histograms saved with save."""
+    with np.load(fname) as data:
+        keys = sorted(set(k.rsplit('/', 1)[0] for k in data.files))
+        return {key: Histogram.from_dict(data, key + '/') for key in keys}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Accumulate Ramachandran and distance histograms '
+                                     'over many runs, and their free energy surfaces.')
+    parser.add_argument('sources',
+                        type=str,
+                        nargs='+',
+                        help='Measurement stores (.mstore), csv prefixes, e.g. measurements/2mx4_p1_s8, '
+                        'or trajectories (.dcd, .trjz) measured on the fly with --psf.')
+    parser.add_argument('--rama',
+                        type=str,
+                        nargs=2,
+                        action='append',
+                        default=[],
+                        metavar=('PHI', 'PSI'),
+                        help='Series of a Ramachandran histogram, or quantities of measure.py '
+                        'for trajectories, e.g. phi2 psi2. Can be repeated.')
+    parser.add_argument('--dist',
+                        type=str,
+                        nargs='+',
+                        default=[],
+                        help='Series of distance histograms.')
+    parser.add_argument('--psf',
+                        type=str,
+                        default=None,
+                        help='PSF file of trajectory sources.')
+    parser.add_argument('--offset',
+                        type=int,
+                        default=0,
+                        help='Add this to every resid in quantities of trajectories. Default 0.')
+    parser.add_argument('--bins',
+                        type=int,
+                        default=72,
+                        help='Bins in each dimension of Ramachandran histograms. Default 72 (5 degrees).')
+    parser.add_argument('--dist-range',
+                        type=float,
+                        nargs=2,
+                        default=[0, 30],
+                        help='Range of distance histograms in A. Default 0 30.')
+    parser.add_argument('--dist-bins',
+                        type=int,
+                        default=120,
+                        help='Bins of distance histograms. Default 120.')
+    parser.add_argument('--temperature',
+                        type=float,
+                        default=TEMPERATURE,
+                        help='Temperature in K for free energies. Default %s.' % TEMPERATURE)
+    parser.add_argument('--workers',
+                        type=int,
+                        default=None,
+                        help='Number of processes. Default: number of cores.')
+    parser.add_argument('--out',
+                        type=str,
+                        required=True,
+                        help='Output .npz file.')
+
+    args = parser.parse_args()
+
+    if not args.rama and not args.dist:
+        parser.error('Use --rama and/or --dist')
+    for source in args.sources:
+        if (source.endswith('.mstore') or is_trajectory(source)) and not os.path.exists(source):
+            raise IOError('File %s not found.' % source)
+    if any(is_trajectory(source) for source in args.sources):
+        if not args.psf:
+            parser.error('Trajectory sources need --psf')
+        if not os.path.exists(args.psf):
+            raise IOError('File %s not found.' % args.psf)
+
+    histograms = accumulate_many(args.sources, workers=args.workers, rama=args.rama, dist=args.dist,
+                                 bins=args.bins, dist_range=args.dist_range, dist_bins=args.dist_bins,
+                                 psf=args.psf, offset=args.offset)
+    for key, hist in sorted(histograms.items()):
+        print('%s: %d values, %d outside the range' % (key, hist.total, hist.outside))
+    print(save(args.out, histograms, args.temperature))
+
+
+if __name__ == "__main__":
+    main()
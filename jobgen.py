@@ -5,12 +5,14 @@ import sys
 import tempfile
 import glob
 import logging
+import re
+import random
+from concurrent.futures import ThreadPoolExecutor
 
 from subprocess import Popen, PIPE
 
 try:
     import argparse
-    import numpy as np
     from datetime import datetime
     import shutil
 except ImportError:
@@ -22,6 +24,9 @@ if sys.version_info[0] < 3:
     print('Needs python3. Load it using: module load python/3.4.3')
     sys.exit(0)
 
+import cell
+import perfdb
+
 
 #####################################################################
 # Template job from gevorg
@@ -53,6 +58,16 @@ if os.environ['HOME'].find('anthill') >= 0:
     if not os.path.exists('/home/ironfs/scratch'):
         raise IOError('Cannot access /home/ironfs/scratch')
 
+# Content addressed store of input files (pdb, psf, ...) shared by all runs.
+# Each file is stored once as INPUT_DIR/<sha1 of content>/<file name> and
+# hard linked (or symlinked) into the run directories.
+INPUT_DIR = os.path.join(OUTPUT_DIR, 'inputs')
+
+# Command run by the jobs before NAMD, to stagger the start of jobs. The
+# python running jobgen is used, as python3 is not on the PATH of the jobs
+# without module load.
+LAUNCH = '%s %s' % (sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'launch.py'))
+
 # 40 random ints generated using numpy.random.random_integers(1, 10000, 40)
 RANDOM_INTS = [6012, 7146, 1572, 5017, 4932, 3200, 8521, 1315, 2002, 7949, 9286,
                1666, 4724, 4960, 7995, 7073, 3350, 9843, 6611, 1471, 2476, 7387,
@@ -60,6 +75,31 @@ RANDOM_INTS = [6012, 7146, 1572, 5017, 4932, 3200, 8521, 1315, 2002, 7949, 9286,
                5639, 9757, 3595,  281, 5861, 4816, 8265]
 
 
+def random_seed(run):
+    """Return the random seed of a run.
+
+    Runs are numbered from 1 (-1 is a single run without a number). Runs
+    below len(RANDOM_INTS) keep their seed from RANDOM_INTS, higher runs get
+    a seed derived from the run number, so any number of runs is reproducible.
+    """
+    if run < len(RANDOM_INTS):
+        return RANDOM_INTS[run]
+    return random.Random(run).randint(1, 10000)
+
+
+def segment_seed(run, k):
+    """Return the random seed of segment k of a run split into segments.
+
+    The first segment uses the seed of the run, the others a seed derived from
+    it and k, so restarts do not replay the random numbers of the segment
+    before.
+    """
+    seed = random_seed(run)
+    if k == 0:
+        return seed
+    return random.Random('%d/%d' % (seed, k)).randint(1, 10000)
+
+
 def run_shell_command(cmd):
     """Run a shell command and return output and error log."""
     if isinstance(cmd, str):
@@ -73,22 +113,13 @@ def run_shell_command(cmd):
 
 
 def get_vols(pdb):
-    """Return a string with cell vectors for the solvated pdb file."""
-    script = 'getsize.sh'
-    if not os.path.exists(script):
-        raise ValueError('Script getsize.sh not found in current directory.')
-    cmd = 'sh %s %s' % (script, pdb)
-    out, err = run_shell_command(cmd)
-    # if out == '':
-    #     raise ValueError('Could not find cell vectors for the solvated pdb.')
-    lines = out.split('\n')
-    for i in range(3):
-    	cells = lines[i].split(' ')
-    	value = float(cells[i+1])
-    	cells[i+1] = str(value - 1.5)
-    	lines[i] = ' '.join(cells)
-    out = '\n'.join(lines)
-    return out
+    """Return a string with cell vectors for the solvated pdb file.
+
+    The cell is the bounding box of the atoms, shrunk by 1.5 A in each
+    direction, and centered at the geometric center of the atoms.
+    """
+    vectors, origin = cell.get_cell(pdb)
+    return cell.format_cell(vectors - 1.5, origin)
 
 
 def filebasename(fname):
@@ -97,6 +128,16 @@ def filebasename(fname):
     return '.'.join(fname.split('.')[:-1])
 
 
+# Maximum run time (h_rt) in seconds of the short and medium queues.
+QUEUE_LIMITS = {'short': 10800, 'medium': 86400}
+
+
+def format_time(seconds):
+    """Return time in seconds as a string in %H:%M:%S format."""
+    seconds = int(seconds)
+    return '%02d:%02d:%02d' % (seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+
 def queue(time):
     """Return queue for the given time in string. Time format: %H:%M:%S."""
     if time.find(':') == -1 or len(time.split(':')) != 3:
@@ -107,70 +148,111 @@ def queue(time):
     mn = int(fields[1])
     sec = int(fields[2])
     seconds = hr * 60 * 60 + mn * 60 + sec
-    if seconds <= 10800:  # 3 hour
+    if seconds <= QUEUE_LIMITS['short']:  # 3 hour
         return 'short'
-    elif seconds <= 86400:  # 24 hour
+    elif seconds <= QUEUE_LIMITS['medium']:  # 24 hour
         return 'medium'
     else:
         return 'long'
 
 
-def string_after(line, after, till=[',', ' ', '\n']):
-    """Return string in line `after` substring until one of the `till' substrings."""
-    i = line.find(after)
-    if i == -1:
-        return ''
-    value = ''
-    for c in line[i+len(after):]:
-        if c in till:
-            break
-        else:
-            value += c
-    return value
+# Seconds the resources of an advance reservation (AR) are cached for.
+AR_TTL = 300
 
+# Fields in the output of qrstat -ar.
+AR_ID = re.compile(r'^id\s+(\d+)', re.M)
+AR_END_TIME = re.compile(r'^end_time\s+(\S+ \S+)', re.M)
+AR_RESOURCES = re.compile(r'^resource_list\s+(.*)$', re.M)
+AR_SLOTS = re.compile(r'^granted_parallel_environment\s+\S+ slots (\d+)', re.M)
+AR_RESOURCE = re.compile(r'(\w+)=([^,\s]+)')
 
-def ar_resources(arid):
+# Parsed qrstat output by ARID, with the time it was queried.
+_ar_cache = {}
+
+
+def query_ars(arids):
+    """Query the resources of advance reservations with a single qrstat call.
+
+    The results are cached for AR_TTL seconds, see ar_resources.
+    """
+    arids = [int(arid) for arid in arids]
+    out, err = run_shell_command('qrstat -ar %s' % ','.join(str(arid) for arid in arids))
+    if not out:
+        raise ValueError('No AR found for %s' % ', '.join(str(arid) for arid in arids))
+
+    now = datetime.now().timestamp()
+    # Output has a block of lines for each AR, starting with its id.
+    starts = list(AR_ID.finditer(out))
+    if starts:
+        blocks = [(int(m.group(1)), out[m.start():n.start() if n else len(out)])
+                  for m, n in zip(starts, starts[1:] + [None])]
+    else:
+        blocks = [(arids[0], out)]
+    for arid, block in blocks:
+        ar = {'end_time': None, 'vf': None, 'h_rt': None, 'cores': None, 'hostname': ''}
+        m = AR_END_TIME.search(block)
+        if m:
+            ar['end_time'] = datetime.strptime(m.group(1), '%m/%d/%Y %H:%M:%S').timestamp()
+        for line in AR_RESOURCES.findall(block):
+            resources = dict(AR_RESOURCE.findall(line))
+            ar['hostname'] = resources.get('hostname', ar['hostname'])
+            ar['vf'] = resources.get('virtual_free', ar['vf'])
+            if 'h_rt' in resources:
+                ar['h_rt'] = int(resources['h_rt'])
+        m = AR_SLOTS.search(block)
+        if m:
+            ar['cores'] = int(m.group(1))
+        _ar_cache[arid] = (now, ar)
+
+
+def ar_resources(arid, share=1):
     """Return resources reserved in given arid.
 
+    qrstat is only run if the AR is not in the cache (see query_ars), so
+    creating many jobs in the same AR queries it once.
+
     Parameters
     ----------
     arid : int
         ARID
+    share : int, optional, default 1
+        number of jobs running at the same time in the AR. The cores of the
+        AR are split between them.
 
     Return
     ------
     vf : string
-        memory per thread
+        memory per thread, or None if the AR does not set it.
     h_rt : int
         time limit in seconds for the job
     cores : int
-        number of assigned cores for this AR.
+        number of assigned cores for this AR, divided by share.
     hostname : string
         hostname requested in AR. If none is requested, '' is returned.
     """
-    cmd = 'qrstat -ar %d' % arid
-    out, err = run_shell_command(cmd)
-    if not out:
+    arid = int(arid)
+    cached = _ar_cache.get(arid)
+    if cached is None or datetime.now().timestamp() - cached[0] > AR_TTL:
+        query_ars([arid])
+    if arid not in _ar_cache:
         raise ValueError('No AR found for %d' % arid)
-
-    for line in out.split('\n'):
-        if line.startswith('end_time'):
-            end_time = datetime.strptime(' '.join(line.split()[1:]), '%m/%d/%Y %H:%M:%S').timestamp()
-        elif line.startswith('resource_list'):
-            if line.find('hostname') > 0:
-                hostname = string_after(line, 'hostname=')
-            if line.find('virtual_free') > 0:
-                vf = string_after(line, 'virtual_free=')
-            if line.find('h_rt') > 0:
-                h_rt = int(string_after(line, 'h_rt='))
-        elif line.startswith('granted_parallel_environment'):
-            cores = int(string_after(line, 'smp slots '))
-
-    dt = end_time - datetime.now().timestamp() - 600
-    h_rt = min(h_rt, dt)
-    return vf, h_rt, cores, hostname
-
-
+    ar = _ar_cache[arid][1]
+    if ar['cores'] is None or ar['end_time'] is None:
+        raise ValueError('Cannot parse resources of AR %d' % arid)
+
+    dt = ar['end_time'] - datetime.now().timestamp() - 600
+    h_rt = int(dt if ar['h_rt'] is None else min(ar['h_rt'], dt))
+    cores = ar['cores'] // share
+    if cores < 1:
+        raise ValueError('AR %d has %d cores, not enough for %d jobs' % (arid, ar['cores'], share))
+    return ar['vf'], h_rt, cores, ar['hostname']
+
+
+# The NAMD executables of the jobs can be replaced by setting CHARMRUN (may
+# include options, e.g. "charmrun ++local") and NAMD2 in the environment of
+# the job, e.g. to run them on a workstation with localsched.py. An empty
+# CHARMRUN runs NAMD2 without a launcher, e.g. a multicore build. The jobs
+# exit with the status of NAMD.
 JOB_MULTI_CORE = """#!/bin/bash
 #$ -N %s
 #$ -cwd
@@ -183,17 +265,19 @@ JOB_MULTI_CORE = """#!/bin/bash
 #$ -q short,medium,long
 %s
 
-# start the job with a random delay (< 1 min), so that we do not start simulations submitted together at the exact same time.
-sleep %s
+# wait for our turn to start (see launch.py), so that we do not start simulations submitted together at the exact same time.
+%s wait
 
 echo "Got $NSLOTS slots on: " "`cat $PE_HOSTFILE`"
 
-/home/grigoryanlab/library/bin/charmrun +p$NSLOTS /home/grigoryanlab/library/bin/namd2 %s &> %s
+# the log starts with the host name, for the performance database (perfdb.py).
+{ echo "Info: HOSTNAME $(hostname)"; ${CHARMRUN-/home/grigoryanlab/library/bin/charmrun} ${NAMD2-/home/grigoryanlab/library/bin/namd2} +p$NSLOTS %s; } &> %s
+status=$?
 
 # create a sym link for this job's logfile in directory where it can be accessed by slackbot
 ln -s %s %s
 
-exit 0
+exit $status
 """
 
 JOB_SINGLE_CORE = """#!/bin/bash
@@ -207,19 +291,121 @@ JOB_SINGLE_CORE = """#!/bin/bash
 #$ -q short,medium,long
 %s
 
-# start the job with a random delay (< 1 min), so that we do not start all simulations at the exact same time.
-sleep %s
+# wait for our turn to start (see launch.py), so that we do not start all simulations at the exact same time.
+%s wait
 
-/home/anthill/cs86/students/bin/namd2-linux %s &> %s
+# the log starts with the host name, for the performance database (perfdb.py).
+{ echo "Info: HOSTNAME $(hostname)"; ${NAMD2-/home/anthill/cs86/students/bin/namd2-linux} %s; } &> %s
+status=$?
 
 # create a sym link for this job's logfile in directory where it can be accessed by slackbot
 ln -s %s %s
 
-exit 0
+exit $status
 """
 
+# Array job versions of the templates above. Each task reads its fep file and
+# log file from line $SGE_TASK_ID of a manifest file.
+JOB_ARRAY_MULTI_CORE = """#!/bin/bash
+#$ -N %s
+#$ -cwd
+#$ -j y
+#$ -S /bin/bash
+#$ -pe smp %s
+#$ -l vf=%s
+#$ -l %s
+#$ -l h_rt=%s
+#$ -q short,medium,long
+#$ -t 1-%d
+%s%s
+
+read RUNDIR FEP JOBLOGFILE <<< "$(sed -n "${SGE_TASK_ID}p" %s)"
+
+# wait for our turn to start (see launch.py), so that we do not start all tasks at the exact same time.
+%s wait
+
+echo "Got $NSLOTS slots on: " "`cat $PE_HOSTFILE`"
+
+# the log starts with the host name, for the performance database (perfdb.py).
+{ echo "Info: HOSTNAME $(hostname)"; ${CHARMRUN-/home/grigoryanlab/library/bin/charmrun} ${NAMD2-/home/grigoryanlab/library/bin/namd2} +p$NSLOTS $FEP; } &> $JOBLOGFILE
+status=$?
 
-def create_job(name, fep, joblogfile, time='24:00:00', cores=16, arid=None, mem='2G', hostname=None):
+# create a sym link for this task's logfile in directory where it can be accessed by slackbot
+ln -s $JOBLOGFILE %s.$SGE_TASK_ID.log
+
+exit $status
+"""
+
+JOB_ARRAY_SINGLE_CORE = """#!/bin/bash
+#$ -N %s
+#$ -cwd
+#$ -j y
+#$ -S /bin/bash
+#$ -l vf=%s
+#$ -l %s
+#$ -l h_rt=%s
+#$ -q short,medium,long
+#$ -t 1-%d
+%s%s
+
+read RUNDIR FEP JOBLOGFILE <<< "$(sed -n "${SGE_TASK_ID}p" %s)"
+
+# wait for our turn to start (see launch.py), so that we do not start all tasks at the exact same time.
+%s wait
+
+# the log starts with the host name, for the performance database (perfdb.py).
+{ echo "Info: HOSTNAME $(hostname)"; ${NAMD2-/home/anthill/cs86/students/bin/namd2-linux} $FEP; } &> $JOBLOGFILE
+status=$?
+
+# create a sym link for this task's logfile in directory where it can be accessed by slackbot
+ln -s $JOBLOGFILE %s.$SGE_TASK_ID.log
+
+exit $status
+"""
+
+# Array job running a (single core) shell command for each task, e.g. to
+# gather results. The command can use $RUNDIR, $FEP and $JOBLOGFILE.
+JOB_ARRAY_COMMAND = """#!/bin/bash
+#$ -N %s
+#$ -cwd
+#$ -j y
+#$ -S /bin/bash
+#$ -l vf=%s
+#$ -l %s
+#$ -l h_rt=%s
+#$ -q short,medium,long
+#$ -t 1-%d
+%s%s
+
+read RUNDIR FEP JOBLOGFILE <<< "$(sed -n "${SGE_TASK_ID}p" %s)"
+
+%s
+
+exit $?
+"""
+
+
+def job_resources(time, cores, arid, mem, hostname, share=1):
+    """Return mem, time, cores, hostname resource and ar lines for a job.
+
+    If an ARID is given, the resources are those of the advanced reservation,
+    with its cores split between `share` jobs.
+    """
+    if arid:
+        ar = '#$ -ar %d' % arid
+        vf, time, cores, hostname = ar_resources(arid, share)
+        mem = vf or mem
+    else:
+        ar = ''
+
+    if hostname:
+        hostname = 'hostname=%s' % hostname
+    else:
+        hostname = 'ironfs'
+    return mem, time, cores, hostname, ar
+
+
+def create_job(name, fep, joblogfile, time='24:00:00', cores=16, arid=None, mem='2G', hostname=None, share=1):
     """Create a job (.sh) to submit to anthill and save it in ~/jobs directory.
 
     Parameters
@@ -242,6 +428,8 @@ def create_job(name, fep, joblogfile, time='24:00:00', cores=16, arid=None, mem=
         memory to use per thread
     hostname : string, optional, default None
         hostname to use. If None, '-l ironfs' is used instead
+    share : int, optional, default 1
+        number of jobs sharing the cores of the AR at the same time.
 
     Return
     ------
@@ -262,30 +450,155 @@ def create_job(name, fep, joblogfile, time='24:00:00', cores=16, arid=None, mem=
     # log file, saved in BASE_DIR, where slackbot can access it.
     logfile = os.path.join(dir, name + '.log')
 
-    # start the job with a random delay (< 1 min)
-    randtime = np.random.random_integers(1, 60)
-
-    if arid:
-        ar = '#$ -ar %d' % arid
-        mem, time, cores, hostname = ar_resources(arid)
-    else:
-        ar = ''
-
-    if hostname:
-        hostname = 'hostname=%s' % hostname
-    else:
-        hostname = 'ironfs'
+    mem, time, cores, hostname, ar = job_resources(time, cores, arid, mem, hostname, share)
 
     if cores > 1:
-        f.write(JOB_MULTI_CORE % (name, cores, mem, hostname, time, ar, randtime, fep, joblogfile, joblogfile, logfile))
+        f.write(JOB_MULTI_CORE % (name, cores, mem, hostname, time, ar, LAUNCH, fep, joblogfile, joblogfile, logfile))
     elif cores == 1:
-        f.write(JOB_SINGLE_CORE % (name, mem, hostname, time, ar, randtime, fep, joblogfile, joblogfile, logfile))
+        f.write(JOB_SINGLE_CORE % (name, mem, hostname, time, ar, LAUNCH, fep, joblogfile, joblogfile, logfile))
     else:
         raise ValueError('Invalid cores value: %f' % cores)
     return f.name
 
 
-def create_fep(templatefep, dir, pdb, randomseed):
+def create_array_job(name, tasks, time='24:00:00', cores=16, arid=None, mem='2G', hostname=None, hold=None,
+                     hold_tasks=True, command=None, share=1):
+    """Create an array job (.sh) running one task per run and save it in ~/jobs directory.
+
+    A manifest file, with the run directory, fep file and log file of each
+    task on a line, is saved next to the job script.
+
+    Parameters
+    ----------
+    name : string
+        Job name prefix
+    tasks : list of tuples
+        (rundir, fep, joblogfile) for each task.
+    time, cores, arid, mem, hostname, share : optional
+        resources for each task, see create_job.
+    hold : string, optional, default None
+        name of an array job with as many tasks. Each task of this job only
+        starts after the same task of that job has finished (-hold_jid_ad).
+    hold_tasks : bool, optional, default True
+        if False, wait for all tasks of the `hold` job instead (-hold_jid).
+        The two jobs can then have a different number of tasks.
+    command : string, optional, default None
+        run this single core shell command in each task instead of NAMD.
+
+    Return
+    ------
+    out : string
+        Path of the created job script.
+    """
+    dir = "%s/jobs" % BASE_DIR
+    if not os.path.exists(dir):
+        os.makedirs(dir)
+
+    f = tempfile.NamedTemporaryFile(dir=dir, prefix=name+'-', suffix='.sh', mode='w', delete=False)
+    name = filebasename(f.name)
+
+    # log file prefix, saved in BASE_DIR, where slackbot can access it.
+    logfile = os.path.join(dir, name)
+
+    manifest = os.path.join(dir, name + '.manifest')
+    with open(manifest, 'w') as fp:
+        for task in tasks:
+            fp.write('%s\n' % '\t'.join(task))
+
+    mem, time, cores, hostname, ar = job_resources(time, cores, arid, mem, hostname, share)
+    if hold:
+        hold = '\n#$ -%s %s' % ('hold_jid_ad' if hold_tasks else 'hold_jid', hold)
+    else:
+        hold = ''
+
+    with f:
+        if command:
+            f.write(JOB_ARRAY_COMMAND % (name, mem, hostname, time, len(tasks), ar, hold, manifest, command))
+        elif cores > 1:
+            f.write(JOB_ARRAY_MULTI_CORE % (name, cores, mem, hostname, time, len(tasks), ar, hold, manifest, LAUNCH, logfile))
+        elif cores == 1:
+            f.write(JOB_ARRAY_SINGLE_CORE % (name, mem, hostname, time, len(tasks), ar, hold, manifest, LAUNCH, logfile))
+        else:
+            raise ValueError('Invalid cores value: %f' % cores)
+    return f.name
+
+
+def add_idws(lines):
+    """Return fep lines with backward energies written in each lambda window.
+
+    An alchLambdaIDWS line, set to the previous lambda (2 alchLambda -
+    alchLambda2), is added after the alchLambda and alchLambda2 lines in the
+    for loop over windows. NAMD leaves it off for the negative value of the
+    first window. fepout.py uses the backward energies for BAR and MBAR.
+    alchLambdaIDWS needs NAMD 2.12 or newer.
+    """
+    out = []
+    loop = False
+    values = {}
+    added = False
+    for line in lines:
+        fields = line.split(None, 1)
+        cmd = fields[0] if fields else ''
+        if cmd == 'for':
+            loop = True
+            values = {}
+        elif cmd == '}':
+            loop = False
+        out.append(line)
+        if loop and cmd in ['alchLambda', 'alchLambda2']:
+            values[cmd] = fields[1].split(';')[0].strip()
+            if len(values) == 2:
+                out.append('  alchLambdaIDWS [expr 2*%s - %s]; # backward energies for BAR\n'
+                           % (values['alchLambda'], values['alchLambda2']))
+                values = {}
+                added = True
+    if not added:
+        raise ValueError('No alchLambda and alchLambda2 lines in a for loop, cannot add alchLambdaIDWS.')
+    return out
+
+
+def render_fep(templatefep, pdb, idws=False):
+    """Return lines of the fep file for a pdb, before run specific settings are set.
+
+    This replaces the pdb, psf, alch pdb and fixed pdb file names and the
+    cell vectors in the template, which are the same for all runs of a pdb.
+    With idws, backward energies are also written, see add_idws.
+    See create_fep.
+    """
+    cellvectors = get_vols(pdb)
+    basename = filebasename(pdb)
+    lines = []
+    with open(templatefep, 'r') as fin:
+        for line in fin:
+            if line.startswith('set psffile'):
+                line = 'set psffile %s.psf;\n' % basename
+            elif line.startswith('set pdbfile'):
+                line = 'set pdbfile %s.pdb;\n' % basename
+            elif line.startswith('###CELLVECTORS'):
+                line = '%s\n' % cellvectors
+            elif line.startswith('set alchpdbfile'):
+                line = 'set alchpdbfile %s_alch.pdb;\n' % basename
+            elif line.startswith('set fixedpdbfile'):
+                line = 'set fixedpdbfile %s_fixed.pdb;\n' % basename
+            lines.append(line)
+    if idws:
+        lines = add_idws(lines)
+    return lines
+
+
+def specialise_fep(lines, dir, randomseed):
+    """Return fep file content for a run from lines rendered by render_fep."""
+    out = []
+    for line in lines:
+        if line.startswith('set outdir'):
+            line = 'set outdir %s;\n' % dir
+        elif line.startswith('set randomseed'):
+            line = 'set randomseed %d;\n' % randomseed
+        out.append(line)
+    return ''.join(out)
+
+
+def create_fep(templatefep, dir, pdb, randomseed, rendered=None):
     """Return the name of new fep created in given directory.
 
     Create a new fep file from template file for simulation.
@@ -297,7 +610,7 @@ def create_fep(templatefep, dir, pdb, randomseed):
     - random seed
     - pdb file name
     - psf file name
-    - cell vectors : the are determined using the getsize.sh script.
+    - cell vectors : they are determined using the cell module.
 
     Parameters
     ---------
@@ -310,6 +623,9 @@ def create_fep(templatefep, dir, pdb, randomseed):
         pdb file path.
     randomseed : int
         use this random seed in the fep tcl.
+    rendered : list of strings, optional, default None
+        lines returned by render_fep for this template and pdb. Pass them
+        when creating many runs, so the template is only rendered once.
 
     Returns
     -------
@@ -320,29 +636,492 @@ def create_fep(templatefep, dir, pdb, randomseed):
 
     # Create a new fep file for this run, replacing the output directory
     # and random seed variables in the template fep file.
-    cellvectors = get_vols(pdb)
-    basename = filebasename(pdb)
-    with open(templatefep, 'r') as fin:
-        with open(fep, 'w') as fout:
-            for line in fin:
-                if line.startswith('set outdir'):
-                    line = 'set outdir %s;\n' % dir
-                elif line.startswith('set randomseed'):
-                    line = 'set randomseed %d;\n' % randomseed
-                elif line.startswith('set psffile'):
-                    line = 'set psffile %s.psf;\n' % basename
-                elif line.startswith('set pdbfile'):
-                    line = 'set pdbfile %s.pdb;\n' % basename
-                elif line.startswith('###CELLVECTORS'):
-                    line = '%s\n' % cellvectors
-                elif line.startswith('set alchpdbfile'):
-                	line = 'set alchpdbfile %s_alch.pdb;\n' % basename
-                elif line.startswith('set fixedpdbfile'):
-                	line = 'set fixedpdbfile %s_fixed.pdb;\n' % basename
-                fout.write(line)
+    if rendered is None:
+        rendered = render_fep(templatefep, pdb)
+    with open(fep, 'w') as fout:
+        fout.write(specialise_fep(rendered, dir, randomseed))
     return fep
 
 
+def stage_input(fname, store=None):
+    """Return path of a copy of fname in the content addressed input store.
+
+    The file is copied into the store only if the store does not have a file
+    with the same name and content yet.
+    """
+    store = store or INPUT_DIR
+    staged = os.path.join(store, cell.file_hash(fname), os.path.basename(fname))
+    if not os.path.exists(staged):
+        os.makedirs(os.path.dirname(staged), exist_ok=True)
+        tmp = '%s.%d.tmp' % (staged, os.getpid())
+        shutil.copy(fname, tmp)
+        os.replace(tmp, staged)
+    return staged
+
+
+def link_input(staged, rundir):
+    """Link a staged input file into a run directory.
+
+    A hard link is used if possible, otherwise a symbolic link.
+    """
+    newfname = os.path.join(rundir, os.path.basename(staged))
+    try:
+        os.link(staged, newfname)
+    except OSError:
+        os.symlink(staged, newfname)
+    return newfname
+
+
+def setup_runs(templatefep, pdb, inputs, runs, suffix, threads=None, idws=False):
+    """Create run directories with inputs and fep files for many runs.
+
+    Input files are staged once in the input store and linked into each run
+    directory, the template fep is rendered once, and run directories are
+    created in parallel.
+
+    Parameters
+    ----------
+    templatefep : string
+        path of template fep to use for the simulation.
+    pdb : string
+        pdb file path.
+    inputs : list of strings
+        input files (pdb, psf, ...) needed in each run directory.
+    runs : list of ints
+        run numbers.
+    suffix : string
+        suffix to use in run dirs.
+    threads : int, optional, default None
+        number of threads creating run directories.
+    idws : bool, optional, default False
+        also write backward energies, see add_idws.
+
+    Returns
+    -------
+    rendered : list of strings
+        lines of the fep file returned by render_fep.
+    tasks : list of tuples
+        (rundir, fep, joblogfile) for each run.
+    """
+    staged = [stage_input(fname) for fname in inputs]
+    rendered = render_fep(templatefep, pdb, idws)
+
+    def setup(run):
+        rundir = get_rundir(pdb, run, suffix)
+        for fname in staged:
+            link_input(fname, rundir)
+        fep = create_fep(templatefep, rundir, pdb, random_seed(run), rendered=rendered)
+        return rundir, fep, os.path.join(rundir, 'namd.stdout')
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        tasks = list(pool.map(setup, runs))
+    return rendered, tasks
+
+
+def copy_jobs(jobs, rundirs, threads=None):
+    """Copy job scripts and their manifests to run dirs, so we know which script we used for each simulation."""
+    def copy(rundir):
+        for job in jobs:
+            for fname in [job, job[:-3] + '.manifest']:
+                shutil.copy(fname, os.path.join(rundir, os.path.basename(fname)))
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(copy, rundirs))
+
+
+def create_batch(templatefep, pdb, inputs, runs, suffix, threads=None, idws=False, **resources):
+    """Create run directories for many runs and a single array job for them.
+
+    See setup_runs for the parameters.
+
+    Parameters
+    ----------
+    resources : optional
+        time, cores, arid, mem, hostname for each task, see create_job.
+
+    Returns
+    -------
+    job : string
+        Path of the created array job script.
+    """
+    rendered, tasks = setup_runs(templatefep, pdb, inputs, runs, suffix, threads, idws)
+
+    # Job name, to show in qstat and on slack.
+    jobname = 'dis_%s_run%d-%d%s' % (filebasename(pdb), runs[0], runs[-1], suffix)
+    job = create_array_job(jobname, tasks, **resources)
+    copy_jobs([job], [task[0] for task in tasks], threads)
+    return job
+
+
+def _steps(line):
+    """Return the number in a 'command number; # comment' line."""
+    return int(line.split()[1].rstrip(';'))
+
+
+def parse_program(lines):
+    """Split rendered fep lines into configuration and the commands that run the simulation.
+
+    The program starts at the first minimize, run or for command. It can
+    have minimize and run commands, and a `for` loop over lambda windows with
+    one run command in its body, like in fep.tcl.
+
+    Returns
+    -------
+    program : dict
+        'config': configuration lines before the program.
+        'minimize': minimize lines.
+        'header': other lines in the program outside the loop (e.g. set N 10).
+        'body': lines in the loop body, without the run command.
+        'var': loop variable name.
+        'pieces': list of (window, steps), one for each run command, in
+            order. window is the value of the loop variable, or None for
+            run commands outside the loop.
+    """
+    program = {'config': [], 'minimize': [], 'header': [], 'body': [], 'var': None, 'pieces': []}
+    variables = {}
+    loop = None
+    started = False
+    for line in lines:
+        cmd = line.strip()
+        fields = cmd.split()
+        if len(fields) >= 3 and fields[0] == 'set':
+            variables[fields[1]] = fields[2].rstrip(';')
+        if not started and not cmd.startswith(('minimize', 'run', 'for ')):
+            program['config'].append(line)
+            continue
+        started = True
+        if loop is not None:
+            if cmd == '}':
+                program['pieces'] += [(i, loop['steps']) for i in range(loop['start'], loop['stop'])]
+                loop = None
+            elif cmd.startswith('run'):
+                loop['steps'] = _steps(cmd)
+            else:
+                program['body'].append(line)
+        elif cmd.startswith('minimize'):
+            program['minimize'].append(line)
+        elif cmd.startswith('run'):
+            program['pieces'].append((None, _steps(cmd)))
+        elif cmd.startswith('for '):
+            m = re.match(r'for \{set (\w+) (\d+)\} \{\$\w+ < \$?(\w+)\}', cmd)
+            if not m:
+                raise ValueError('Cannot parse loop: %s' % cmd)
+            stop = m.group(3)
+            stop = int(variables[stop]) if stop in variables else int(stop)
+            program['var'] = m.group(1)
+            loop = {'start': int(m.group(2)), 'stop': stop, 'steps': 0}
+        else:
+            program['header'].append(line)
+    return program
+
+
+def split_segments(pieces, capacity):
+    """Split run pieces into segments of at most `capacity` steps.
+
+    Lambda windows are kept whole in a segment when they fit in one, runs
+    outside windows are split to fill segments. A window longer than
+    `capacity` is split too: each piece is a new NAMD run at the same lambda
+    that repeats alchEquilSteps, see gather_fepout.
+
+    Returns
+    -------
+    segments : list of lists
+        (window, steps) pieces of each segment.
+    """
+    segments = [[]]
+    used = 0
+    for window, steps in pieces:
+        if window is not None and used + steps > capacity and steps <= capacity:
+            # Start the window in a new segment instead of splitting it.
+            segments.append([])
+            used = 0
+        while steps > 0:
+            if used == capacity:
+                segments.append([])
+                used = 0
+            n = min(steps, capacity - used)
+            segments[-1].append((window, n))
+            used += n
+            steps -= n
+    return [segment for segment in segments if segment]
+
+
+def render_segment(program, segment, tag, restart=None, firststep=0):
+    """Return fep file content for one segment of a run.
+
+    Without `restart`, the segment starts from the pdb and minimizes it, like
+    the full fep. Otherwise it restarts from the .coor, .vel and .xsc files
+    that NAMD writes at the end of a previous segment. Output files of the
+    segment have .<tag> in their name.
+
+    Parameters
+    ----------
+    program : dict
+        fep program returned by parse_program.
+    segment : list of tuples
+        (window, steps) run pieces in this segment.
+    tag : string
+        tag added to output file names, e.g. seg1.
+    restart : string, optional, default None
+        output name (outname.tag) of the segment to restart from.
+    firststep : int, optional, default 0
+        step number at the end of the segment to restart from.
+    """
+    outname = _outname(program)
+    out = []
+    for line in program['config']:
+        cmd = line.strip()
+        if cmd.startswith('set outname'):
+            line = 'set outname %s.%s;\n' % (outname, tag)
+        elif cmd.startswith('alchOutfile'):
+            base, ext = os.path.splitext(cmd.split()[1])
+            line = 'alchOutfile         %s.%s%s\n' % (base, tag, ext)
+        elif restart and cmd.startswith(('temperature', 'cellBasisVector', 'cellOrigin')):
+            # Velocities, cell and step come from the restart files.
+            continue
+        out.append(line)
+        if restart and cmd.startswith('coordinates'):
+            out.append('bincoordinates %s.coor\n' % restart)
+            out.append('binvelocities %s.vel\n' % restart)
+            out.append('extendedSystem %s.xsc\n' % restart)
+            out.append('firsttimestep %d\n' % firststep)
+    if not restart:
+        out += program['minimize']
+    out += program['header']
+    for window, steps in segment:
+        if window is not None:
+            out.append('set %s %d\n' % (program['var'], window))
+            out += program['body']
+        out.append('run %d\n' % steps)
+    return ''.join(out)
+
+
+def _outname(program):
+    for line in program['config']:
+        if line.strip().startswith('set outname'):
+            return line.split()[2].rstrip(';')
+    raise ValueError('No "set outname" in fep file.')
+
+
+def timestep(lines):
+    """Return the timestep in fs set in fep lines."""
+    for line in lines:
+        if line.strip().startswith('timestep'):
+            return float(line.split()[1].rstrip(';'))
+    return 1.0
+
+
+def auto_resources(rendered, psf, windows=False, hostname=None, cores=None):
+    """Return resources for a run predicted from the performance database.
+
+    Parameters
+    ----------
+    rendered : list of strings
+        lines returned by render_fep.
+    psf : string
+        psf file of the system.
+    windows : bool, optional, default False
+        size the job for the longest lambda window instead of the whole run
+        (--fep-windows).
+    hostname : string, optional
+        host the job will run on.
+    cores : int, optional
+        requested cores, kept if the recorded runs all used the same core
+        count.
+
+    Returns
+    -------
+    choice : dict or None
+        seconds, cores and ns_per_day, see perfdb.choose_resources. None if
+        there are not enough recorded runs.
+    """
+    program = parse_program(rendered)
+    if windows:
+        steps = max(s for window, s in program['pieces'] if window is not None)
+    else:
+        steps = sum(_steps(line.strip()) for line in program['minimize'])
+        steps += sum(s for window, s in program['pieces'])
+    ns = steps * timestep(rendered) * 1e-6
+    db = perfdb.connect()
+    return perfdb.choose_resources(db, perfdb.psf_atoms(psf), ns, hostname, QUEUE_LIMITS, cores=cores)
+
+
+def create_chain(templatefep, pdb, inputs, runs, suffix, ns_per_day, segment_queue='medium',
+                 threads=None, idws=False, **resources):
+    """Create run directories and a chain of array jobs running them in segments.
+
+    Each run is split into restartable segments short enough to finish in
+    `segment_queue` at the given speed. Segment k of all runs is an array job
+    whose tasks wait for the same task of segment k-1 (-hold_jid_ad). For
+    FEP runs, a last array job concatenates the fepout files of the segments
+    of each run (see gather_fepout).
+
+    Parameters
+    ----------
+    ns_per_day : float
+        expected simulation speed, used to size the segments.
+    segment_queue : string, optional, default medium
+        queue the segments should fit in, short or medium.
+    See create_batch for the other parameters.
+
+    Returns
+    -------
+    jobs : list of strings
+        Paths of the array job scripts, in the order they must be submitted.
+    """
+    rendered, tasks = setup_runs(templatefep, pdb, inputs, runs, suffix, threads, idws)
+    program = parse_program(rendered)
+
+    # Leave 10% of the queue limit as margin for startup and speed variations.
+    seconds = QUEUE_LIMITS[segment_queue] * 0.9
+    capacity = int(ns_per_day * 1e6 / timestep(rendered) * seconds / 86400)
+    if capacity <= 0:
+        raise ValueError('Simulation speed %s ns/day is too low.' % ns_per_day)
+    segments = split_segments(program['pieces'], capacity)
+    windows = [piece for piece in program['pieces'] if piece[0] is not None]
+    too_long = [window for window, steps in windows if steps > capacity]
+    if too_long:
+        print('Warning: lambda windows %s are longer than a segment (%d steps at %s ns/day) and are '
+              'split over segments. Each piece repeats alchEquilSteps; use a longer --segment-queue '
+              'or --fep-windows to avoid it.' % (', '.join(str(w) for w in too_long), capacity, ns_per_day),
+              file=sys.stderr)
+
+    minimize = sum(_steps(line.strip()) for line in program['minimize'])
+    firststeps = [minimize]
+    for segment in segments[:-1]:
+        firststeps.append(firststeps[-1] + sum(steps for window, steps in segment))
+
+    def write_segments(run, task):
+        rundir = task[0]
+        files = []
+        for k, segment in enumerate(segments):
+            fep = os.path.join(rundir, 'fep_seg%d.tcl' % k)
+            restart = '%s.seg%d' % (_outname(program), k - 1) if k else None
+            content = render_segment(program, segment, 'seg%d' % k, restart, firststeps[k])
+            with open(fep, 'w') as fout:
+                fout.write(specialise_fep(content.splitlines(True), rundir, segment_seed(run, k)))
+            files.append((rundir, fep, os.path.join(rundir, 'namd.seg%d.stdout' % k)))
+        return files
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        files = list(pool.map(write_segments, runs, tasks))
+
+    resources['time'] = format_time(seconds / 0.9)
+    jobs = []
+    hold = None
+    for k in range(len(segments)):
+        jobname = 'dis_%s_run%d-%d%s_seg%d' % (filebasename(pdb), runs[0], runs[-1], suffix, k)
+        job = create_array_job(jobname, [f[k] for f in files], hold=hold, **resources)
+        hold = filebasename(job)
+        jobs.append(job)
+    if windows:
+        name = 'dis_%s_run%d-%d%s_gather' % (filebasename(pdb), runs[0], runs[-1], suffix)
+        command = '%s %s --gather $RUNDIR' % (sys.executable, os.path.abspath(__file__))
+        jobs.append(create_array_job(name, tasks, time='00:30:00', mem=resources.get('mem', '2G'),
+                                     hold=hold, command=command))
+    copy_jobs(jobs, [task[0] for task in tasks], threads)
+    return jobs
+
+
+def create_windows(templatefep, pdb, inputs, runs, suffix, equil_steps=50000, threads=None, idws=False,
+                   **resources):
+    """Create run directories and jobs running the lambda windows of each run in parallel.
+
+    Each run is split into an equilibration segment (minimization and
+    `equil_steps` steps at the initial lambda) and one segment per lambda
+    window that restarts from the equilibrated structure. Three array jobs
+    are created: the equilibration of all runs, all windows of all runs, and
+    a gather step that concatenates the per-window fepout files of each run
+    in lambda order (see gather_fepout).
+
+    Parameters
+    ----------
+    equil_steps : int, optional, default 50000
+        steps of dynamics after minimization, before the windows start.
+    See create_batch for the other parameters.
+
+    Returns
+    -------
+    jobs : list of strings
+        Paths of the array job scripts, in the order they must be submitted.
+    """
+    rendered, tasks = setup_runs(templatefep, pdb, inputs, runs, suffix, threads, idws)
+    program = parse_program(rendered)
+    windows = [piece for piece in program['pieces'] if piece[0] is not None]
+    if not windows:
+        raise ValueError('No lambda windows (for loop) found in %s' % templatefep)
+    outname = _outname(program)
+    minimize = sum(_steps(line.strip()) for line in program['minimize'])
+
+    def write_windows(run, task):
+        rundir = task[0]
+        files = []
+        segments = [('equil', None, 0, [(None, equil_steps)])]
+        segments += [('win%d' % window, '%s.equil' % outname, minimize + equil_steps, [(window, steps)])
+                     for window, steps in windows]
+        for k, (tag, restart, firststep, segment) in enumerate(segments):
+            fep = os.path.join(rundir, 'fep_%s.tcl' % tag)
+            content = render_segment(program, segment, tag, restart, firststep)
+            with open(fep, 'w') as fout:
+                fout.write(specialise_fep(content.splitlines(True), rundir, segment_seed(run, k)))
+            files.append((rundir, fep, os.path.join(rundir, 'namd.%s.stdout' % tag)))
+        return files
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        files = list(pool.map(write_windows, runs, tasks))
+
+    name = 'dis_%s_run%d-%d%s' % (filebasename(pdb), runs[0], runs[-1], suffix)
+    equil = create_array_job(name + '_equil', [f[0] for f in files], **resources)
+    wins = create_array_job(name + '_win', [t for f in files for t in f[1:]],
+                            hold=filebasename(equil), hold_tasks=False, **resources)
+    command = '%s %s --gather $RUNDIR' % (sys.executable, os.path.abspath(__file__))
+    gather = create_array_job(name + '_gather', tasks, time='00:30:00', mem=resources.get('mem', '2G'),
+                              hold=filebasename(wins), hold_tasks=False, command=command)
+    jobs = [equil, wins, gather]
+    copy_jobs(jobs, [task[0] for task in tasks], threads)
+    return jobs
+
+
+def gather_fepout(rundir):
+    """Concatenate the fepout files of the lambda windows or segments of a run, in order.
+
+    The pieces are the fep_win<i>.tcl files in rundir created by
+    create_windows, in lambda order, or else the fep_seg<k>.tcl files created
+    by create_chain, in segment order. A window split over segments appears
+    once in each of them, fepout.read_fepout merges it back. The output is
+    written to the alchOutfile of the run's fep.tcl, e.g. namdrun.fepout.
+
+    Returns
+    -------
+    out : string
+        path of the concatenated fepout file.
+    """
+    with open(os.path.join(rundir, 'fep.tcl'), 'r') as fp:
+        alchfiles = [line.split()[1] for line in fp if line.strip().startswith('alchOutfile')]
+    if not alchfiles:
+        raise ValueError('No alchOutfile in %s' % os.path.join(rundir, 'fep.tcl'))
+    base, ext = os.path.splitext(alchfiles[0])
+
+    for tag in ['win', 'seg']:
+        pieces = [int(filebasename(fep)[len('fep_' + tag):])
+                  for fep in glob.glob(os.path.join(rundir, 'fep_%s*.tcl' % tag))]
+        if pieces:
+            break
+    else:
+        raise ValueError('No lambda windows or segments found in %s' % rundir)
+
+    out = os.path.join(rundir, alchfiles[0])
+    with open(out + '.tmp', 'wb') as fout:
+        for piece in sorted(pieces):
+            fepout = os.path.join(rundir, '%s.%s%d%s' % (base, tag, piece, ext))
+            if not os.path.exists(fepout):
+                raise IOError('File %s not found' % fepout)
+            with open(fepout, 'rb') as fin:
+                shutil.copyfileobj(fin, fout, 1 << 20)
+    os.replace(out + '.tmp', out)
+    return out
+
+
 def get_rundir(pdb, run, suffix):
     """Return directory to use for this simulation run.
 
@@ -391,22 +1170,21 @@ def main():
                         help='Create job for this particular run number.')
     parser.add_argument('--fep',
                         type=str,
-                        required=True,
                         default=None,
-                        help='Template tcl file')
+                        help='Template tcl file. Required, except with --gather.')
     parser.add_argument('--pdb',
                         type=str,
-                        required=True,
                         default=None,
-                        help='PDB file.')
+                        help='PDB file. Required, except with --gather.')
     parser.add_argument('--time',
                         type=str,
                         default='24:00:00',
                         help='Time limit for the job. Default 24:00:00')
     parser.add_argument('--cores',
                         type=int,
-                        default=1,
-                        help='Number of cores to request for the job. Default 1.')
+                        default=None,
+                        help='Number of cores to request for the job. Default 1, or with --auto '
+                        'the recorded core count.')
     parser.add_argument('--suffix',
                         type=str,
                         default='',
@@ -415,9 +1193,70 @@ def main():
                         type=int,
                         default=None,
                         help='advanced reservatoin ID.')
+    parser.add_argument('--runs-per-ar',
+                        type=int,
+                        default=1,
+                        help='Number of runs sharing the advanced reservation at the same time. '
+                        'Each run gets this fraction of its cores. Default 1.')
+    parser.add_argument('--batch',
+                        action='store_true',
+                        help='Link inputs from a shared content addressed store, create '
+                        'run directories in parallel and submit all runs as a single '
+                        'array job. Needs --nruns.')
+    parser.add_argument('--chain',
+                        action='store_true',
+                        help='Split each run into restartable segments that fit in '
+                        '--segment-queue, and submit them as a chain of array jobs. '
+                        'Needs --ns-per-day.')
+    parser.add_argument('--ns-per-day',
+                        type=float,
+                        default=None,
+                        help='Expected simulation speed in ns/day, used to size segments.')
+    parser.add_argument('--segment-queue',
+                        type=str,
+                        default='medium',
+                        choices=sorted(QUEUE_LIMITS),
+                        help='Queue each segment should fit in. Default medium.')
+    parser.add_argument('--fep-windows',
+                        action='store_true',
+                        help='Run the lambda windows of each run as parallel jobs that start '
+                        'from a shared equilibrated structure, then gather their fepout files.')
+    parser.add_argument('--equil-steps',
+                        type=int,
+                        default=50000,
+                        help='Equilibration steps before the windows with --fep-windows. '
+                        'Default 50000.')
+    parser.add_argument('--gather',
+                        type=str,
+                        nargs='+',
+                        default=None,
+                        help='Concatenate the window or segment fepout files of these run dirs, '
+                        'created with --fep-windows or --chain.')
+    parser.add_argument('--auto',
+                        action='store_true',
+                        help='Choose --time and --cores (and so the queue) from the speed of '
+                        'similar runs recorded in the performance database (perfdb.py). '
+                        'With --chain, also predict --ns-per-day.')
+    parser.add_argument('--idws',
+                        action='store_true',
+                        help='Also write backward energies (alchLambdaIDWS) in each lambda window, '
+                        'for BAR and MBAR in fepout.py. Needs NAMD 2.12 or newer.')
+    parser.add_argument('--threads',
+                        type=int,
+                        default=None,
+                        help='Threads used to create run directories in batch mode. '
+                        'Default: number of cores.')
 
     args = parser.parse_args()
 
+    if args.gather:
+        for rundir in args.gather:
+            print(gather_fepout(rundir))
+        return
+
+    if not args.fep or not args.pdb:
+        parser.error('--fep and --pdb are required')
+
     if args.nruns:
         runs = range(1, args.nruns+1, 1)
     elif args.run:
@@ -435,12 +1274,67 @@ def main():
 
     alchpdbfile = args.pdb[:-4] + '_alch.pdb'
     if not os.path.exists(alchpdbfile):
-        raise IOError('File %s not found' % alchpdbfile)
+        raise IOError('File %s not found. Create it with: python pdbflags.py %s' % (alchpdbfile, args.pdb))
 
     fixedpdbfile = args.pdb[:-4] + '_fixed.pdb'
     if not os.path.exists(fixedpdbfile):
-        raise IOError('File %s not found' % fixedpdbfile)
+        raise IOError('File %s not found. Create it with: python pdbflags.py %s' % (fixedpdbfile, args.pdb))
+
+    if args.auto and not args.arid:
+        # Without --cores, the core count is chosen from the recorded runs too.
+        choice = auto_resources(render_fep(args.fep, args.pdb), psffile, windows=args.fep_windows,
+                                cores=args.cores)
+        if choice is None:
+            args.cores = args.cores or 1
+            print('Not enough runs in the performance database, using --time %s --cores %d.'
+                  % (args.time, args.cores), file=sys.stderr)
+        elif args.chain:
+            # Segments always fill a queue, only the cores and speed are needed.
+            args.cores = args.cores or choice['cores']
+            if not args.ns_per_day:
+                args.ns_per_day = perfdb.predict(perfdb.connect(), perfdb.psf_atoms(psffile), args.cores)
+                print('Predicted %.2f ns/day on %d cores.' % (args.ns_per_day, args.cores), file=sys.stderr)
+        else:
+            args.time, args.cores = format_time(choice['seconds']), choice['cores']
+            print('Predicted %.2f ns/day: --time %s --cores %d (%s queue).'
+                  % (choice['ns_per_day'], args.time, args.cores, queue(args.time)), file=sys.stderr)
+    if args.cores is None:
+        args.cores = 1
+
+    if args.fep_windows:
+        if runs == [-1]:
+            raise ValueError('--fep-windows needs --nruns or --run')
+        jobs = create_windows(args.fep, args.pdb, [args.pdb, psffile, alchpdbfile, fixedpdbfile],
+                              list(runs), args.suffix, args.equil_steps,
+                              threads=args.threads, idws=args.idws, time=args.time, cores=args.cores,
+                              arid=args.arid, share=args.runs_per_ar)
+        for job in jobs:
+            print('qsub %s' % job)
+        return
+
+    if args.chain:
+        if not args.ns_per_day:
+            raise ValueError('--chain needs --ns-per-day')
+        if runs == [-1]:
+            raise ValueError('--chain needs --nruns or --run')
+        jobs = create_chain(args.fep, args.pdb, [args.pdb, psffile, alchpdbfile, fixedpdbfile],
+                            list(runs), args.suffix, args.ns_per_day, args.segment_queue,
+                            threads=args.threads, idws=args.idws, cores=args.cores, arid=args.arid,
+                            share=args.runs_per_ar)
+        for job in jobs:
+            print('qsub %s' % job)
+        return
+
+    if args.batch:
+        if not args.nruns:
+            raise ValueError('--batch needs --nruns')
+        job = create_batch(args.fep, args.pdb, [args.pdb, psffile, alchpdbfile, fixedpdbfile],
+                           list(runs), args.suffix, threads=args.threads, idws=args.idws,
+                           time=args.time, cores=args.cores, arid=args.arid, share=args.runs_per_ar)
+        print('qsub %s' % job)
+        return
 
+    rendered = render_fep(args.fep, args.pdb, args.idws)
     for run in runs:
         # Get a directory where we store the pdb, psf, and fep.tcl files, used
         # for this simulation run.
@@ -452,11 +1346,7 @@ def main():
             newfname = os.path.join(rundir, os.path.basename(fname))
             shutil.copy(fname, newfname)
 
-        if run >= len(RANDOM_INTS):
-            raise ValueError('run number %d higher than our random int set size. '
-                             'Increase the random set the set.' % run)
-
-        fep = create_fep(args.fep, rundir, args.pdb, RANDOM_INTS[run])
+        fep = create_fep(args.fep, rundir, args.pdb, random_seed(run), rendered=rendered)
 
         # Job name, to show in qstat and on slack.
         jobname = 'dis_%s' % os.path.basename(rundir)
@@ -464,7 +1354,8 @@ def main():
         # where we want to save output from stdout and stderr for this job.
         joblogfile = os.path.join(rundir, 'namd.stdout')
 
-        job = create_job(jobname, fep, joblogfile, time=args.time, cores=args.cores, arid=args.arid)
+        job = create_job(jobname, fep, joblogfile, time=args.time, cores=args.cores, arid=args.arid,
+                         share=args.runs_per_ar)
         print('qsub %s' % job)
 
         # Also copy job to run dir, so we know which script we used for this simulation.
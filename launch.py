@@ -0,0 +1,219 @@
+"""Coordinate the start of jobs, so that jobs submitted together do not start at once.
+
+The job scripts of jobgen.py run `launch.py wait` before NAMD, with the python
+that ran jobgen.py (python3 is not on the PATH of jobs). Starts are admitted
+by a token bucket shared by all jobs: up to --burst jobs start at once, then
+one job every 1/--rate seconds. The bucket is a small file in
+the jobs directory (~/jobs, on the shared filesystem), updated under a fcntl
+lock. Each job takes a token when it asks, possibly going into debt, and
+sleeps only until its token is due, so jobs start in the order they asked
+without polling the lock.
+
+The start time, wait and host of every job are appended to launch.log in the
+same directory, see `python launch.py stats`.
+
+If the jobs directory can not be locked, the job starts right away.
+
+Usage: python launch.py wait --name $JOB_NAME
+       python launch.py stats
+"""
+
+import sys
+import os
+import time
+import json
+import fcntl
+import socket
+import argparse
+from contextlib import contextmanager
+
+if sys.version_info[0] < 3:
+    print('Needs python3. Load it using: module load python/3.4.3')
+    sys.exit(0)
+
+
+LAUNCH_DIR = os.path.join(os.environ['HOME'], 'jobs')
+
+# Starts per second admitted by the bucket, and starts admitted at once. Can
+# be changed with LAUNCH_RATE and LAUNCH_BURST in the environment of the jobs.
+RATE = 0.5
+BURST = 4
+
+STATE = 'launch.state'
+LOG = 'launch.log'
+
+
+@contextmanager
+def locked(fname):
+    """Open a file for reading and writing, with an exclusive lock while in the context."""
+    with open(fname, 'a+') as fp:
+        # lockf locks are also honoured across NFS clients, unlike flock.
+        fcntl.lockf(fp, fcntl.LOCK_EX)
+        try:
+            fp.seek(0)
+            yield fp
+        finally:
+            fp.flush()
+            fcntl.lockf(fp, fcntl.LOCK_UN)
+
+
+def take_token(dir=LAUNCH_DIR, rate=RATE, burst=BURST):
+    """Take a token from the bucket and return the seconds until it is due.
+
+    Parameters
+    ----------
+    dir : string, optional
+        directory of the bucket state file.
+    rate : float, optional
+        tokens added per second.
+    burst : int, optional
+        tokens the bucket holds at most.
+
+    Returns
+    -------
+    delay : float
+        seconds to wait before starting, 0 if a token was available.
+    """
+    if rate <= 0 or burst < 1:
+        raise ValueError('rate must be > 0 and burst >= 1, got %g and %d' % (rate, burst))
+    if not os.path.exists(dir):
+        os.makedirs(dir)
+    with locked(os.path.join(dir, STATE)) as fp:
+        try:
+            state = json.loads(fp.read())
+        except ValueError:
+            state = None
+        now = time.time()
+        if state:
+            tokens = min(burst, state['tokens'] + (now - state['time']) * rate)
+        else:
+            tokens = burst
+        tokens -= 1
+        fp.seek(0)
+        fp.truncate()
+        fp.write(json.dumps({'tokens': tokens, 'time': now}))
+    return max(0.0, -tokens / rate)
+
+
+def record(name, start, waited, dir=LAUNCH_DIR):
+    """Append the start of a job to the launch log."""
+    with locked(os.path.join(dir, LOG)) as fp:
+        fp.seek(0, os.SEEK_END)
+        fp.write('%.3f\t%.3f\t%s\t%s\n' % (start, waited, socket.gethostname(), name))
+
+
+def wait(name, dir=LAUNCH_DIR, rate=RATE, burst=BURST):
+    """Wait until a job may start, and record its start.
+
+    Returns
+    -------
+    waited : float
+        seconds waited.
+    """
+    asked = time.time()
+    try:
+        delay = take_token(dir, rate, burst)
+    except OSError as e:
+        print('Launch coordination failed, starting now: %s' % e, file=sys.stderr)
+        return 0.0
+    if delay > 0:
+        time.sleep(delay)
+    start = time.time()
+    try:
+        record(name, start, start - asked, dir)
+    except OSError as e:
+        print('Could not record start: %s' % e, file=sys.stderr)
+    return start - asked
+
+
+def read_log(dir=LAUNCH_DIR):
+    """Return the recorded starts as a list of (start, waited, host, name), by start time."""
+    fname = os.path.join(dir, LOG)
+    if not os.path.exists(fname):
+        raise IOError('File %s not found.' % fname)
+    starts = []
+    with open(fname) as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) == 4:
+                starts.append((float(fields[0]), float(fields[1]), fields[2], fields[3]))
+    starts.sort()
+    return starts
+
+
+def stats(starts):
+    """Return a summary of recorded starts.
+
+    Returns
+    -------
+    summary : dict
+        starts, hosts, first and last start time, mean and max wait in
+        seconds, the smallest gap between two starts and the mean rate
+        (starts per second).
+    """
+    summary = {'starts': len(starts), 'hosts': len(set(s[2] for s in starts)), 'first': None,
+               'last': None, 'mean_wait': 0.0, 'max_wait': 0.0, 'min_gap': None, 'rate': None}
+    if not starts:
+        return summary
+    times = [s[0] for s in starts]
+    waits = [s[1] for s in starts]
+    summary.update(first=times[0], last=times[-1], mean_wait=sum(waits) / len(waits),
+                   max_wait=max(waits))
+    if len(times) > 1:
+        summary['min_gap'] = min(b - a for a, b in zip(times, times[1:]))
+        if times[-1] > times[0]:
+            summary['rate'] = (len(times) - 1) / (times[-1] - times[0])
+    return summary
+
+
+def _job_name():
+    name = os.environ.get('JOB_NAME', 'unknown')
+    task = os.environ.get('SGE_TASK_ID', 'undefined')
+    return name if task == 'undefined' else '%s.%s' % (name, task)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Admit job starts at a limited rate, shared by '
+                                     'all jobs through a lock file.')
+    parser.add_argument('--dir',
+                        type=str,
+                        default=LAUNCH_DIR,
+                        help='Directory with the bucket and the launch log, on a filesystem '
+                        'shared by all jobs. Default: %s' % LAUNCH_DIR)
+    subparsers = parser.add_subparsers(dest='command')
+
+    p = subparsers.add_parser('wait', help='Wait until this job may start.')
+    p.add_argument('--name',
+                   type=str,
+                   default=_job_name(),
+                   help='Job name in the launch log. Default: $JOB_NAME.$SGE_TASK_ID.')
+    p.add_argument('--rate',
+                   type=float,
+                   default=float(os.environ.get('LAUNCH_RATE', RATE)),
+                   help='Starts per second. Default: $LAUNCH_RATE, or %g.' % RATE)
+    p.add_argument('--burst',
+                   type=int,
+                   default=int(os.environ.get('LAUNCH_BURST', BURST)),
+                   help='Starts admitted at once. Default: $LAUNCH_BURST, or %d.' % BURST)
+
+    subparsers.add_parser('stats', help='Print a summary of the recorded starts.')
+
+    args = parser.parse_args()
+
+    if args.command == 'wait':
+        waited = wait(args.name, args.dir, args.rate, args.burst)
+        print('Started %s after waiting %.1f s' % (args.name, waited))
+    elif args.command == 'stats':
+        s = stats(read_log(args.dir))
+        print('starts: %d on %d hosts' % (s['starts'], s['hosts']))
+        if s['starts']:
+            print('from %s to %s' % (time.ctime(s['first']), time.ctime(s['last'])))
+            print('wait: mean %.1f s, max %.1f s' % (s['mean_wait'], s['max_wait']))
+        if s['rate']:
+            print('rate: %.3f starts/s, smallest gap %.3f s' % (s['rate'], s['min_gap']))
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""Load all measurement series of a run into a single pandas DataFrame.
+
+Replacement for read_csv/update_df/populate_df in plots.ipynb. All series of
+a run prefix are read in parallel and aligned on the frame index with a single
+concat, instead of joining them into a growing DataFrame one file at a time.
+
+Runs that were measured in two parts, <prefix>_start_<name>.csv and
+<prefix>_end_<name>.csv, are stitched back into one continuous series <name>.
+If a measurement store <prefix>.mstore exists (see store.py), it is used
+instead of the csv files.
+
+Usage (in plots.ipynb):
+    from loader import populate_df
+    up1_df = populate_df('up1_s10', usecols=['bond3'], stop=25000)
+"""
+
+import os
+import glob
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from store import MeasurementStore, EXTENSION
+
+
+# Parts of a run measured separately, in the order they were simulated.
+PARTS = ['start', 'end']
+
+
+def find_series(prefix):
+    """Return csv files for each series of a run prefix.
+
+    Returns
+    -------
+    series : dict
+        list of csv files (in simulation order) for each series name.
+    """
+    series = {}
+    for csv in sorted(glob.glob('%s_*.csv' % prefix)):
+        name = csv[len(prefix)+1:][:-4]
+        part = name.split('_')[0]
+        if part in PARTS and name != part:
+            name = name[len(part)+1:]
+        series.setdefault(name, []).append(csv)
+    for name, files in series.items():
+        files.sort(key=lambda f: _part_order(f, prefix))
+    return series
+
+
+def _part_order(csv, prefix):
+    part = csv[len(prefix)+1:].split('_')[0]
+    return PARTS.index(part) if part in PARTS else -1
+
+
+def read_csv(csv, colname, nrows=None):
+    """Return a tab-separated measurement csv file as a Series indexed by frame."""
+    df = pd.read_csv(csv, sep='\t', header=None, names=['frame', colname],
+                     index_col=0, nrows=nrows, dtype={colname: np.float32})
+    return df[colname]
+
+
+def read_series(files, colname, stop=None):
+    """Return the series stored in one or more consecutive csv files.
+
+    The first frame of every part after the first one is the starting
+    structure that VMD loads before the trajectory, so it is dropped and the
+    frames of the part are numbered after the last frame of the previous part.
+    """
+    if len(files) == 1:
+        # Frames are numbered from 0 without gaps, so we can stop reading early.
+        return read_csv(files[0], colname, nrows=stop)
+    parts = []
+    last = -1
+    for csv in files:
+        s = read_csv(csv, colname)
+        if parts:
+            s = s.iloc[1:]
+            s.index = s.index - s.index[0] + last + 1
+        last = s.index[-1]
+        parts.append(s)
+    return pd.concat(parts)
+
+
+def _select(df, start, stop, stride):
+    index = df.index.values
+    mask = np.ones(len(index), dtype=bool)
+    if start is not None:
+        mask &= index >= start
+    if stop is not None:
+        mask &= index < stop
+    if stride > 1:
+        mask &= (index - (start or 0)) % stride == 0
+    return df[mask]
+
+
+def populate_df(prefix, usecols=None, start=None, stop=None, stride=1, max_workers=None, store=True):
+    """Read data from all prefix_*.csv files into a pandas DataFrame.
+
+    Each column of the dataframe is a series name (the csv file name without
+    the prefix), the index is the frame number.
+
+    Parameters
+    ----------
+    prefix : string
+        prefix of the csv files, e.g. 'up1_s10'.
+    usecols : list of strings, optional, default None
+        only load these series. Default is all series.
+    start, stop : int, optional, default None
+        only load frames start <= frame < stop. With 1e4 frames per ns, the
+        first 2.5 ns are stop=25000.
+    stride : int, optional, default 1
+        only load every stride-th frame from start.
+    max_workers : int, optional, default None
+        number of threads reading csv files. Default is one per file, up to
+        the number of cores.
+    store : bool, optional, default True
+        use <prefix>.mstore instead of the csv files if it exists.
+
+    Returns
+    -------
+    df : pandas.DataFrame
+        all series aligned on frames.
+    """
+    if store and os.path.exists(prefix + EXTENSION):
+        ms = MeasurementStore(prefix + EXTENSION)
+        df = ms.to_dataframe(usecols)
+        return _select(df, start, stop, stride)
+
+    series = find_series(prefix)
+    if not series:
+        raise IOError('No files found for %s_*.csv' % prefix)
+    names = usecols or sorted(series)
+    for name in names:
+        if name not in series:
+            raise ValueError('No series %s for prefix %s' % (name, prefix))
+
+    if max_workers is None:
+        max_workers = min(len(names), os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        columns = list(pool.map(lambda name: read_series(series[name], name, stop), names))
+
+    df = pd.concat(columns, axis=1)
+    df.index.name = 'frame'
+    return _select(df, start, stop, stride)
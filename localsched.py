@@ -0,0 +1,347 @@
+"""Run job scripts of jobgen.py on this machine instead of submitting them with qsub.
+
+The grid engine directives of the scripts are followed: the cores of
+`#$ -pe smp`, the time limit `#$ -l h_rt`, array tasks `#$ -t` and holds on
+other jobs by name `#$ -hold_jid` (after all tasks of that job) and
+`#$ -hold_jid_ad` (after the same task of that job). Holds on jobs that were
+not given are ignored, like holds on finished jobs in the grid engine.
+
+Tasks are started in the order of the scripts as soon as their holds are
+done and enough of the --cores cores are free, so short tasks fill cores left
+over by large ones. Each task gets NSLOTS, PE_HOSTFILE, JOB_ID, JOB_NAME and
+SGE_TASK_ID like on anthill, and CHARMRUN and NAMD2 (see jobgen.py) to run a
+local NAMD. With --charmrun '' multi core jobs run NAMD2 +p<cores> without a
+launcher, for a multicore NAMD build. The output of a task is written to
+<job name>.o<job id>[.<task>] in the current directory (the -cwd of the
+scripts), and it is killed when it runs longer than its h_rt. A task fails
+when NAMD exits with an error.
+
+Usage: python jobgen.py --nruns 4 --cores 4 --batch | python localsched.py
+       python localsched.py --cores 8 --charmrun '' --namd ~/NAMD_2.14_Linux-x86_64-multicore/namd2
+           ~/jobs/dis_2mx4_p1_s8_run1-abc123.sh
+"""
+
+import sys
+import os
+import re
+import time
+import signal
+import argparse
+import tempfile
+import subprocess
+from collections import namedtuple
+
+if sys.version_info[0] < 3:
+    print('Needs python3. Load it using: module load python/3.4.3')
+    sys.exit(0)
+
+
+# NAMD executables used when CHARMRUN and NAMD2 are not set. A multicore NAMD
+# build runs as namd2 +p<cores>, charmrun ++local does the same for a net build.
+CHARMRUN = 'charmrun ++local'
+NAMD2 = 'namd2'
+
+# Seconds between checks of the running tasks.
+POLL = 0.2
+
+# Seconds between SIGTERM and SIGKILL for a task over its time limit.
+KILL_GRACE = 10
+
+DIRECTIVE = re.compile(r'^#\$\s+(.*)$')
+
+JobSpec = namedtuple('JobSpec', ['script', 'name', 'shell', 'cores', 'h_rt', 'tasks', 'hold', 'hold_tasks', 'cwd'])
+
+
+def parse_time(value):
+    """Return seconds of a grid engine time, [[HH:]MM:]SS."""
+    seconds = 0
+    for field in value.split(':'):
+        seconds = seconds * 60 + int(field or 0)
+    return seconds
+
+
+def parse_job(script):
+    """Return the resources of a job script from its grid engine directives.
+
+    Returns
+    -------
+    job : JobSpec
+        script path, name (-N, default the script name), shell (-S), cores
+        (-pe smp, default 1), h_rt (seconds, or None), tasks (task ids of
+        -t, or None if it is not an array job), hold (job names of -hold_jid
+        or -hold_jid_ad), hold_tasks (True for -hold_jid_ad) and cwd (True
+        with -cwd).
+    """
+    if not os.path.exists(script):
+        raise IOError('Job script %s not found.' % script)
+    spec = {'script': script, 'name': os.path.basename(script), 'shell': '/bin/bash', 'cores': 1,
+            'h_rt': None, 'tasks': None, 'hold': [], 'hold_tasks': False, 'cwd': False}
+    with open(script) as f:
+        for line in f:
+            m = DIRECTIVE.match(line)
+            if not m:
+                continue
+            fields = m.group(1).split()
+            option, values = fields[0], fields[1:]
+            if option == '-N':
+                spec['name'] = values[0]
+            elif option == '-S':
+                spec['shell'] = values[0]
+            elif option == '-cwd':
+                spec['cwd'] = True
+            elif option == '-pe':
+                spec['cores'] = int(values[1].split('-')[-1])
+            elif option == '-l':
+                for resource in ','.join(values).split(','):
+                    key, _, value = resource.partition('=')
+                    if key in ['h_rt', 's_rt']:
+                        spec['h_rt'] = parse_time(value)
+            elif option == '-t':
+                m = re.match(r'^(\d+)(?:-(\d+)(?::(\d+))?)?$', values[0])
+                if not m:
+                    raise ValueError('Invalid task range %s in %s' % (values[0], script))
+                first = int(m.group(1))
+                last = int(m.group(2) or first)
+                spec['tasks'] = list(range(first, last + 1, int(m.group(3) or 1)))
+            elif option in ['-hold_jid', '-hold_jid_ad']:
+                spec['hold'] += values[0].split(',')
+                spec['hold_tasks'] = option == '-hold_jid_ad'
+    return JobSpec(**spec)
+
+
+class Task(object):
+    """A job, or a task of an array job, scheduled by Scheduler.
+
+    Attributes
+    ----------
+    job : JobSpec
+    job_id : int
+    task_id : int or None
+        SGE_TASK_ID, None if the job is not an array job.
+    after : list of Task
+        tasks that have to finish before this one starts.
+    status : string
+        'waiting', 'running', 'done', 'failed' or 'timeout'.
+    returncode : int or None
+    start, end : float
+        wall clock times of the start and end of the task.
+    """
+
+    def __init__(self, job, job_id, task_id=None):
+        self.job = job
+        self.job_id = job_id
+        self.task_id = task_id
+        self.after = []
+        self.status = 'waiting'
+        self.returncode = None
+        self.start = None
+        self.end = None
+        self.proc = None
+        self.hostfile = None
+        self.killed = None
+
+    @property
+    def label(self):
+        if self.task_id is None:
+            return self.job.name
+        return '%s.%d' % (self.job.name, self.task_id)
+
+    @property
+    def finished(self):
+        return self.status in ['done', 'failed', 'timeout']
+
+    @property
+    def output(self):
+        """Output file, as written by the grid engine with -j y."""
+        fname = '%s.o%d' % (self.job.name, self.job_id)
+        if self.task_id is not None:
+            fname += '.%d' % self.task_id
+        return fname
+
+
+class Scheduler(object):
+    """Run job scripts on this machine with at most `cores` cores in use.
+
+    Parameters
+    ----------
+    cores : int, optional, default None
+        number of cores. Default: number of cores of the machine.
+    env : dict, optional, default None
+        extra environment variables of all tasks, e.g. CHARMRUN and NAMD2.
+    time_limit : bool, optional, default True
+        kill tasks running longer than their h_rt.
+    """
+
+    def __init__(self, cores=None, env=None, time_limit=True):
+        self.cores = cores or os.cpu_count() or 1
+        self.env = dict(os.environ, **(env or {}))
+        self.time_limit = time_limit
+        self.tasks = []
+        self._jobs = {}
+        self._submitted = 0
+
+    def submit(self, script):
+        """Add a job script, like qsub. Returns its tasks."""
+        job = parse_job(script)
+        self._submitted += 1
+        job_id = self._submitted
+        if job.cores > self.cores:
+            print('%s asks for %d cores, running it on %d.' % (job.name, job.cores, self.cores),
+                  file=sys.stderr)
+            job = job._replace(cores=self.cores)
+        tasks = [Task(job, job_id, task_id) for task_id in (job.tasks or [None])]
+        for name in job.hold:
+            held = self._jobs.get(name, [])
+            for i, task in enumerate(tasks):
+                if job.hold_tasks and held:
+                    if len(held) != len(tasks):
+                        raise ValueError('%s holds on the tasks of %s, which has %d tasks instead of %d.'
+                                         % (job.name, name, len(held), len(tasks)))
+                    task.after.append(held[i])
+                else:
+                    task.after.extend(held)
+        self._jobs[job.name] = tasks
+        self.tasks.extend(tasks)
+        return tasks
+
+    def _start(self, task):
+        job = task.job
+        cwd = os.getcwd() if job.cwd else os.path.expanduser('~')
+        fd, hostfile = tempfile.mkstemp(prefix='pe_hostfile-')
+        with os.fdopen(fd, 'w') as f:
+            f.write('localhost %d localhost.q UNDEFINED\n' % job.cores)
+        env = dict(self.env, NSLOTS=str(job.cores), PE_HOSTFILE=hostfile, JOB_ID=str(task.job_id),
+                   JOB_NAME=job.name, SGE_TASK_ID=str(task.task_id or 'undefined'))
+        with open(os.path.join(cwd, task.output), 'w') as out:
+            # A new session, so the whole task can be killed at its time limit.
+            task.proc = subprocess.Popen([job.shell, os.path.abspath(job.script)], cwd=cwd, env=env,
+                                         stdin=subprocess.DEVNULL, stdout=out, stderr=subprocess.STDOUT,
+                                         start_new_session=True)
+        task.hostfile = hostfile
+        task.start = time.time()
+        task.status = 'running'
+
+    def _check(self, task):
+        """Update a running task, killing it at its time limit."""
+        code = task.proc.poll()
+        now = time.time()
+        if code is None:
+            h_rt = task.job.h_rt
+            if self.time_limit and h_rt and now - task.start > h_rt:
+                if task.killed is None:
+                    os.killpg(task.proc.pid, signal.SIGTERM)
+                    task.killed = now
+                elif now - task.killed > KILL_GRACE:
+                    os.killpg(task.proc.pid, signal.SIGKILL)
+            return
+        task.returncode = code
+        task.end = now
+        if task.killed is not None:
+            task.status = 'timeout'
+        else:
+            task.status = 'done' if code == 0 else 'failed'
+        os.remove(task.hostfile)
+
+    def run(self, poll=POLL, report=None):
+        """Run all submitted tasks and return them when they have finished.
+
+        Parameters
+        ----------
+        poll : float, optional
+            seconds between checks of the running tasks.
+        report : callable, optional
+            called with each task when it starts and when it finishes.
+        """
+        running = []
+        try:
+            while True:
+                for task in list(running):
+                    self._check(task)
+                    if task.finished:
+                        running.remove(task)
+                        if report:
+                            report(task)
+                free = self.cores - sum(task.job.cores for task in running)
+                waiting = [task for task in self.tasks if task.status == 'waiting']
+                for task in waiting:
+                    if task.job.cores <= free and all(t.finished for t in task.after):
+                        self._start(task)
+                        running.append(task)
+                        free -= task.job.cores
+                        if report:
+                            report(task)
+                if not running:
+                    if any(task.status == 'waiting' for task in self.tasks):
+                        raise RuntimeError('Tasks hold on each other and can not start.')
+                    return self.tasks
+                time.sleep(poll)
+        except BaseException:
+            for task in running:
+                os.killpg(task.proc.pid, signal.SIGKILL)
+            raise
+
+
+def read_qsub_lines(lines):
+    """Return job scripts from lines printed by jobgen.py, 'qsub <script>'."""
+    scripts = []
+    for line in lines:
+        fields = line.split()
+        if len(fields) >= 2 and fields[0] == 'qsub':
+            scripts.append(fields[-1])
+    return scripts
+
+
+def _report(task):
+    if task.status == 'running':
+        print('%s started on %d cores' % (task.label, task.job.cores))
+    else:
+        print('%s %s (exit %s) after %.1f s' % (task.label, task.status, task.returncode,
+                                                 task.end - task.start))
+    sys.stdout.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run job scripts of jobgen.py on this machine, '
+                                     'with a pool of cores instead of the grid engine.')
+    parser.add_argument('scripts',
+                        type=str,
+                        nargs='*',
+                        help='Job scripts, in submission order. Default: read the "qsub <script>" '
+                        'lines printed by jobgen.py from stdin.')
+    parser.add_argument('--cores',
+                        type=int,
+                        default=None,
+                        help='Number of cores to use. Default: all cores of this machine.')
+    parser.add_argument('--namd',
+                        type=str,
+                        default=os.environ.get('NAMD2', NAMD2),
+                        help='NAMD executable. Default: $NAMD2, or %s.' % NAMD2)
+    parser.add_argument('--charmrun',
+                        type=str,
+                        default=os.environ.get('CHARMRUN', CHARMRUN),
+                        help='charmrun command used for multi core jobs, "" to run the NAMD '
+                        'executable directly (multicore build). Default: $CHARMRUN, or "%s".' % CHARMRUN)
+    parser.add_argument('--no-time-limit',
+                        action='store_true',
+                        help='Do not kill tasks running longer than their h_rt.')
+
+    args = parser.parse_args()
+
+    scripts = args.scripts or read_qsub_lines(sys.stdin)
+    if not scripts:
+        parser.error('No job scripts given.')
+
+    scheduler = Scheduler(args.cores, env={'CHARMRUN': args.charmrun, 'NAMD2': args.namd},
+                          time_limit=not args.no_time_limit)
+    for script in scripts:
+        scheduler.submit(script)
+    print('Running %d tasks of %d jobs on %d cores.' % (len(scheduler.tasks), len(scripts), scheduler.cores))
+    sys.stdout.flush()
+    tasks = scheduler.run(report=_report)
+    failed = [task for task in tasks if task.status != 'done']
+    print('%d of %d tasks failed' % (len(failed), len(tasks)))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
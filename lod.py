@@ -0,0 +1,386 @@
+"""Level of detail downsampling of measurement series, for interactive plots.
+
+A series of 100k+ frames has far more points than a figure has pixels. A
+Pyramid keeps the series at several resolutions: level k splits the frames in
+buckets of FACTOR**k frames and keeps the minimum and the maximum of each
+bucket (in frame order), so peaks and the envelope of the series are drawn
+exactly as with all points. Plotting picks the coarsest level that still has
+a point pair per pixel in the visible range, and switches level when the
+x limits change, e.g. when zooming in with %matplotlib notebook.
+
+The levels of <prefix> are cached in <prefix>.lod.npz next to the
+measurements, and rebuilt when the csv files or the store change.
+
+lttb (Largest Triangle Three Buckets) downsamples to a fixed number of points
+that keep the visual shape of the series, for figures with thin lines.
+
+Usage (in plots.ipynb):
+    import lod
+    up1_ex = lod.load_pyramid('up1_extended_s10', ['bond3'])
+    lod.plot(up1_ex, 'bond3', color='black', alpha=0.6, lw=2)
+    xlim([0, 2.5])
+
+    python lod.py up1_s10 up1_extended_s10 p1_s10 p1_extended_s10
+"""
+
+import sys
+import os
+import argparse
+import numpy as np
+
+if sys.version_info[0] < 3:
+    print('Needs python3. Load it using: module load python/3.4.3')
+    sys.exit(0)
+
+
+# Frames per bucket grow by this factor from one level to the next.
+FACTOR = 8
+
+# Levels are built until a level has fewer points than this.
+MIN_POINTS = 1024
+
+# Width in pixels used when there is no axes to measure.
+PIXELS = 1000
+
+CACHE_VERSION = 1
+CACHE_EXTENSION = '.lod.npz'
+
+
+def minmax(frames, values, size):
+    """Return minimum and maximum of each bucket of `size` points, in frame order.
+
+    Parameters
+    ----------
+    frames : numpy.ndarray
+        sorted frame numbers.
+    values : numpy.ndarray
+        values at frames, NaN for missing values.
+    size : int
+        number of points per bucket.
+
+    Returns
+    -------
+    frames, values : numpy.ndarray
+        two points per bucket, the first and last of the minimum and maximum.
+        A bucket of only NaN values gives two NaN points.
+    """
+    n = len(values)
+    nb = -(-n // size)
+    pad = nb * size - n
+    v = np.concatenate([np.asarray(values, dtype=np.float64), np.full(pad, np.nan)]).reshape(nb, size)
+    f = np.concatenate([frames, np.full(pad, frames[-1] if n else 0)]).reshape(nb, size)
+    missing = np.isnan(v)
+    lo = np.where(missing, np.inf, v).argmin(axis=1)
+    hi = np.where(missing, -np.inf, v).argmax(axis=1)
+    idx = np.sort(np.column_stack([lo, hi]), axis=1)
+    rows = np.arange(nb)[:, None]
+    return f[rows, idx].ravel(), v[rows, idx].ravel().astype(np.float32)
+
+
+def lttb(x, y, n_out):
+    """Return n_out points of (x, y) chosen by Largest Triangle Three Buckets.
+
+    The first and last points are kept. The other points are split in
+    n_out - 2 buckets, and from each bucket the point forming the largest
+    triangle with the previously chosen point and the average of the next
+    bucket is kept. Points must be finite.
+
+    Returns
+    -------
+    x, y : numpy.ndarray
+        downsampled points, or the input if it has at most n_out points.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return x, y
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    # Averages of every bucket, and of the last point as the bucket after the last.
+    sums_x = np.add.reduceat(x[1:n-1], edges[:-1] - 1)
+    sums_y = np.add.reduceat(y[1:n-1], edges[:-1] - 1)
+    counts = np.diff(edges)
+    avg_x = np.append(sums_x / counts, x[-1])
+    avg_y = np.append(sums_y / counts, y[-1])
+
+    keep = np.empty(n_out, dtype=np.int64)
+    keep[0] = 0
+    keep[-1] = n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i+1]
+        area = np.abs((x[a] - avg_x[i+1]) * (y[lo:hi] - y[a])
+                      - (x[a] - x[lo:hi]) * (avg_y[i+1] - y[a]))
+        a = lo + int(area.argmax())
+        keep[i+1] = a
+    return x[keep], y[keep]
+
+
+class Pyramid(object):
+    """Series of a run at several resolutions.
+
+    Parameters
+    ----------
+    frames : numpy.ndarray
+        sorted frame numbers, shared by all series.
+    series : dict
+        array of values for each series name.
+    levels : dict, optional
+        list of (frames, values) of levels 1, 2, ... for each series name,
+        e.g. from a cache. Default: built from the series.
+    factor : int, optional, default FACTOR
+        frames per bucket grow by this factor from one level to the next.
+    scale : float, optional, default 1e-4
+        x units (ns) per frame, for plotting. 1e4 frames per ns in plots.ipynb.
+
+    Attributes
+    ----------
+    sizes : list of ints
+        frames per bucket of each level, sizes[0] = 1 is the series itself.
+    """
+
+    def __init__(self, frames, series, levels=None, factor=FACTOR, scale=1e-4):
+        self.frames = np.asarray(frames)
+        self.series = series
+        self.factor = factor
+        self.scale = scale
+        self.levels = levels if levels is not None else {name: self._build(values)
+                                                         for name, values in series.items()}
+        depth = max([len(l) for l in self.levels.values()] or [0])
+        self.sizes = [factor ** k for k in range(depth + 1)]
+
+    @classmethod
+    def from_dataframe(cls, df, **kwargs):
+        """Return the Pyramid of all columns of a DataFrame indexed by frame, e.g. from populate_df."""
+        return cls(df.index.values, {name: df[name].values for name in df.columns}, **kwargs)
+
+    @property
+    def names(self):
+        return sorted(self.series)
+
+    def _build(self, values):
+        # Each level is built from the points of the previous one: the
+        # minimum and maximum of a bucket are among the minima and maxima of
+        # its FACTOR sub-buckets.
+        levels = []
+        frames, values = self.frames, values
+        size = self.factor
+        while len(values) > MIN_POINTS:
+            frames, values = minmax(frames, values, size)
+            levels.append((frames, values))
+            # Buckets of the built levels hold two points each.
+            size = 2 * self.factor
+        return levels
+
+    def level(self, start=None, stop=None, pixels=PIXELS):
+        """Return the coarsest level with at least `pixels` buckets for frames start <= frame < stop."""
+        lo = 0 if start is None else np.searchsorted(self.frames, start)
+        hi = len(self.frames) if stop is None else np.searchsorted(self.frames, stop)
+        count = max(hi - lo, 1)
+        k = 0
+        while k + 1 < len(self.sizes) and self.sizes[k+1] * pixels <= count:
+            k += 1
+        return k
+
+    def view(self, name, start=None, stop=None, pixels=PIXELS, method='minmax'):
+        """Return at least `pixels` points of a series for frames start <= frame < stop.
+
+        Parameters
+        ----------
+        name : string
+            series name.
+        start, stop : float, optional, default None
+            frame range. Default is all frames.
+        pixels : int, optional, default PIXELS
+            width of the plot in pixels.
+        method : string, optional, default minmax
+            'minmax' returns the points of the chosen level, 'lttb' further
+            downsamples them to 2 * pixels points with lttb.
+
+        Returns
+        -------
+        frames, values : numpy.ndarray
+            points including one point on each side of the range, so lines
+            reach the edges of the plot.
+        """
+        if name not in self.series:
+            raise KeyError('No series %s, got %s' % (name, ', '.join(self.names)))
+        k = self.level(start, stop, pixels)
+        if k == 0:
+            frames, values = self.frames, self.series[name]
+        else:
+            frames, values = self.levels[name][k-1]
+        lo = 0 if start is None else max(np.searchsorted(frames, start) - 1, 0)
+        hi = len(frames) if stop is None else np.searchsorted(frames, stop) + 1
+        frames, values = frames[lo:hi], values[lo:hi]
+        if method == 'lttb':
+            finite = np.isfinite(values)
+            frames, values = lttb(frames[finite], values[finite], 2 * pixels)
+        elif method != 'minmax':
+            raise ValueError('Unknown method %s, use minmax or lttb' % method)
+        return frames, values
+
+    def to_arrays(self):
+        """Return the levels as a dict of arrays, see load_pyramid."""
+        arrays = {}
+        for name, levels in self.levels.items():
+            for k, (frames, values) in enumerate(levels):
+                arrays['frames_%d_%s' % (k + 1, name)] = frames
+                arrays['values_%d_%s' % (k + 1, name)] = values
+        return arrays
+
+    @staticmethod
+    def levels_from_arrays(arrays, names):
+        """Return levels of series names stored by to_arrays, or None if one is missing."""
+        levels = {}
+        for name in names:
+            levels[name] = []
+            k = 1
+            while 'frames_%d_%s' % (k, name) in arrays:
+                levels[name].append((arrays['frames_%d_%s' % (k, name)],
+                                     arrays['values_%d_%s' % (k, name)]))
+                k += 1
+            if not levels[name] and 'empty_%s' % name not in arrays:
+                return None
+        return levels
+
+
+def _sources(prefix):
+    """Return the files with the measurements of a prefix, see loader.populate_df."""
+    from store import EXTENSION
+    from loader import find_series
+    if os.path.exists(prefix + EXTENSION):
+        return [prefix + EXTENSION]
+    return sorted(f for files in find_series(prefix).values() for f in files)
+
+
+def _signature(files):
+    stats = [os.stat(f) for f in files]
+    return sum(s.st_size for s in stats), max([s.st_mtime_ns for s in stats] or [0])
+
+
+def load_pyramid(prefix, names=None, cache=True, factor=FACTOR):
+    """Return the Pyramid of the series of a run prefix.
+
+    Levels are read from <prefix>.lod.npz if it is up to date with the
+    measurements, and written to it otherwise.
+
+    Parameters
+    ----------
+    prefix : string
+        prefix of the csv files or store, e.g. 'up1_s10', see loader.populate_df.
+    names : list of strings, optional, default None
+        only load these series. Default is all series.
+    cache : bool, optional, default True
+        read and write the cache file.
+    """
+    from loader import populate_df
+    from store import MeasurementStore, EXTENSION
+
+    df = populate_df(prefix, usecols=names)
+    names = list(df.columns)
+    scale = 1e-4
+    if os.path.exists(prefix + EXTENSION):
+        meta = MeasurementStore(prefix + EXTENSION).meta
+        scale = meta['dcdfreq'] * meta['timestep'] * 1e-6
+
+    cache_file = prefix + CACHE_EXTENSION
+    size, mtime = _signature(_sources(prefix))
+    arrays = {}
+    if cache and os.path.exists(cache_file):
+        try:
+            with np.load(cache_file, allow_pickle=False) as data:
+                arrays = dict(data)
+        except (OSError, ValueError):
+            arrays = {}
+        if (arrays.get('version') != CACHE_VERSION or arrays.get('size') != size
+                or arrays.get('mtime') != mtime or arrays.get('factor') != factor):
+            arrays = {}
+    levels = Pyramid.levels_from_arrays(arrays, names) if arrays else None
+    pyramid = Pyramid.from_dataframe(df, levels=levels, factor=factor, scale=scale)
+
+    if cache and levels is None:
+        # Keep the levels of series cached before that were not loaded now.
+        arrays.update(pyramid.to_arrays())
+        for name in names:
+            if not pyramid.levels[name]:
+                arrays['empty_%s' % name] = np.zeros(0)
+        arrays.update(version=CACHE_VERSION, size=size, mtime=mtime, factor=factor)
+        tmp = '%s.%d.tmp.npz' % (cache_file, os.getpid())
+        try:
+            np.savez(tmp, **arrays)
+            os.replace(tmp, cache_file)
+        except OSError:
+            # The cache is only an optimization, e.g. the directory is read only.
+            if os.path.exists(tmp):
+                os.remove(tmp)
+    return pyramid
+
+
+def _pixels(ax):
+    try:
+        return max(int(ax.get_window_extent().width), 1)
+    except Exception:
+        return PIXELS
+
+
+def plot(pyramid, name, ax=None, method='minmax', **kwargs):
+    """Plot a series of a Pyramid against time, at the level of detail of the x limits.
+
+    The line is updated when the x limits of the axes change.
+
+    Parameters
+    ----------
+    pyramid : Pyramid
+        series of a run, see load_pyramid.
+    name : string
+        series name.
+    ax : matplotlib.axes.Axes, optional
+        axes to plot in. Default is the current axes.
+    method : string, optional, default minmax
+        see Pyramid.view.
+    kwargs : optional
+        line properties passed to ax.plot, e.g. color, lw, label.
+
+    Returns
+    -------
+    line : matplotlib.lines.Line2D
+    """
+    import matplotlib.pyplot as plt
+    ax = ax or plt.gca()
+    scale = pyramid.scale
+    frames, values = pyramid.view(name, pixels=_pixels(ax), method=method)
+    line, = ax.plot(frames * scale, values, **kwargs)
+
+    def update(ax):
+        lo, hi = ax.get_xlim()
+        frames, values = pyramid.view(name, lo / scale, hi / scale, _pixels(ax), method)
+        line.set_data(frames * scale, values)
+        ax.figure.canvas.draw_idle()
+
+    ax.callbacks.connect('xlim_changed', update)
+    return line
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the level of detail caches of measurement series.')
+    parser.add_argument('prefixes',
+                        type=str,
+                        nargs='+',
+                        help='Prefixes of the csv files or stores, e.g. up1_s10.')
+    parser.add_argument('--names',
+                        type=str,
+                        nargs='+',
+                        default=None,
+                        help='Only these series. Default: all series.')
+
+    args = parser.parse_args()
+
+    for prefix in args.prefixes:
+        pyramid = load_pyramid(prefix, args.names)
+        points = [len(pyramid.frames)] + [len(l[0]) for l in pyramid.levels[pyramid.names[0]]]
+        print('%s%s: %s points' % (prefix, CACHE_EXTENSION, ' '.join(str(p) for p in points)))
+
+
+if __name__ == "__main__":
+    main()
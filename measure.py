@@ -0,0 +1,295 @@
+"""Script to measure bond distances and phi/psi dihedrals over a trajectory.
+
+All quantities are computed together in a single pass over the frames, and
+each one is written to a tab-separated file `<prefix>_<name>.csv` in the same
+format as the files in measurements/ (frame number, value).
+
+With --store, all series are also written to a single columnar measurement
+store (see store.py) instead of, or in addition to, the csv files.
+
+Quantities are given as NAME=ATOMS, where ATOMS is a comma separated list of 2
+(distance) or 4 (dihedral) atoms written as [segid:]resid:name. Alternative
+atom names can be separated with '/', the first one found is used. Dihedrals
+named phiN or psiN do not need atoms, they are the backbone dihedrals
+C(N)-N(N+1)-CA(N+1)-C(N+1) and N(N)-CA(N)-C(N)-N(N+1). Like in measurements/,
+they are named after the residue of their first atom.
+
+Usage: python measure.py --psf data/2mx4_p1_s8.psf --dcd namdrun.namdout.dcd
+           --prefix measurements/p1_s8 bond3=35:CA,43:CA phi35 psi36
+"""
+
+import sys
+import os
+import argparse
+import numpy as np
+
+from dcd import open_trajectory
+from topology import load_topology, read_pdb_coords, find_atom
+from store import write_store
+
+if sys.version_info[0] < 3:
+    print('Needs python3. Load it using: module load python/3.4.3')
+    sys.exit(0)
+
+
+# Quantities in measurements/, using the residue numbering of the native 2mx4
+# fragment (35-43). The hydroxyl hydrogen of T37 is HT when it is phosphorylated.
+DEFAULT_QUANTITIES = ['bond1=37:HT/HG1,41:HG1',
+                      'bond2=37:CA,41:CA',
+                      'bond3=35:CA,43:CA',
+                      'phi35',
+                      'psi36',
+                      'phi40',
+                      'psi41']
+
+
+def parse_atom(atoms, spec, offset=0):
+    """Return index of the atom given as [segid:]resid:name[/altname].
+
+    `offset` is added to the resid.
+    """
+    fields = spec.split(':')
+    if len(fields) == 2:
+        segid = ''
+    elif len(fields) == 3:
+        segid = fields.pop(0)
+    else:
+        raise ValueError('Invalid atom %s, expected [segid:]resid:name' % spec)
+    resid = int(fields[0]) + offset
+    names = fields[1].split('/')
+    for name in names[:-1]:
+        try:
+            return find_atom(atoms, segid, resid, name)
+        except ValueError:
+            pass
+    return find_atom(atoms, segid, resid, names[-1])
+
+
+def parse_quantity(atoms, spec, offset=0):
+    """Return name and atom indices of a quantity given as NAME=ATOMS, phiN or psiN."""
+    if spec.find('=') >= 0:
+        name, sel = spec.split('=', 1)
+        indices = [parse_atom(atoms, s, offset) for s in sel.split(',')]
+    elif spec[:3] in ['phi', 'psi'] and spec[3:].isdigit():
+        name = spec
+        r = int(spec[3:])
+        if spec.startswith('phi'):
+            sel = ['%d:C' % r, '%d:N' % (r+1), '%d:CA' % (r+1), '%d:C' % (r+1)]
+        else:
+            # The C-terminal CT2 patch names the amide nitrogen NT.
+            sel = ['%d:N' % r, '%d:CA' % r, '%d:C' % r, '%d:N/%d:NT' % (r+1, r)]
+        indices = []
+        for s in sel:
+            alternatives = s.split('/')
+            for alt in alternatives:
+                try:
+                    indices.append(parse_atom(atoms, alt, offset))
+                    break
+                except ValueError:
+                    if alt == alternatives[-1]:
+                        raise
+    else:
+        raise ValueError('Invalid quantity %s, expected NAME=ATOMS, phiN or psiN' % spec)
+
+    if len(indices) not in [2, 4]:
+        raise ValueError('Quantity %s needs 2 (distance) or 4 (dihedral) atoms' % spec)
+    return name, indices
+
+
+def distances(xyz, pairs):
+    """Return distances between atom pairs in every frame.
+
+    Parameters
+    ----------
+    xyz : numpy.ndarray
+        coordinates with shape (n_frames, n_atoms, 3).
+    pairs : numpy.ndarray
+        atom indices with shape (n_pairs, 2).
+
+    Returns
+    -------
+    out : numpy.ndarray
+        distances with shape (n_frames, n_pairs).
+    """
+    d = xyz[:, pairs[:, 0]] - xyz[:, pairs[:, 1]]
+    return np.sqrt((d * d).sum(axis=-1))
+
+
+def dihedrals(xyz, quads):
+    """Return dihedral angles in degrees, in (-180, 180], in every frame.
+
+    Parameters
+    ----------
+    xyz : numpy.ndarray
+        coordinates with shape (n_frames, n_atoms, 3).
+    quads : numpy.ndarray
+        atom indices with shape (n_dihedrals, 4).
+
+    Returns
+    -------
+    out : numpy.ndarray
+        dihedrals with shape (n_frames, n_dihedrals).
+    """
+    p0, p1, p2, p3 = [xyz[:, quads[:, i]] for i in range(4)]
+    b0 = p0 - p1
+    b1 = p2 - p1
+    b2 = p3 - p2
+    b1 /= np.sqrt((b1 * b1).sum(axis=-1))[..., None]
+    # project b0 and b2 on the plane perpendicular to b1
+    v = b0 - (b0 * b1).sum(axis=-1)[..., None] * b1
+    w = b2 - (b2 * b1).sum(axis=-1)[..., None] * b1
+    x = (v * w).sum(axis=-1)
+    y = (np.cross(b1, v) * w).sum(axis=-1)
+    return np.degrees(np.arctan2(y, x))
+
+
+def measure(dcd, psf, quantities, offset=0, pdb=None, start=0, stop=None, stride=1, chunk=1000):
+    """Measure quantities over the frames of a trajectory in a single pass.
+
+    Parameters
+    ----------
+    dcd : string
+        trajectory file path.
+    psf : string
+        psf file path for the trajectory.
+    quantities : list of strings
+        quantities to measure, see parse_quantity.
+    offset : int, optional, default 0
+        number added to every resid in quantities.
+    pdb : string, optional, default None
+        if given, coordinates in this pdb are used as frame 0 and frames in
+        the dcd are numbered from 1. This is how VMD numbers frames when a
+        trajectory is loaded on top of the structure.
+    start, stop, stride : int, optional
+        range of dcd frames to measure, as in a slice.
+    chunk : int, optional, default 1000
+        number of frames read from the trajectory at a time.
+
+    Returns
+    -------
+    frames : numpy.ndarray
+        frame numbers.
+    series : dict
+        numpy.ndarray of float32 values for each quantity name.
+    """
+    atoms = load_topology(psf).atoms
+    names = []
+    kinds = []
+    pairs = []
+    quads = []
+    for spec in quantities:
+        name, indices = parse_quantity(atoms, spec, offset)
+        names.append(name)
+        if len(indices) == 2:
+            kinds.append((0, len(pairs)))
+            pairs.append(indices)
+        else:
+            kinds.append((1, len(quads)))
+            quads.append(indices)
+
+    # Only the atoms used in some quantity are read from the trajectory.
+    used = np.unique(np.concatenate([np.ravel(pairs), np.ravel(quads)]).astype(int))
+    remap = np.zeros(len(atoms), dtype=int)
+    remap[used] = np.arange(len(used))
+    pairs = remap[np.array(pairs, dtype=int).reshape(-1, 2)]
+    quads = remap[np.array(quads, dtype=int).reshape(-1, 4)]
+
+    blocks = []
+    allframes = []
+    if pdb:
+        xyz = read_pdb_coords(pdb)[used][None]
+        blocks.append((distances(xyz, pairs), dihedrals(xyz, quads)))
+        allframes.append(np.zeros(1, dtype=int))
+    with open_trajectory(dcd) as traj:
+        if traj.n_atoms != len(atoms):
+            raise ValueError('Trajectory %s has %d atoms, psf %s has %d atoms.'
+                             % (dcd, traj.n_atoms, psf, len(atoms)))
+        for frames, xyz in traj.chunks(chunk, start, stop, stride, atoms=used):
+            blocks.append((distances(xyz, pairs), dihedrals(xyz, quads)))
+            allframes.append(frames + 1 if pdb else frames)
+
+    dist = np.concatenate([b[0] for b in blocks]).astype(np.float32)
+    dihed = np.concatenate([b[1] for b in blocks]).astype(np.float32)
+    series = {}
+    for name, (kind, i) in zip(names, kinds):
+        series[name] = dist[:, i] if kind == 0 else dihed[:, i]
+    return np.concatenate(allframes), series
+
+
+def write_csvs(prefix, frames, series):
+    """Write each series to <prefix>_<name>.csv as tab-separated frame and value."""
+    files = []
+    for name, values in series.items():
+        fname = '%s_%s.csv' % (prefix, name)
+        np.savetxt(fname, np.column_stack([frames, values]), fmt=['%d', '%f'], delimiter='\t')
+        files.append(fname)
+    return files
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure distances and dihedrals over a '
+                                     'trajectory in a single pass and write them to '
+                                     '<prefix>_<name>.csv files.')
+    parser.add_argument('quantities',
+                        type=str,
+                        nargs='*',
+                        help='Quantities to measure, NAME=ATOMS, phiN or psiN. '
+                        'Default: %s' % ' '.join(DEFAULT_QUANTITIES))
+    parser.add_argument('--psf',
+                        type=str,
+                        required=True,
+                        help='PSF file.')
+    parser.add_argument('--dcd',
+                        type=str,
+                        required=True,
+                        help='DCD trajectory file, or compressed trajectory (.trjz, see trajzip.py).')
+    parser.add_argument('--prefix',
+                        type=str,
+                        default=None,
+                        help='Prefix of the output csv files.')
+    parser.add_argument('--store',
+                        type=str,
+                        default=None,
+                        help='Write all series to this measurement store file.')
+    parser.add_argument('--run',
+                        type=str,
+                        default=None,
+                        help='Run name saved in the store. Default: basename of the dcd directory.')
+    parser.add_argument('--pdb',
+                        type=str,
+                        default=None,
+                        help='Use coordinates in this pdb file as frame 0, like VMD.')
+    parser.add_argument('--offset',
+                        type=int,
+                        default=0,
+                        help='Add this to every resid in quantities. Default 0.')
+    parser.add_argument('--stride',
+                        type=int,
+                        default=1,
+                        help='Measure every n-th frame. Default 1.')
+
+    args = parser.parse_args()
+
+    if not args.prefix and not args.store:
+        raise ValueError('Use --prefix and/or --store to save the measurements.')
+
+    for fname in [args.psf, args.dcd, args.pdb]:
+        if fname and not os.path.exists(fname):
+            raise IOError('File %s not found.' % fname)
+
+    quantities = args.quantities or DEFAULT_QUANTITIES
+    frames, series = measure(args.dcd, args.psf, quantities, offset=args.offset,
+                             pdb=args.pdb, stride=args.stride)
+    if args.prefix:
+        for fname in write_csvs(args.prefix, frames, series):
+            print(fname)
+    if args.store:
+        with open_trajectory(args.dcd) as traj:
+            dcdfreq, timestep = traj.nsavc, traj.timestep
+        run = args.run or os.path.basename(os.path.dirname(os.path.abspath(args.dcd)))
+        print(write_store(args.store, frames, series, run=run, timestep=round(timestep, 6),
+                          dcdfreq=dcdfreq))
+
+
+if __name__ == "__main__":
+    main()
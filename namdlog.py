@@ -0,0 +1,354 @@
+"""Energy time series of NAMD logs, and a stability check of many runs.
+
+NAMD prints an ENERGY: line every outputEnergies steps (100 in the
+templates), with the column names in ETITLE: lines. This script reads logs
+in large chunks, parses all ENERGY: lines of a chunk at once into numpy
+columns and writes them to a measurement store (see store.py), one per run:
+
+- <run dir>/energy.mstore for a run directory of jobgen.py, with the
+  ENERGY: lines of its consecutive segments (fep.tcl, the --chain segments
+  in step order, or the equilibration of --fep-windows).
+- <run dir>/energy_<tag>.mstore for each segment that starts at the same
+  step as another one, i.e. the lambda windows fep_win<k>.tcl of
+  --fep-windows, which all restart from the equilibration. They are checked
+  as separate runs, <run>/<tag>.
+- <log>_energy.mstore for a log given directly, e.g. namd.stdout ->
+  namd_energy.mstore.
+
+The frame column of the store is the step (dcdfreq 1), the series are the
+ETITLE columns (TEMP, TOTAL, PRESSURE, VOLUME, ...). A store is only rewritten
+when its logs changed.
+
+For every run, the mean temperature, total energy drift, mean pressure and
+volume change are printed, and runs that are not stable are flagged: NaN
+energies, mean temperature of the second half of the run far from the
+Langevin temperature, or a large volume change.
+
+Usage: python namdlog.py                       # all runs under jobgen OUTPUT_DIR
+       python namdlog.py --root /path/to/runs --workers 16
+       python namdlog.py p1_s10_run1 p1_s10_run2/namd.stdout
+"""
+
+import sys
+import os
+import re
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+from store import write_store, MeasurementStore, EXTENSION
+
+if sys.version_info[0] < 3:
+    print('Needs python3. Load it using: module load python/3.4.3')
+    sys.exit(0)
+
+
+# Bytes read from a log at a time.
+CHUNK_SIZE = 1 << 24
+
+STORE_NAME = 'energy' + EXTENSION
+
+ETITLE = re.compile(rb'(?m)^ETITLE:([^\n]*)')
+ENERGY = re.compile(rb'(?m)^ENERGY:([^\n]*)')
+TIMESTEP = re.compile(rb'(?m)^Info: TIMESTEP\s+(\S+)')
+LANGEVIN_TEMPERATURE = re.compile(rb'(?m)^Info: LANGEVIN TEMPERATURE\s+(\S+)')
+
+# Stability limits: temperature difference (K) to the Langevin temperature,
+# and relative volume change over the run.
+MAX_TEMPERATURE_DIFF = 5.0
+MAX_VOLUME_CHANGE = 0.05
+
+
+def _parse_energies(lines, ncols):
+    """Return rows of the ENERGY: bodies with ncols values, as float64."""
+    values = np.fromstring(b' '.join(lines), sep=' ')
+    if values.size == len(lines) * ncols:
+        return values.reshape(-1, ncols)
+    # A garbled line (e.g. cut by a crash) shifts all columns: parse the
+    # lines with the right number of fields only.
+    good = [line for line in lines if len(line.split()) == ncols]
+    return np.fromstring(b' '.join(good), sep=' ').reshape(-1, ncols)
+
+
+def read_energies(fname, chunksize=CHUNK_SIZE):
+    """Read the ENERGY: lines of a NAMD log.
+
+    Parameters
+    ----------
+    fname : string
+        NAMD log file path.
+    chunksize : int, optional
+        number of bytes read at a time.
+
+    Returns
+    -------
+    log : dict
+        'titles': ETITLE column names (TS first), 'values': float64 array
+        with one row per ENERGY: line, 'timestep' (fs) and 'temperature'
+        (Langevin temperature in K, or None) from the Info: lines.
+    """
+    titles = None
+    blocks = []
+    timestep = 1.0
+    temperature = None
+    tail = b''
+    with open(fname, 'rb') as fp:
+        while True:
+            data = fp.read(chunksize)
+            if not data:
+                break
+            data = tail + data
+            # Only complete lines, the rest is parsed with the next chunk.
+            end = data.rfind(b'\n') + 1
+            data, tail = data[:end], data[end:]
+            if titles is None:
+                m = ETITLE.search(data)
+                if m:
+                    titles = m.group(1).decode('ascii', 'replace').split()
+            m = TIMESTEP.search(data)
+            if m:
+                timestep = float(m.group(1))
+            m = LANGEVIN_TEMPERATURE.search(data)
+            if m:
+                temperature = float(m.group(1))
+            lines = ENERGY.findall(data)
+            if lines and titles:
+                blocks.append(_parse_energies(lines, len(titles)))
+    ncols = len(titles) if titles else 0
+    values = np.concatenate(blocks) if blocks else np.zeros((0, ncols))
+    return {'titles': titles or [], 'values': values, 'timestep': timestep,
+            'temperature': temperature}
+
+
+def run_energies(logs):
+    """Return the energies of the consecutive logs of a run, in step order.
+
+    The step where a segment restarts is printed by the previous log too,
+    and steps of a log from its first step on replace those of the previous
+    log (e.g. a segment that was restarted after a crash).
+
+    Parameters
+    ----------
+    logs : list of strings
+        NAMD logs in simulation order, e.g. the --chain segments.
+
+    Returns
+    -------
+    steps : numpy.ndarray
+        step of every row.
+    series : dict
+        values of every ETITLE column except TS.
+    info : dict
+        timestep and temperature, see read_energies.
+    """
+    found = [log for log in logs if os.path.exists(log)]
+    parsed = [read_energies(log) for log in found]
+    found = [log for log, p in zip(found, parsed) if p['titles']]
+    parsed = [p for p in parsed if p['titles']]
+    if not parsed:
+        return np.zeros(0, dtype=np.int64), {}, {'timestep': 1.0, 'temperature': None}
+    titles = parsed[0]['titles']
+    for p in parsed[1:]:
+        if p['titles'] != titles:
+            raise ValueError('Logs %s have different ETITLE columns.' % ', '.join(logs))
+    blocks = []
+    previous = None
+    for log, p in zip(found, parsed):
+        values = p['values']
+        if not len(values):
+            continue
+        if blocks:
+            if values[0, 0] <= previous[1]:
+                raise ValueError('Log %s does not start after log %s, they are not consecutive '
+                                 'segments.'
+                                 % (log, previous[0]))
+            blocks[-1] = blocks[-1][blocks[-1][:, 0] < values[0, 0]]
+        blocks.append(values)
+        previous = (log, values[0, 0])
+    values = np.concatenate(blocks) if blocks else np.zeros((0, len(titles)))
+    steps = values[:, 0].astype(np.int64)
+    # Last occurrence of every step printed twice by a log, in step order.
+    order = np.argsort(steps[::-1], kind='stable')
+    unique, first = np.unique(steps[::-1][order], return_index=True)
+    rows = (len(steps) - 1 - order)[first]
+    series = {name: values[rows, i] for i, name in enumerate(titles) if i > 0}
+    info = {'timestep': parsed[-1]['timestep'], 'temperature': parsed[-1]['temperature']}
+    return steps[rows], series, info
+
+
+def _sources(logs):
+    return [[log, os.path.getsize(log), os.stat(log).st_mtime_ns] for log in logs if os.path.exists(log)]
+
+
+def energy_store(logs, out, run='', force=False):
+    """Write the energies of the logs of a run to a store, unless it is up to date.
+
+    Returns
+    -------
+    fname : string
+        path of the store.
+    """
+    sources = _sources(logs)
+    if not force and os.path.exists(out):
+        try:
+            if MeasurementStore(out).meta.get('sources') == sources:
+                return out
+        except ValueError:
+            pass
+    steps, series, info = run_energies(logs)
+    return write_store(out, steps, series, run=run, timestep=info['timestep'], dcdfreq=1,
+                       temperature=info['temperature'], sources=sources)
+
+
+def stability(fname):
+    """Return a summary of the energies in a store written by energy_store.
+
+    Returns
+    -------
+    summary : dict
+        frames, ns, temperature (mean of the second half), total energy drift
+        (kcal/mol/ns, least squares slope), pressure (mean), volume change
+        (relative, first to last), and 'problems': list of strings, empty if
+        the run is stable.
+    """
+    ms = MeasurementStore(fname)
+    summary = {'frames': len(ms), 'ns': 0.0, 'temperature': np.nan, 'drift': np.nan,
+               'pressure': np.nan, 'volume': np.nan, 'problems': []}
+    if len(ms) < 2:
+        summary['problems'].append('no energies')
+        return summary
+    time = ms.time
+    summary['ns'] = float(time[-1] - time[0])
+    problems = summary['problems']
+    for name in ['TOTAL', 'TEMP']:
+        if name in ms and not np.isfinite(ms[name]).all():
+            problems.append('%s is not finite' % name)
+    half = len(ms) // 2
+    if 'TEMP' in ms:
+        summary['temperature'] = float(np.mean(ms['TEMP'][half:]))
+        target = ms.meta.get('temperature')
+        if target is not None and abs(summary['temperature'] - target) > MAX_TEMPERATURE_DIFF:
+            problems.append('temperature %.1f K, expected %.1f K' % (summary['temperature'], target))
+    if 'TOTAL' in ms and summary['ns'] > 0 and np.isfinite(ms['TOTAL']).all():
+        summary['drift'] = float(np.polyfit(time - time[0], ms['TOTAL'].astype(np.float64), 1)[0])
+    if 'PRESSURE' in ms:
+        summary['pressure'] = float(np.mean(ms['PRESSURE']))
+    if 'VOLUME' in ms and ms['VOLUME'][0] > 0:
+        volume = ms['VOLUME']
+        summary['volume'] = float(volume[-1] / volume[0] - 1)
+        if abs(summary['volume']) > MAX_VOLUME_CHANGE:
+            problems.append('volume changed %.1f%%' % (100 * summary['volume']))
+    return summary
+
+
+def _process(job):
+    run, logs, out, force = job
+    fname = energy_store(logs, out, run, force)
+    return run, fname, stability(fname)
+
+
+def run_jobs(run, rundir, segments):
+    """Return the (run, logs, store) jobs of the segments of a run directory.
+
+    Consecutive segments, in step order, share the store of the run.
+    Segments that start at the same step (the lambda windows of --fep-windows)
+    overlap in steps: each one is a run <run>/<tag> with its own store.
+    """
+    segments = sorted(segments, key=lambda s: s.firststep)
+    starts = [s.firststep for s in segments]
+    chain = [s for s in segments if starts.count(s.firststep) == 1]
+    jobs = []
+    if chain:
+        jobs.append((run, [s.tail.fname for s in chain], os.path.join(rundir, STORE_NAME)))
+    for s in segments:
+        if starts.count(s.firststep) > 1:
+            tag = os.path.basename(s.fep)[len('fep_'):-len('.tcl')]
+            jobs.append(('%s/%s' % (run, tag), [s.tail.fname],
+                         os.path.join(rundir, 'energy_%s%s' % (tag, EXTENSION))))
+    return jobs
+
+
+def find_runs(paths=None, root=None):
+    """Return (run, logs, store) of run directories and logs, see run_jobs.
+
+    Parameters
+    ----------
+    paths : list of strings, optional
+        run directories or NAMD logs. Default: all run directories under root.
+    root : string, optional
+        see simeta.discover_runs.
+    """
+    from simeta import discover_runs, run_segments
+    jobs = []
+    if not paths:
+        for run, segments in discover_runs(root).items():
+            jobs += run_jobs(run, os.path.dirname(segments[0].fep), segments)
+        return jobs
+    for path in paths:
+        if os.path.isdir(path):
+            segments = run_segments(path)
+            if not segments:
+                raise IOError('No fep tcl files in run directory %s' % path)
+            jobs += run_jobs(os.path.basename(os.path.normpath(path)), path, segments)
+        elif os.path.exists(path):
+            jobs.append((path, [path], os.path.splitext(path)[0] + '_energy' + EXTENSION))
+        else:
+            raise IOError('File %s not found.' % path)
+    return jobs
+
+
+def process_runs(jobs, workers=None, force=False):
+    """Write the energy stores of runs in parallel and return their stability summaries.
+
+    Returns
+    -------
+    results : list of (run, store, summary)
+    """
+    jobs = [(run, logs, out, force) for run, logs, out in jobs]
+    if workers == 1 or len(jobs) < 2:
+        return [_process(job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(_process, jobs))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write the energies of NAMD logs to stores and '
+                                     'check the stability of many runs.')
+    parser.add_argument('paths',
+                        type=str,
+                        nargs='*',
+                        help='Run directories or NAMD logs. Default: all runs under --root.')
+    parser.add_argument('--root',
+                        type=str,
+                        default=None,
+                        help='Directory with run directories. Default: jobgen OUTPUT_DIR.')
+    parser.add_argument('--workers',
+                        type=int,
+                        default=None,
+                        help='Number of logs processed at the same time. Default: number of cores.')
+    parser.add_argument('--force',
+                        action='store_true',
+                        help='Rewrite stores even if their logs did not change.')
+    parser.add_argument('--problems',
+                        action='store_true',
+                        help='Only print runs that are not stable.')
+
+    args = parser.parse_args()
+
+    results = process_runs(find_runs(args.paths, args.root), args.workers, args.force)
+    print('%-40s %8s %8s %10s %12s %10s %8s  %s' % ('run', 'frames', 'ns', 'temp', 'drift/ns',
+                                                    'pressure', 'volume', 'status'))
+    unstable = 0
+    for run, fname, s in results:
+        if s['problems']:
+            unstable += 1
+        elif args.problems:
+            continue
+        print('%-40s %8d %8.3f %10.2f %12.2f %10.2f %7.2f%%  %s'
+              % (run, s['frames'], s['ns'], s['temperature'], s['drift'], s['pressure'],
+                 100 * s['volume'], '; '.join(s['problems']) or 'ok'))
+    print('%d of %d runs not stable' % (unstable, len(results)))
+
+
+if __name__ == "__main__":
+    main()
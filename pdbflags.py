@@ -0,0 +1,204 @@
+"""Script to create the _alch.pdb and _fixed.pdb files of solvated structures.
+
+NAMD reads the alchemical atoms (alchFile) and fixed atoms (fixedAtomsFile)
+from the B column of a copy of the structure. This script writes these copies
+for any number of pdb files, e.g. all solvation sizes of a system at once:
+data/2mx4_p1_s8.pdb -> data/2mx4_p1_s8_alch.pdb, data/2mx4_p1_s8_fixed.pdb.
+
+The B column of all atoms is written in one vectorized pass over the bytes of
+the file, the rest of the file is copied unchanged.
+
+By default, the alchemical atoms are the phosphate group of the
+phosphorylated threonine, and the fixed atoms are the first and last atoms of
+the protein, like in the files in data/. With --fixed and --fixed-beyond,
+the fixed atoms are the atoms of a selection farther than a distance from
+the alchemical atoms, e.g. the protein backbone beyond 10 A of the site.
+Selections use the language of topology.py.
+
+Usage: python pdbflags.py data/2mx4_p1_s*.pdb
+       python pdbflags.py data/2mx4_p1_s8.pdb --fixed 'not water and name N CA C O' --fixed-beyond 10
+"""
+
+import sys
+import os
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from topology import load_pdb
+
+if sys.version_info[0] < 3:
+    print('Needs python3. Load it using: module load python/3.4.3')
+    sys.exit(0)
+
+
+# Phosphate group of the phosphorylated threonine (THR with the phosphate patch).
+DEFAULT_ALCH = 'not water and name P O1P O2P OT HT'
+
+# Columns of the B (temperature factor) field in a pdb line.
+BETA_COLUMNS = (60, 66)
+
+SUFFIXES = ['_alch', '_fixed']
+
+
+def atom_lines(data):
+    """Return start offsets and lengths of the ATOM/HETATM lines in pdb bytes."""
+    buf = np.frombuffer(data, dtype=np.uint8)
+    ends = np.flatnonzero(buf == ord('\n'))
+    starts = np.concatenate([[0], ends + 1])
+    ends = np.concatenate([ends, [len(buf)]])
+    keep = np.zeros(len(starts), dtype=bool)
+    for record in [b'ATOM  ', b'HETATM']:
+        # Compare the first 6 bytes of every line at once.
+        valid = ends - starts >= len(record)
+        match = valid.copy()
+        for i, c in enumerate(record):
+            idx = np.minimum(starts + i, len(buf) - 1)
+            match &= buf[idx] == c
+        keep |= match
+    return starts[keep], (ends - starts)[keep]
+
+
+def write_beta(pdb, out, values):
+    """Write a copy of pdb to out with the B column set to values.
+
+    Parameters
+    ----------
+    pdb : string
+        pdb file path.
+    out : string
+        output pdb file path.
+    values : numpy.ndarray
+        B value of each atom, in the order of the ATOM/HETATM records.
+    """
+    with open(pdb, 'rb') as fp:
+        data = fp.read()
+    starts, lengths = atom_lines(data)
+    if len(starts) != len(values):
+        raise ValueError('%s has %d atoms, got %d values' % (pdb, len(starts), len(values)))
+    first, last = BETA_COLUMNS
+    if len(lengths) and lengths.min() < last:
+        raise ValueError('%s has atom lines without a B column' % pdb)
+
+    # Format each distinct value once, and scatter the formatted bytes into
+    # the B columns of all lines.
+    unique, inverse = np.unique(values, return_inverse=True)
+    table = np.array([('%6.2f' % v).encode('ascii') for v in unique], dtype='S%d' % (last - first))
+    table = table.view(np.uint8).reshape(len(unique), last - first)
+    buf = np.frombuffer(data, dtype=np.uint8).copy()
+    buf[starts[:, None] + np.arange(first, last)] = table[inverse]
+
+    tmp = '%s.%d.tmp' % (out, os.getpid())
+    with open(tmp, 'wb') as fp:
+        fp.write(buf.tobytes())
+    os.replace(tmp, out)
+    return out
+
+
+def min_distances(xyz, site, chunk=100000):
+    """Return distance of each point in xyz to the nearest point in site."""
+    out = np.empty(len(xyz))
+    for i in range(0, len(xyz), chunk):
+        d = xyz[i:i+chunk, None, :] - site[None, :, :]
+        out[i:i+chunk] = np.sqrt((d * d).sum(axis=-1)).min(axis=1)
+    return out
+
+
+def flags(pdb, alch=DEFAULT_ALCH, fixed=None, fixed_beyond=None):
+    """Return B values of the alchemical and fixed atoms of a pdb.
+
+    Parameters
+    ----------
+    pdb : string
+        pdb file path.
+    alch : string, optional
+        selection of the alchemical atoms, flagged 1.
+    fixed : string, optional, default None
+        selection of fixed atoms, flagged 1. Default is the first and last
+        atoms of the protein (all atoms except water).
+    fixed_beyond : float, optional, default None
+        only fix atoms of `fixed` farther than this distance (A) from the
+        alchemical atoms.
+
+    Returns
+    -------
+    alch, fixed : numpy.ndarray
+        B values of all atoms.
+    """
+    top = load_pdb(pdb)
+    n = len(top)
+    selected = top.select(alch)
+    if len(selected) == 0:
+        raise ValueError('No alchemical atoms in %s for selection: %s' % (pdb, alch))
+    alch_beta = np.zeros(n)
+    alch_beta[selected] = 1
+
+    if fixed is None:
+        protein = top.select('not water')
+        candidates = protein[[0, -1]] if len(protein) else protein
+    else:
+        candidates = top.select(fixed)
+    if fixed_beyond is not None:
+        xyz = top.atoms['xyz']
+        far = min_distances(xyz[candidates], xyz[selected]) > fixed_beyond
+        candidates = candidates[far]
+    fixed_beta = np.zeros(n)
+    fixed_beta[candidates] = 1
+    return alch_beta, fixed_beta
+
+
+def create_flags(pdb, **kwargs):
+    """Write <pdb>_alch.pdb and <pdb>_fixed.pdb next to pdb, see flags.
+
+    Returns
+    -------
+    files : list of strings
+        paths of the written files.
+    """
+    base = pdb[:-4]
+    return [write_beta(pdb, base + suffix + '.pdb', values)
+            for suffix, values in zip(SUFFIXES, flags(pdb, **kwargs))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Create _alch.pdb and _fixed.pdb files with '
+                                     'flags in the B column, for many pdb files at once.')
+    parser.add_argument('pdbs',
+                        type=str,
+                        nargs='+',
+                        help='PDB files, e.g. all solvation sizes data/2mx4_p1_s*.pdb. '
+                        'Input files ending in _alch/_fixed are ignored; outputs are overwritten.')
+    parser.add_argument('--alch',
+                        type=str,
+                        default=DEFAULT_ALCH,
+                        help='Selection of alchemical atoms. Default: %s' % DEFAULT_ALCH)
+    parser.add_argument('--fixed',
+                        type=str,
+                        default=None,
+                        help='Selection of fixed atoms. Default: first and last atoms of the protein.')
+    parser.add_argument('--fixed-beyond',
+                        type=float,
+                        default=None,
+                        help='Only fix atoms farther than this distance (A) from the alchemical atoms.')
+    parser.add_argument('--threads',
+                        type=int,
+                        default=None,
+                        help='Number of pdb files processed at the same time. Default: number of cores.')
+
+    args = parser.parse_args()
+
+    pdbs = [pdb for pdb in args.pdbs if not pdb[:-4].endswith(tuple(SUFFIXES))]
+    for pdb in pdbs:
+        if not os.path.exists(pdb):
+            raise IOError('File %s not found.' % pdb)
+
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        results = pool.map(lambda pdb: create_flags(pdb, alch=args.alch, fixed=args.fixed,
+                                                    fixed_beyond=args.fixed_beyond), pdbs)
+        for files in results:
+            for fname in files:
+                print(fname)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,309 @@
+"""Database of measured simulation performance, to predict run times of new jobs.
+
+For every NAMD log recorded, the database keeps the number of atoms, cores,
+host and timestep of the simulation, and its speed in ns/day measured from
+the TIMING: lines of the log. The speed of a new job is predicted by a least
+squares fit of log(ns/day) to log(atoms) and log(cores), using the runs on
+the same host if there are enough of them. jobgen.py --auto uses it to choose
+the time limit, cores and so the queue of new jobs.
+
+Usage: python perfdb.py scan
+       python perfdb.py record p1_s10_run1/namd.stdout
+       python perfdb.py predict data/2mx4_p1_s10.psf --cores 16
+"""
+
+import sys
+import os
+import glob
+import sqlite3
+import time
+import argparse
+import numpy as np
+
+from simeta import LogTail
+
+if sys.version_info[0] < 3:
+    print('Needs python3. Load it using: module load python/3.4.3')
+    sys.exit(0)
+
+
+DB_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'disorder', 'perf.sqlite')
+
+# Core counts predicted by default with `perfdb.py predict`.
+CORE_CHOICES = [1, 4, 8, 16]
+
+# Minimum number of runs to fit a model, and to fit one for a single host.
+MIN_RUNS = 3
+
+SCHEMA = """CREATE TABLE IF NOT EXISTS runs (
+    log TEXT PRIMARY KEY,
+    atoms INTEGER NOT NULL,
+    cores INTEGER NOT NULL,
+    hostname TEXT NOT NULL,
+    timestep REAL NOT NULL,
+    ns_per_day REAL NOT NULL,
+    finished INTEGER NOT NULL,
+    recorded REAL NOT NULL
+)"""
+
+# Bytes at the start of a log with the Info: lines of the NAMD startup.
+HEADER_SIZE = 1 << 18
+
+
+def connect(fname=None):
+    """Return a connection to the database, creating it if needed."""
+    fname = fname or DB_PATH
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    db = sqlite3.connect(fname)
+    db.execute(SCHEMA)
+    return db
+
+
+def parse_log(log):
+    """Return performance of a NAMD log.
+
+    The host is the 'Info: HOSTNAME' line written by the job scripts of
+    jobgen.py before NAMD starts, or '' for older logs.
+
+    Returns
+    -------
+    perf : dict or None
+        atoms, cores, hostname, timestep (fs), ns_per_day and finished, or
+        None if the log has no TIMING lines yet.
+    """
+    perf = {'atoms': 0, 'cores': 1, 'hostname': '', 'timestep': 1.0}
+    with open(log, 'rb') as fp:
+        header = fp.read(HEADER_SIZE)
+    for line in header.splitlines():
+        if not line.startswith(b'Info:'):
+            continue
+        fields = line.split()
+        if len(fields) == 3 and fields[2] == b'ATOMS':
+            perf['atoms'] = int(fields[1])
+        elif line.startswith(b'Info: Running on') and fields[4].startswith(b'processor'):
+            perf['cores'] = int(fields[3])
+        elif line.startswith(b'Info: HOSTNAME'):
+            perf['hostname'] = fields[2].decode('ascii', 'replace') if len(fields) > 2 else ''
+        elif line.startswith(b'Info: TIMESTEP'):
+            perf['timestep'] = float(fields[2])
+
+    tail = LogTail(log)
+    tail.update()
+    if not tail.timing or not perf['atoms']:
+        return None
+    # Median wall time per step, robust to slow startup and load spikes.
+    seconds = np.median([t[2] for t in tail.timing])
+    perf['ns_per_day'] = 86400 / seconds * perf['timestep'] * 1e-6
+    perf['finished'] = tail.finished
+    return perf
+
+
+def record(db, log):
+    """Add (or update) the performance of a NAMD log in the database.
+
+    Returns
+    -------
+    perf : dict or None
+        see parse_log.
+    """
+    perf = parse_log(log)
+    if perf is None:
+        return None
+    with db:
+        db.execute('INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                   (os.path.abspath(log), perf['atoms'], perf['cores'], perf['hostname'],
+                    perf['timestep'], perf['ns_per_day'], int(perf['finished']), time.time()))
+    return perf
+
+
+def scan(db, root):
+    """Record the logs of all run directories under root.
+
+    Returns
+    -------
+    logs : list of strings
+        logs that were recorded.
+    """
+    logs = []
+    for log in sorted(glob.glob(os.path.join(root, '*_run*', 'namd*.stdout'))):
+        if record(db, log) is not None:
+            logs.append(log)
+    return logs
+
+
+def psf_atoms(psf):
+    """Return the number of atoms in a psf file, reading only its header."""
+    with open(psf, 'r') as fp:
+        for line in fp:
+            if line.find('!NATOM') > 0:
+                return int(line.split()[0])
+    raise ValueError('No atoms found in psf file %s' % psf)
+
+
+def _runs(db, hostname=None):
+    """Return (atoms, cores, ns_per_day) of the runs used for predictions.
+
+    These are the runs on `hostname` if there are at least MIN_RUNS of them,
+    otherwise all runs.
+    """
+    rows = []
+    if hostname:
+        rows = db.execute('SELECT atoms, cores, ns_per_day FROM runs WHERE hostname = ?',
+                          (hostname,)).fetchall()
+    if len(rows) < MIN_RUNS:
+        rows = db.execute('SELECT atoms, cores, ns_per_day FROM runs').fetchall()
+    return rows
+
+
+def recorded_cores(db, atoms, hostname=None):
+    """Return the sorted core counts of the runs used to predict the speed of a system.
+
+    Core counts of runs with the same number of atoms are returned if there
+    are any, otherwise those of all runs used for predictions (see predict).
+    """
+    rows = _runs(db, hostname)
+    same = [cores for n, cores, speed in rows if n == atoms]
+    return sorted(set(same or [cores for n, cores, speed in rows]))
+
+
+def predict(db, atoms, cores, hostname=None):
+    """Return predicted speed in ns/day for a system, or None without enough data.
+
+    The speed is assumed to scale as a power of atoms and cores:
+    log(ns/day) = a + b log(atoms) + c log(cores), fitted by least squares.
+    Only runs on `hostname` are used, if there are at least MIN_RUNS of them.
+    A term is dropped from the model when all runs have the same value. If
+    all runs used the same core count, the speed on fewer cores is scaled
+    down linearly and the speed on more cores is not scaled up, so the
+    prediction never overestimates the speed.
+    """
+    rows = _runs(db, hostname)
+    if len(rows) < MIN_RUNS:
+        return None
+    data = np.log(np.array(rows, dtype=float))
+    x = np.log([atoms, cores])
+    columns = [np.ones(len(data))]
+    point = [1.0]
+    for i in range(2):
+        if np.ptp(data[:, i]) > 0:
+            columns.append(data[:, i])
+            point.append(x[i])
+    coef = np.linalg.lstsq(np.column_stack(columns), data[:, 2], rcond=None)[0]
+    speed = float(np.exp(np.dot(coef, point)))
+    if np.ptp(data[:, 1]) == 0:
+        speed *= min(1.0, cores / rows[0][1])
+    return speed
+
+
+def choose_resources(db, atoms, ns, hostname=None, queue_limits=None, margin=1.2, cores=None):
+    """Return time limit and cores for a run of `ns` nanoseconds.
+
+    The job goes in the shortest queue it fits in with some core count. In
+    that queue the core count with the highest ns/day per core is used, so
+    that many runs together get the best throughput. Only core counts of
+    recorded runs are considered (see recorded_cores). If all of them used
+    the same core count, the speed does not tell how it scales with cores,
+    and the requested `cores` are kept.
+
+    Parameters
+    ----------
+    atoms : int
+        number of atoms in the system.
+    ns : float
+        simulated time of the run in ns.
+    hostname : string, optional
+        host the job will run on.
+    queue_limits : dict, optional
+        time limit in seconds of each queue, except the last queue without a
+        limit. Default jobgen.QUEUE_LIMITS.
+    margin : float, optional, default 1.2
+        requested time is the predicted time times margin.
+    cores : int, optional
+        cores requested for the job, used if the recorded runs have a single
+        core count. Default: that core count.
+
+    Returns
+    -------
+    choice : dict or None
+        seconds, cores and ns_per_day (predicted), or None without enough
+        data to predict.
+    """
+    if queue_limits is None:
+        import jobgen
+        queue_limits = jobgen.QUEUE_LIMITS
+    rows = _runs(db, hostname)
+    if len(rows) < MIN_RUNS:
+        return None
+    if len(set(row[1] for row in rows)) == 1:
+        choices = [cores or rows[0][1]]
+    else:
+        choices = recorded_cores(db, atoms, hostname)
+    candidates = []
+    for n in choices:
+        speed = predict(db, atoms, n, hostname)
+        candidates.append({'cores': n, 'ns_per_day': speed,
+                           'seconds': int(np.ceil(ns / speed * 86400 * margin))})
+    limits = sorted(queue_limits.values()) + [np.inf]
+    for limit in limits:
+        fits = [c for c in candidates if c['seconds'] <= limit]
+        if fits:
+            return max(fits, key=lambda c: (c['ns_per_day'] / c['cores'], -c['cores']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Record and predict NAMD simulation performance.')
+    parser.add_argument('--db',
+                        type=str,
+                        default=None,
+                        help='Database file. Default %s' % DB_PATH)
+    subparsers = parser.add_subparsers(dest='command')
+
+    p = subparsers.add_parser('record', help='Record NAMD logs.')
+    p.add_argument('logs', type=str, nargs='+', help='NAMD logs (namd.stdout).')
+
+    p = subparsers.add_parser('scan', help='Record the logs of all run directories.')
+    p.add_argument('root', type=str, nargs='?', default=None,
+                   help='Directory with run directories. Default: jobgen OUTPUT_DIR.')
+
+    p = subparsers.add_parser('predict', help='Predict ns/day of a system.')
+    p.add_argument('psf', type=str, help='PSF file of the system.')
+    p.add_argument('--cores', type=int, nargs='+', default=CORE_CHOICES,
+                   help='Core counts. Default %s.' % ' '.join(str(c) for c in CORE_CHOICES))
+    p.add_argument('--hostname', type=str, default=None, help='Host to predict for.')
+
+    p = subparsers.add_parser('list', help='List recorded runs.')
+
+    args = parser.parse_args()
+    db = connect(args.db)
+
+    if args.command == 'record':
+        for log in args.logs:
+            perf = record(db, log)
+            if perf is None:
+                print('%s: no TIMING lines' % log)
+            else:
+                print('%s: %d atoms, %d cores, %.2f ns/day' % (log, perf['atoms'], perf['cores'],
+                                                               perf['ns_per_day']))
+    elif args.command == 'scan':
+        root = args.root
+        if root is None:
+            import jobgen
+            root = jobgen.OUTPUT_DIR
+        for log in scan(db, root):
+            print(log)
+    elif args.command == 'predict':
+        atoms = psf_atoms(args.psf)
+        for cores in args.cores:
+            speed = predict(db, atoms, cores, args.hostname)
+            if speed is None:
+                raise ValueError('Need at least %d recorded runs to predict.' % MIN_RUNS)
+            print('%d atoms, %d cores: %.2f ns/day' % (atoms, cores, speed))
+    elif args.command == 'list':
+        for row in db.execute('SELECT * FROM runs ORDER BY hostname, atoms, cores'):
+            print('\t'.join(str(v) for v in row))
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,22 @@
-"""Script to estimate completion time for a vmd simulation."""
+"""Script to estimate completion time for a vmd simulation.
+
+The NAMD log is followed incrementally: only the bytes written since the
+last poll are read, and a new log is read from a bounded tail before its end,
+so a poll costs the same on a multi-GB log as on a small one.
+
+With --monitor, all run directories (<pdb>_run<n><suffix>, see
+jobgen.get_rundir) under the output directory are followed at once, and a
+table with the progress, speed and ETA of every run is printed on each poll.
+The number of steps of each run is taken from the fep files in its directory.
+
+Usage: python simeta.py -f p1_s10_run1/namd.stdout
+       python simeta.py --monitor
+"""
 
 import sys
 import argparse
+import asyncio
+import glob
 import time
 import os
 import numpy as np
@@ -11,13 +26,252 @@ if sys.version_info[0] < 3:
     sys.exit(0)
 
 
+# Bytes before the end of the log read when it is first opened.
+BACKLOG = 1 << 20
+
+# Seconds without log output after which a program is not counted as running.
+STALE = 15 * 60
+
+
+class LogTail(object):
+    """Follow a NAMD log, parsing new lines each time it is updated.
+
+    Attributes
+    ----------
+    step : int
+        last step in a WRITING COORDINATES line, or -1.
+    last_step : int
+        last step in any ENERGY:, TIMING: or WRITING COORDINATES line, or -1.
+    energy : dict
+        values of the last ENERGY: line by ETITLE column name.
+    timing : list of tuples
+        (step, wall seconds, wall seconds per step) of TIMING: lines.
+    """
+
+    def __init__(self, fname, backlog=BACKLOG):
+        self.fname = fname
+        self.backlog = backlog
+        self.offset = None
+        self.buffer = b''
+        self.titles = None
+        self.step = -1
+        self.last_step = -1
+        self.energy = {}
+        self.timing = []
+        self.finished = False
+
+    def update(self):
+        """Read and parse lines written since the last update.
+
+        Returns
+        -------
+        n : int
+            number of complete lines parsed.
+        """
+        with open(self.fname, 'rb') as fp:
+            fp.seek(0, os.SEEK_END)
+            size = fp.tell()
+            if self.offset is None or size < self.offset:
+                # New or truncated log: start close to its end, at a line start.
+                self.offset = max(0, size - self.backlog)
+                self.buffer = b''
+                if self.offset > 0:
+                    fp.seek(self.offset - 1)
+                    skip = fp.readline()
+                    self.offset += len(skip) - 1
+            fp.seek(self.offset)
+            data = fp.read(size - self.offset)
+        self.offset += len(data)
+        data = self.buffer + data
+        end = data.rfind(b'\n') + 1
+        lines, self.buffer = data[:end].splitlines(), data[end:]
+        for line in lines:
+            self.parse(line)
+        return len(lines)
+
+    def parse(self, line):
+        """Parse one line of the log."""
+        if line.startswith(b'WRITING COORDINATES'):
+            self.step = int(line.split()[-1])
+            self.last_step = max(self.last_step, self.step)
+        elif line.startswith(b'ETITLE:'):
+            self.titles = line.decode('ascii', 'replace').split()[1:]
+        elif line.startswith(b'ENERGY:'):
+            fields = line.split()[1:]
+            if self.titles and len(fields) == len(self.titles):
+                self.energy = dict(zip(self.titles, [float(v) for v in fields]))
+            self.last_step = max(self.last_step, int(fields[0]))
+        elif line.startswith(b'WallClock:'):
+            # Printed by NAMD when the program ends.
+            self.finished = True
+        elif line.startswith(b'TIMING:'):
+            # TIMING: 5000  CPU: 1234.5, 0.24/step  Wall: 1240.2, 0.24/step, ...
+            fields = line.replace(b',', b' ').split()
+            wall = fields.index(b'Wall:')
+            step = int(fields[1])
+            self.timing.append((step, float(fields[wall+1]), float(fields[wall+2].split(b'/')[0])))
+            self.last_step = max(self.last_step, step)
+
+    def speed(self):
+        """Return steps/sec from the last two TIMING lines, or None."""
+        if len(self.timing) < 2:
+            return None
+        (s0, w0, _), (s1, w1, _) = self.timing[-2:]
+        if w1 <= w0:
+            return None
+        return (s1 - s0) / (w1 - w0)
+
+
+class Segment(object):
+    """A NAMD program of a run: its fep file and the log it writes.
+
+    Attributes
+    ----------
+    work : int
+        number of steps of the program, including minimization.
+    firststep : int
+        step number at the start of the program (firsttimestep).
+    timestep : float
+        timestep in fs.
+    """
+
+    def __init__(self, fep, log):
+        import jobgen
+
+        with open(fep, 'r') as fp:
+            lines = fp.readlines()
+        program = jobgen.parse_program(lines)
+        self.fep = fep
+        self.tail = LogTail(log)
+        self.work = sum(jobgen._steps(line.strip()) for line in program['minimize'])
+        self.work += sum(steps for window, steps in program['pieces'])
+        self.firststep = 0
+        for line in program['config']:
+            if line.strip().startswith('firsttimestep'):
+                self.firststep = jobgen._steps(line.strip())
+        self.timestep = jobgen.timestep(lines)
+        # (step, log modification time) when the log advanced, for logs without TIMING lines.
+        self.samples = []
+
+    def update(self):
+        if os.path.exists(self.tail.fname):
+            self.tail.update()
+            step = self.tail.last_step
+            if step >= 0 and (not self.samples or step != self.samples[-1][0]):
+                self.samples = self.samples[-5:] + [(step, os.path.getmtime(self.tail.fname))]
+
+    @property
+    def done(self):
+        """Steps done, between 0 and work."""
+        if self.tail.finished:
+            return self.work
+        return min(self.work, max(0, self.tail.last_step - self.firststep))
+
+    @property
+    def speed(self):
+        """Steps/sec of a running program, 0 if it is not running."""
+        if self.tail.finished or not self.samples or time.time() - self.samples[-1][1] > STALE:
+            return 0.0
+        speed = self.tail.speed()
+        if speed is None:
+            speed = _speeds(self.samples)
+            speed = speed.mean() if len(speed) else 0.0
+        return speed
+
+
+def run_segments(rundir):
+    """Return the segments of a run directory.
+
+    A run is either fep.tcl writing namd.stdout, or segments fep_<tag>.tcl
+    writing namd.<tag>.stdout (jobgen --chain and --fep-windows modes), in
+    numeric order of the tags (seg2 before seg10).
+    """
+    def order(fep):
+        tag = os.path.basename(fep)[len('fep_'):-len('.tcl')]
+        name = tag.rstrip('0123456789')
+        return name, int(tag[len(name):] or -1)
+
+    segments = []
+    for fep in sorted(glob.glob(os.path.join(rundir, 'fep_*.tcl')), key=order):
+        tag = os.path.basename(fep)[len('fep_'):-len('.tcl')]
+        segments.append(Segment(fep, os.path.join(rundir, 'namd.%s.stdout' % tag)))
+    if not segments and os.path.exists(os.path.join(rundir, 'fep.tcl')):
+        segments.append(Segment(os.path.join(rundir, 'fep.tcl'), os.path.join(rundir, 'namd.stdout')))
+    return segments
+
+
+def discover_runs(root=None):
+    """Return segments of every run directory under root, by run directory name.
+
+    Default root is jobgen.OUTPUT_DIR.
+    """
+    if root is None:
+        import jobgen
+        root = jobgen.OUTPUT_DIR
+    runs = {}
+    for rundir in sorted(glob.glob(os.path.join(root, '*_run*'))):
+        if os.path.isdir(rundir) and not rundir.endswith('.bak'):
+            segments = run_segments(rundir)
+            if segments:
+                runs[os.path.basename(rundir)] = segments
+    return runs
+
+
+async def poll(runs):
+    """Update the logs of all runs concurrently."""
+    loop = asyncio.get_running_loop()
+    await asyncio.gather(*[loop.run_in_executor(None, segment.update)
+                           for segments in runs.values() for segment in segments])
+
+
+def status(segments):
+    """Return (done steps, total steps, steps/sec, ns/day, ETA in hours) of a run."""
+    done = sum(s.done for s in segments)
+    work = sum(s.work for s in segments)
+    speed = sum(s.speed for s in segments)
+    ns_per_day = sum(s.speed * s.timestep for s in segments) * 86400 / 1e6
+    eta = (work - done) / speed / 3600 if speed > 0 else np.inf
+    return done, work, speed, ns_per_day, eta
+
+
+def format_table(runs):
+    """Return a table with the status of every run."""
+    rows = ['%-32s %12s %12s %7s %10s %8s %10s' % ('run', 'step', 'total', '%', 'steps/s',
+                                                    'ns/day', 'ETA (h)')]
+    for name, segments in sorted(runs.items()):
+        done, work, speed, ns_per_day, eta = status(segments)
+        if done >= work:
+            eta = 'done'
+        elif np.isinf(eta):
+            eta = 'waiting'
+        else:
+            eta = '%.2f' % eta
+        rows.append('%-32s %12d %12d %7.1f %10.2f %8.2f %10s' % (name, done, work, 100.0 * done / max(work, 1),
+                                                                speed, ns_per_day, eta))
+    return '\n'.join(rows)
+
+
+async def monitor(root=None, interval=10, once=False):
+    """Print the status of all runs under root every interval seconds."""
+    runs = discover_runs(root)
+    if not runs:
+        raise IOError('No run directories found in %s' % (root or 'the output directory'))
+    while True:
+        start = time.time()
+        await poll(runs)
+        print(time.strftime('%Y-%m-%d %H:%M:%S'))
+        print(format_table(runs))
+        print()
+        if once or all(status(segments)[0] >= status(segments)[1] for segments in runs.values()):
+            break
+        await asyncio.sleep(max(0, interval - (time.time() - start)))
+
+
 def steps(file):
-    with open(file, 'r') as fp:
-        for line in fp:
-            pass
-    if not line.startswith('WRITING COORDINATES'):
-        return -1
-    return int(line.strip().split()[-1])
+    """Return step of the last WRITING COORDINATES line, or -1."""
+    tail = LogTail(file)
+    tail.update()
+    return tail.step
 
 
 def main():
@@ -26,35 +280,89 @@ def main():
     parser.add_argument('-f', '--file',
                         type=str,
                         dest='outfile',
-                        required=True,
+                        default=None,
                         help='VMD namd.stdout')
+    parser.add_argument('--monitor',
+                        action='store_true',
+                        help='Monitor all run directories in the output directory (or --root).')
+    parser.add_argument('--root',
+                        type=str,
+                        default=None,
+                        help='Directory with run directories, for --monitor. Default: jobgen OUTPUT_DIR.')
+    parser.add_argument('--once',
+                        action='store_true',
+                        help='With --monitor, print the table once and exit.')
+    parser.add_argument('--steps',
+                        type=int,
+                        default=None,
+                        help='Total number of steps of the simulation. Default: steps in fep.tcl '
+                        'next to the log if it exists, else 1e7 (10 ns).')
+    parser.add_argument('--follow',
+                        action='store_true',
+                        help='Keep monitoring the log and print a new estimate on every update.')
+    parser.add_argument('--interval',
+                        type=float,
+                        default=10,
+                        help='Seconds between polls of the log. Default 10.')
 
     args = parser.parse_args()
 
+    if args.monitor:
+        asyncio.run(monitor(args.root, args.interval, args.once))
+        return
+
+    if args.outfile is None:
+        parser.error('-f/--file is required without --monitor')
     if not os.path.exists(args.outfile):
         raise IOError('File %s not found.' % args.outfile)
 
+    if args.steps is None:
+        fep = os.path.join(os.path.dirname(args.outfile), 'fep.tcl')
+        args.steps = Segment(fep, args.outfile).work if os.path.exists(fep) else int(1e7)
+
+    tail = LogTail(args.outfile)
+    tail.update()
+    if tail.speed() is not None and not args.follow:
+        # NAMD already reports wall time per step, no need to wait.
+        report(tail.last_step, np.array([tail.speed()]), args.steps)
+        return
+
     print('Computing estimated time for simulation. Might take 2-3 minutes.')
     N = 6
-    data = np.zeros((N, 2))
-    data[0] = steps(args.outfile), time.time()
-    j = 1
-    while j < N:
-        n, t = steps(args.outfile), time.time()
-        if n > 0 and n != data[j-1, 0]:
-            data[j] = n, t
-            j += 1
-        time.sleep(10)
+    data = [(tail.step, time.time())] if tail.step > 0 else []
+    while args.follow or len(data) < N:
+        time.sleep(args.interval)
+        new = tail.update()
+        n, t = tail.step, time.time()
+        if n > 0 and (not data or n != data[-1][0]):
+            data.append((n, t))
+            data = data[-N:]
+        if args.follow and new:
+            speed = _speeds(data) if tail.speed() is None else np.array([tail.speed()])
+            if len(speed):
+                report(tail.last_step, speed, args.steps)
+
+    report(tail.last_step, _speeds(data), args.steps)
 
+
+def _speeds(data):
+    if len(data) < 2:
+        return np.zeros(0)
+    data = np.array(data, dtype=float)
     diff = data[1:] - data[:-1]
-    speed = diff[:,0] / diff[:,1]
+    return diff[:, 0] / diff[:, 1]
+
 
+def report(step, speed, total):
     print('Simulation speed: %.3f (+/- %.3f) steps/sec' % (speed.mean(), speed.std()))
 
-    eta_seconds = 1e7 / speed  # 1e7 = 10 ns
+    eta_seconds = total / speed
     eta = eta_seconds / 60 / 60 / 24  # eta in days.
 
-    print('Estimated time of 10 nsec: %.3f (+/- %.3f) days' % (eta.mean(), eta.std()))
+    print('Estimated time of %d steps: %.3f (+/- %.3f) days' % (total, eta.mean(), eta.std()))
+    if step > 0:
+        remaining = max(0, total - step) / speed / 60 / 60
+        print('Step %d, remaining: %.2f (+/- %.2f) hours' % (step, remaining.mean(), remaining.std()))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,277 @@
+"""Statistics of measurement series: correlation times, standard errors and equilibration.
+
+All functions take a 2D array with one series per row (e.g. every quantity
+of every run) and compute their result for all rows at once.
+
+- autocorrelation: normalized autocorrelation function, using FFT.
+- statistical_inefficiency: g = 1 + 2 sum of the autocorrelation, summed
+  up to an automatically chosen window (Sokal). N / g samples are effectively
+  independent.
+- block_standard_error: standard error of the mean from block averages.
+- detect_equilibration: the start frame that maximizes the number of
+  effectively independent samples after it (Chodera, JCTC 2016). Frames
+  before it are discarded as equilibration.
+
+Frames written every 100 fs are dominated by fast vibrations, and the
+autocorrelation window stops before the slow conformational decorrelation.
+So by default equilibration detection estimates g from block averages
+instead (block_inefficiency), which does not depend on such a window.
+
+Usage: python stats.py measurements/2mx4_p1_s8 measurements/2mx4_up1_s8 --names bond3
+"""
+
+import sys
+import argparse
+import numpy as np
+
+if sys.version_info[0] < 3:
+    print('Needs python3. Load it using: module load python/3.4.3')
+    sys.exit(0)
+
+
+def _rows(x):
+    x = np.asarray(x, dtype=np.float64)
+    return x[None] if x.ndim == 1 else x
+
+
+def autocorrelation(x):
+    """Return normalized autocorrelation functions of rows of x.
+
+    Parameters
+    ----------
+    x : numpy.ndarray
+        series, shape (n_series, n) or (n,).
+
+    Returns
+    -------
+    rho : numpy.ndarray
+        autocorrelation at lags 0 ... n-1, rho[:, 0] = 1, same shape as x.
+    """
+    single = np.ndim(x) == 1
+    x = _rows(x)
+    n = x.shape[1]
+    dx = x - x.mean(axis=1, keepdims=True)
+    # Zero padding to 2n avoids the circular wrap around of the FFT.
+    size = 1 << int(np.ceil(np.log2(2 * n)))
+    f = np.fft.rfft(dx, n=size, axis=1)
+    acov = np.fft.irfft(f * np.conj(f), n=size, axis=1)[:, :n]
+    # Unbiased: lag t has n - t pairs.
+    acov /= np.arange(n, 0, -1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rho = acov / acov[:, :1]
+    rho[~np.isfinite(rho)] = 0
+    return rho[0] if single else rho
+
+
+def statistical_inefficiency(x, c=5.0):
+    """Return statistical inefficiencies g of rows of x.
+
+    g = 1 + 2 sum_{t=1}^{M} rho(t), with the smallest window M >= c g(M)
+    (Sokal's automatic windowing), which stops summing once the noise of
+    rho(t) dominates.
+
+    Returns
+    -------
+    g : numpy.ndarray
+        shape (n_series,), or float for a 1D x. g >= 1.
+    """
+    single = np.ndim(x) == 1
+    rho = autocorrelation(_rows(x))
+    n = rho.shape[1]
+    g = 1 + 2 * np.cumsum(rho[:, 1:], axis=1)
+    windows = np.arange(1, n)
+    ok = windows[None, :] >= c * g
+    # First window satisfying the condition, or the last one if none does.
+    m = np.where(ok.any(axis=1), ok.argmax(axis=1), n - 2)
+    g = np.maximum(1.0, g[np.arange(len(g)), m]) if n > 1 else np.ones(len(rho))
+    return g[0] if single else g
+
+
+def correlation_time(x, dt=1.0, c=5.0):
+    """Return integrated correlation times (g - 1) / 2 * dt of rows of x."""
+    return (statistical_inefficiency(x, c) - 1) / 2 * dt
+
+
+def block_standard_error(x, min_blocks=16):
+    """Return standard errors of the mean of rows of x from block averages.
+
+    The series are split in blocks of 1, 2, 4, ... frames. The standard error
+    of the block means grows with the block size until the blocks are longer
+    than the correlation time, then it stays the same. The largest standard
+    error over block sizes with at least min_blocks blocks is returned.
+
+    Returns
+    -------
+    se : numpy.ndarray
+        shape (n_series,), or float for a 1D x.
+    sizes : numpy.ndarray
+        block sizes.
+    errors : numpy.ndarray
+        standard error for each block size, shape (n_series, n_sizes).
+    """
+    single = np.ndim(x) == 1
+    x = _rows(x)
+    n = x.shape[1]
+    sizes = []
+    errors = []
+    size = 1
+    while n // size >= max(2, min_blocks):
+        nblocks = n // size
+        means = x[:, :nblocks * size].reshape(len(x), nblocks, size).mean(axis=2)
+        sizes.append(size)
+        errors.append(means.std(axis=1, ddof=1) / np.sqrt(nblocks))
+        size *= 2
+    if not sizes:
+        raise ValueError('Series of %d frames are too short for %d blocks.' % (n, min_blocks))
+    errors = np.array(errors).T
+    se = errors.max(axis=1)
+    return (se[0] if single else se), np.array(sizes), errors
+
+
+def block_inefficiency(x, min_blocks=16):
+    """Return statistical inefficiencies g = n se^2 / var of rows of x from block standard errors."""
+    single = np.ndim(x) == 1
+    x = _rows(x)
+    se = block_standard_error(x, min_blocks)[0]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        g = x.shape[1] * se ** 2 / x.var(axis=1, ddof=1)
+    g = np.maximum(1.0, np.nan_to_num(g, nan=1.0))
+    return g[0] if single else g
+
+
+def detect_equilibration(x, n_starts=50, method='blocks'):
+    """Return the equilibration end of rows of x.
+
+    For candidate start frames t0, the number of effectively independent
+    samples after t0 is (n - t0) / g(x[t0:]). The t0 maximizing it is the end
+    of equilibration: earlier frames bias the mean more than they reduce its
+    variance.
+
+    Parameters
+    ----------
+    n_starts : int, optional, default 50
+        number of candidate start frames, evenly spaced over the first 90%
+        of the series.
+    method : string, optional, default blocks
+        estimate g with block_inefficiency (blocks) or
+        statistical_inefficiency (acf).
+
+    Returns
+    -------
+    t0 : numpy.ndarray
+        equilibration end frame (index) of each row.
+    g : numpy.ndarray
+        statistical inefficiency after t0.
+    n_eff : numpy.ndarray
+        number of effectively independent samples after t0.
+    """
+    single = np.ndim(x) == 1
+    x = _rows(x)
+    n = x.shape[1]
+    starts = np.unique(np.linspace(0, int(0.9 * n), n_starts).astype(int))
+    if method == 'blocks':
+        # Keep enough frames after the last start for the block averages.
+        starts = starts[n - starts >= 32]
+    inefficiency = {'blocks': block_inefficiency, 'acf': statistical_inefficiency}[method]
+    g = np.array([inefficiency(x[:, t0:]) for t0 in starts]).T
+    n_eff = (n - starts)[None, :] / g
+    best = n_eff.argmax(axis=1)
+    rows = np.arange(len(x))
+    out = starts[best], g[rows, best], n_eff[rows, best]
+    return tuple(v[0] for v in out) if single else out
+
+
+def summarize(x, n_starts=50, min_blocks=16, method='blocks'):
+    """Return statistics of rows of x after their equilibration.
+
+    Returns
+    -------
+    stats : dict
+        arrays with one value per row: 't0' (equilibration end), 'mean',
+        'se' (block standard error), 'g' and 'n_eff' after t0.
+    """
+    x = _rows(x)
+    t0, g, n_eff = detect_equilibration(x, n_starts, method)
+    mean = np.empty(len(x))
+    se = np.empty(len(x))
+    # Rows with the same start are analysed together.
+    for start in np.unique(t0):
+        rows = t0 == start
+        mean[rows] = x[rows, start:].mean(axis=1)
+        se[rows] = block_standard_error(x[rows, start:], min_blocks)[0]
+    return {'t0': t0, 'mean': mean, 'se': se, 'g': g, 'n_eff': n_eff}
+
+
+def load_series(sources, names, stop=None):
+    """Return series of many runs, grouped by length.
+
+    Parameters
+    ----------
+    sources : list of strings
+        csv prefixes or store files of runs, see loader.populate_df.
+    names : list of strings
+        series names.
+    stop : int, optional
+        only load frames before stop.
+
+    Returns
+    -------
+    groups : list of (labels, frames, x)
+        labels (source, name) of the rows of x, frame numbers, and the 2D
+        array of series with the same frames.
+    """
+    from loader import populate_df
+    from store import EXTENSION
+
+    groups = {}
+    for source in sources:
+        prefix = source[:-len(EXTENSION)] if source.endswith(EXTENSION) else source
+        df = populate_df(prefix, usecols=names, stop=stop).dropna()
+        key = (len(df), df.index[0] if len(df) else 0)
+        labels, frames, rows = groups.setdefault(key, ([], df.index.values, []))
+        for name in names:
+            labels.append((source, name))
+            rows.append(df[name].values)
+    return [(labels, frames, np.array(rows)) for labels, frames, rows in groups.values()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Equilibration, correlation time and standard '
+                                     'error of measurement series of many runs.')
+    parser.add_argument('sources',
+                        type=str,
+                        nargs='+',
+                        help='csv prefixes or measurement stores of runs.')
+    parser.add_argument('--names',
+                        type=str,
+                        nargs='+',
+                        required=True,
+                        help='Series to analyse, e.g. bond3.')
+    parser.add_argument('--stop',
+                        type=int,
+                        default=None,
+                        help='Only use frames before stop.')
+    parser.add_argument('--tolerance',
+                        type=float,
+                        default=None,
+                        help='Report a run as converged when the standard error of all its '
+                        'series is below this.')
+
+    args = parser.parse_args()
+
+    print('%-40s %-8s %10s %10s %10s %10s %10s' % ('source', 'series', 'equil', 'mean', 'se', 'g', 'n_eff'))
+    converged = {}
+    for labels, frames, x in load_series(args.sources, args.names, args.stop):
+        s = summarize(x)
+        for i, (source, name) in enumerate(labels):
+            print('%-40s %-8s %10d %10.4f %10.4f %10.1f %10.1f' % (source, name, frames[s['t0'][i]],
+                                                                  s['mean'][i], s['se'][i], s['g'][i],
+                                                                  s['n_eff'][i]))
+            if args.tolerance is not None:
+                converged[source] = converged.get(source, True) and s['se'][i] < args.tolerance
+    for source, ok in sorted(converged.items()):
+        print('%s: %s' % (source, 'converged' if ok else 'not converged'))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+"""Columnar, memory-mappable store for per-frame measurements of a run.
+
+A store file holds every measured quantity of one run: a shared int64 frame
+column, one float32 column per quantity and metadata such as the run name,
+timestep and dcdfreq. Columns are laid out one after the other, so opening a
+store only reads its small header and any column is a zero-copy np.memmap.
+
+Layout: 8 byte magic, 8 byte little-endian header size, a JSON header, then
+the frame column and the quantity columns, each aligned to 64 bytes. Column
+offsets in the header are relative to the end of the (aligned) header.
+
+Usage: python store.py import --prefix measurements/p1_s10 --run 2mx4_p1_s10_run1_c1
+       python store.py info measurements/p1_s10.mstore
+"""
+
+import sys
+import os
+import json
+import argparse
+import numpy as np
+
+if sys.version_info[0] < 3:
+    print('Needs python3. Load it using: module load python/3.4.3')
+    sys.exit(0)
+
+
+MAGIC = b'DISMEAS1'
+ALIGN = 64
+EXTENSION = '.mstore'
+
+# Defaults from the template tcl files: timestep 1 fs, dcdfreq 100.
+DEFAULT_META = {'run': '', 'timestep': 1.0, 'dcdfreq': 100}
+
+
+def _aligned(offset):
+    return (offset + ALIGN - 1) // ALIGN * ALIGN
+
+
+def write_store(fname, frames, series, **meta):
+    """Write measurements of a run to a store file.
+
+    Parameters
+    ----------
+    fname : string
+        path of the store file. It is replaced if it exists.
+    frames : array of ints
+        frame numbers, shared by all series.
+    series : dict
+        array of values for each quantity name, each as long as `frames`.
+        Values are stored as float32.
+    meta : optional
+        metadata to store, e.g. run, timestep (fs) and dcdfreq.
+        Values must be JSON serializable.
+    """
+    frames = np.asarray(frames, dtype='<i8')
+    n = len(frames)
+    names = list(series)
+    for name in names:
+        if len(series[name]) != n:
+            raise ValueError('Series %s has %d values, expected %d.' % (name, len(series[name]), n))
+
+    info = dict(DEFAULT_META)
+    info.update(meta)
+    # Column offsets are relative to the start of the data, which is the
+    # first aligned position after the header.
+    header = {'meta': info, 'n_frames': n, 'frame': {'dtype': '<i8', 'offset': 0}, 'columns': []}
+    offset = _aligned(8 * n)
+    for name in names:
+        header['columns'].append({'name': name, 'dtype': '<f4', 'offset': offset})
+        offset = _aligned(offset + 4 * n)
+    data = json.dumps(header, sort_keys=True).encode('utf-8')
+    start = _aligned(len(MAGIC) + 8 + len(data))
+
+    # Write to a temporary file first so readers never see a partial store.
+    tmp = '%s.%d.tmp' % (fname, os.getpid())
+    with open(tmp, 'wb') as fp:
+        fp.write(MAGIC)
+        fp.write(np.array([len(data)], dtype='<u8').tobytes())
+        fp.write(data)
+        columns = [(header['frame'], frames)]
+        columns += [(c, np.asarray(series[c['name']], dtype='<f4')) for c in header['columns']]
+        for column, values in columns:
+            fp.write(b'\0' * (start + column['offset'] - fp.tell()))
+            fp.write(values.tobytes())
+    os.replace(tmp, fname)
+    return fname
+
+
+class MeasurementStore(object):
+    """A store file opened for reading.
+
+    Parameters
+    ----------
+    fname : string
+        path of the store file.
+
+    Attributes
+    ----------
+    meta : dict
+        metadata of the run.
+    columns : list of strings
+        names of the stored quantities.
+    frames : numpy.ndarray
+        int64 view of the frame numbers.
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        with open(fname, 'rb') as fp:
+            if fp.read(len(MAGIC)) != MAGIC:
+                raise ValueError('File %s is not a measurement store.' % fname)
+            size = int(np.frombuffer(fp.read(8), dtype='<u8')[0])
+            header = json.loads(fp.read(size).decode('utf-8'))
+        self._start = _aligned(len(MAGIC) + 8 + size)
+        self.meta = header['meta']
+        self.n_frames = header['n_frames']
+        self._columns = {c['name']: c for c in header['columns']}
+        self.columns = [c['name'] for c in header['columns']]
+        if os.path.getsize(fname) > 0 and self.n_frames > 0:
+            self._mmap = np.memmap(fname, dtype=np.uint8, mode='r')
+        else:
+            self._mmap = np.zeros(0, dtype=np.uint8)
+        self.frames = self._view(header['frame'])
+
+    def _view(self, column):
+        if self.n_frames == 0:
+            return np.zeros(0, dtype=column['dtype'])
+        return np.ndarray(shape=(self.n_frames,), dtype=column['dtype'],
+                          buffer=self._mmap, offset=self._start + column['offset'])
+
+    def __len__(self):
+        return self.n_frames
+
+    def __contains__(self, name):
+        return name in self._columns
+
+    def __getitem__(self, name):
+        """Return a float32 view of the values of a quantity."""
+        if name not in self._columns:
+            raise KeyError('No quantity %s in %s' % (name, self.fname))
+        return self._view(self._columns[name])
+
+    @property
+    def time(self):
+        """Time of each frame in nanoseconds."""
+        return self.frames * (self.meta['dcdfreq'] * self.meta['timestep'] * 1e-6)
+
+    def to_dataframe(self, columns=None):
+        """Return a pandas DataFrame indexed by frame, like populate_df in plots.ipynb."""
+        import pandas as pd
+        columns = columns or self.columns
+        df = pd.DataFrame({name: self[name] for name in columns}, columns=columns,
+                          index=pd.Index(self.frames, name='frame'))
+        return df
+
+
+def import_csvs(prefix, fname=None, **meta):
+    """Import all <prefix>_<name>.csv files into a single store.
+
+    Series are aligned on the union of their frames, missing values are NaN.
+    Runs measured in start and end parts are stitched, see loader.populate_df.
+
+    Parameters
+    ----------
+    prefix : string
+        prefix of the csv files, as used by populate_df in plots.ipynb.
+    fname : string, optional, default None
+        path of the store file. Default is <prefix>.mstore
+    meta : optional
+        metadata for the store, see write_store.
+
+    Returns
+    -------
+    fname : string
+        path of the store file.
+    """
+    # Imported here, loader depends on this module and pandas.
+    from loader import populate_df
+    df = populate_df(prefix, store=False)
+    series = {name: df[name].values for name in df.columns}
+    frames = df.index.values
+
+    meta.setdefault('run', os.path.basename(prefix))
+    return write_store(fname or prefix + EXTENSION, frames, series, **meta)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Create and inspect measurement stores.')
+    subparsers = parser.add_subparsers(dest='command')
+
+    importer = subparsers.add_parser('import', help='Import <prefix>_*.csv files into a store.')
+    importer.add_argument('--prefix',
+                          type=str,
+                          required=True,
+                          nargs='+',
+                          help='Prefix of the csv files. Several prefixes can be given.')
+    importer.add_argument('--run',
+                          type=str,
+                          default=None,
+                          help='Run name. Default: basename of the prefix.')
+    importer.add_argument('--timestep',
+                          type=float,
+                          default=DEFAULT_META['timestep'],
+                          help='Timestep in fs. Default %s.' % DEFAULT_META['timestep'])
+    importer.add_argument('--dcdfreq',
+                          type=int,
+                          default=DEFAULT_META['dcdfreq'],
+                          help='Timesteps between frames. Default %s.' % DEFAULT_META['dcdfreq'])
+
+    info = subparsers.add_parser('info', help='Print metadata and quantities in stores.')
+    info.add_argument('stores',
+                      type=str,
+                      nargs='+',
+                      help='Store files.')
+
+    args = parser.parse_args()
+
+    if args.command == 'import':
+        for prefix in args.prefix:
+            meta = {'timestep': args.timestep, 'dcdfreq': args.dcdfreq}
+            if args.run:
+                meta['run'] = args.run
+            print(import_csvs(prefix, **meta))
+    elif args.command == 'info':
+        for fname in args.stores:
+            store = MeasurementStore(fname)
+            print('%s: %d frames, %s' % (fname, len(store), ' '.join(store.columns)))
+            print('  %s' % json.dumps(store.meta, sort_keys=True))
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
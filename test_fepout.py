@@ -0,0 +1,89 @@
+"""Tests of the fepout parser and free-energy estimators of fepout.py."""
+
+import numpy as np
+
+import fepout
+
+LINE = '%s %6d %14.4f %14.4f %14.4f %14.4f %14.4f %14.4f %14.4f %14.4f\n'
+
+
+def fep_window(lambdas, forward, backward=None, idws=None, equil=0, first=0):
+    """Return the text of one window of a fepout file, as written by NAMD.
+
+    forward and backward are the dE of the collected samples, `equil`
+    samples of 1000 kcal/mol come before the collection starts.
+    """
+    header = '#NEW FEP WINDOW: LAMBDA SET TO %g LAMBDA2 %g' % lambdas
+    if idws is not None:
+        header += ' LAMBDA_IDWS %g' % idws
+    out = [header + '\n']
+    step = first
+    for i in range(equil):
+        step += 5
+        out.append(LINE % ('FepEnergy:', step, 0, 0, 0, 0, 1000.0, 0, 298.15, 0))
+    out.append('#STARTING COLLECTION OF ENSEMBLE AVERAGE AT STEP %d\n' % step)
+    for i, dE in enumerate(forward):
+        step += 5
+        out.append(LINE % ('FepEnergy:', step, 0, 0, 0, 0, dE, 0, 298.15, 0))
+        if backward is not None:
+            out.append(LINE % ('FepE_back:', step, 0, 0, 0, 0, backward[i], 0, 298.15, 0))
+    out.append('#Free energy change for lambda window [ %g %g ] is 0.0 ; net change until now is 0.0\n'
+               % lambdas)
+    return ''.join(out)
+
+
+def write(fname, windows):
+    with open(fname, 'w') as f:
+        f.write('#            STEP                 Elec                            vdW'
+                '                    dE           dE_avg         Temp             dG\n')
+        f.write(''.join(windows))
+    return fname
+
+
+def test_split_window_is_merged(tmp_path):
+    rng = np.random.default_rng(1)
+    dE = [rng.normal(0.5 * i, 0.8, 400) for i in range(3)]
+    lambdas = [(0, 0.5), (0.5, 1), (1, 1)]
+    whole = write(str(tmp_path / 'whole.fepout'),
+                  [fep_window(lam, x, equil=20) for lam, x in zip(lambdas, dE)])
+    # The middle window continued in the next segment of a chain, repeating
+    # the equilibration.
+    split = write(str(tmp_path / 'split.fepout'),
+                  [fep_window(lambdas[0], dE[0], equil=20),
+                   fep_window(lambdas[1], dE[1][:150], equil=20),
+                   fep_window(lambdas[1], dE[1][150:], equil=20),
+                   fep_window(lambdas[2], dE[2], equil=20)])
+
+    windows = fepout.read_fepout(split)
+    assert [w['lambda'] for w in windows] == lambdas
+    assert np.allclose(windows[1]['forward'][:, 5], dE[1], atol=1e-4)
+    assert np.isclose(fepout.analyze(split, nboot=5)['EXP'][0],
+                      fepout.analyze(whole, nboot=5)['EXP'][0])
+
+
+def test_estimators_recover_gaussian_free_energy(tmp_path):
+    # Gaussian forward works with mean mu and variance s2 (kT) have
+    # dG = mu - s2 / 2, and the backward works of the next window follow
+    # from the Crooks relation: mean s2 - mu, same variance.
+    kT = fepout.BOLTZMANN * fepout.TEMPERATURE
+    rng = np.random.default_rng(2)
+    mu = [1.0, -0.5, 0.8]
+    s2 = [0.5, 0.8, 0.3]
+    n = 20000
+    lambdas = [(0, 1/3), (1/3, 2/3), (2/3, 1)]
+    forward = [rng.normal(m, np.sqrt(v), n) for m, v in zip(mu, s2)]
+    backward = [None] + [rng.normal(v - m, np.sqrt(v), n) for m, v in zip(mu[:-1], s2[:-1])]
+    windows = [fep_window(lambdas[0], kT * forward[0], equil=50)]
+    for i in range(1, 3):
+        windows.append(fep_window(lambdas[i], kT * forward[i], kT * backward[i],
+                                  idws=lambdas[i - 1][0], equil=50))
+    fname = write(str(tmp_path / 'gauss.fepout'), windows)
+
+    expected = kT * sum(m - v / 2 for m, v in zip(mu, s2))
+    results = fepout.analyze(fname, nboot=20, block=100)
+    for method in ['EXP', 'EXP_back', 'BAR', 'MBAR']:
+        dg, err = results[method]
+        assert abs(dg - expected) < 0.03, (method, dg, expected)
+        assert 0 < err < 0.03
+    # With two states, MBAR is BAR.
+    assert np.isclose(results['MBAR'][0], results['BAR'][0], atol=1e-6)
@@ -0,0 +1,34 @@
+"""Tests of the trajectory sources of histograms.py."""
+
+import os
+
+import numpy as np
+import pytest
+
+import histograms
+from measure import measure
+from store import write_store
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DCD = os.path.join(HERE, 'psfgen', 'namdrun_run.namdout.dcd')
+PSF = os.path.join(HERE, 'data', '2mx4_p1_p2.psf')
+QUANTITIES = ['phi35', 'psi36', 'bond2=37:CA,41:CA']
+
+
+def test_trajectory_matches_store(tmp_path):
+    frames, series = measure(DCD, PSF, QUANTITIES)
+    fname = str(tmp_path / 'run.mstore')
+    write_store(fname, frames, series)
+    kwargs = {'rama': [('phi35', 'psi36')], 'dist': ['bond2']}
+    expected = histograms.accumulate(fname, **kwargs)
+
+    kwargs = {'rama': [('phi35', 'psi36')], 'dist': ['bond2=37:CA,41:CA']}
+    found = histograms.accumulate(DCD, psf=PSF, **kwargs)
+    assert found['phi35:psi36'].total == len(frames)
+    assert np.array_equal(found['phi35:psi36'].counts, expected['phi35:psi36'].counts)
+    assert np.array_equal(found['bond2=37:CA,41:CA'].counts, expected['bond2'].counts)
+
+
+def test_trajectory_needs_psf():
+    with pytest.raises(ValueError):
+        histograms.accumulate(DCD, dist=['bond2=37:CA,41:CA'])
@@ -0,0 +1,63 @@
+"""Tests of the energy stores of the segments of jobgen.py runs in namdlog.py."""
+
+import os
+
+import numpy as np
+import pytest
+
+import namdlog
+from store import MeasurementStore
+
+TITLES = ['TS', 'BOND', 'TOTAL', 'TEMP', 'PRESSURE', 'VOLUME']
+
+
+def write_segment(rundir, tag, first, steps, temperature=298.0, every=100):
+    """Write fep_<tag>.tcl starting at step `first` and the log it writes."""
+    with open(os.path.join(rundir, 'fep_%s.tcl' % tag), 'w') as f:
+        f.write('timestep 2.0\nfirsttimestep %d\nrun %d\n' % (first, steps))
+    with open(os.path.join(rundir, 'namd.%s.stdout' % tag), 'w') as f:
+        f.write('Info: TIMESTEP 2\nInfo: LANGEVIN TEMPERATURE 298\n')
+        f.write('ETITLE:      %s\n\n' % '  '.join(TITLES))
+        # The first step is printed again by a segment restarted from the previous one.
+        for step in range(first, first + steps + 1, every):
+            f.write('ENERGY: %d 1.0 %.1f %.2f 1.0 1000.0\n' % (step, -1000.0 - first, temperature))
+        f.write('WallClock: 10.0  CPUTime: 10.0  Memory: 100.0 MB\n')
+
+
+def test_chain_segments_in_step_order(tmp_path):
+    rundir = str(tmp_path / 'p1_s10_run1')
+    os.mkdir(rundir)
+    for k in range(12):
+        write_segment(rundir, 'seg%d' % k, 1000 * k, 1000)
+
+    jobs = namdlog.find_runs([rundir])
+    assert len(jobs) == 1
+    run, logs, out = jobs[0]
+    assert logs == [os.path.join(rundir, 'namd.seg%d.stdout' % k) for k in range(12)]
+    steps, series, info = namdlog.run_energies(logs)
+    assert np.array_equal(steps, np.arange(0, 12001, 100))
+    # The boundary step is kept from the segment that starts there.
+    assert series['TOTAL'][10] == -2000.0
+    assert info['temperature'] == 298.0
+
+
+def test_windows_are_separate_runs(tmp_path):
+    rundir = str(tmp_path / 'p1_s10_run1')
+    os.mkdir(rundir)
+    write_segment(rundir, 'equil', 0, 1000)
+    for k in range(11):
+        write_segment(rundir, 'win%d' % k, 1000, 2000, temperature=350.0 if k == 9 else 298.0)
+
+    jobs = namdlog.find_runs([rundir])
+    assert [run for run, logs, out in jobs] == (
+        ['p1_s10_run1'] + ['p1_s10_run1/win%d' % k for k in range(11)])
+    results = namdlog.process_runs(jobs, workers=1)
+    for run, fname, summary in results:
+        assert summary['frames'] == len(MeasurementStore(fname))
+        assert summary['frames'] == (11 if run == 'p1_s10_run1' else 21)
+    unstable = [run for run, fname, summary in results if summary['problems']]
+    assert unstable == ['p1_s10_run1/win9']
+
+    # Two windows start at the same step, they are not consecutive segments.
+    with pytest.raises(ValueError):
+        namdlog.run_energies(jobs[1][1] + jobs[2][1])
@@ -0,0 +1,70 @@
+"""Tests of the resource choice of perfdb.py."""
+
+import os
+import sys
+import glob
+import shutil
+import subprocess
+
+import numpy as np
+
+import perfdb
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def make_db(tmp_path, runs):
+    db = perfdb.connect(str(tmp_path / 'perf.sqlite'))
+    with db:
+        for i, (atoms, cores, ns_per_day) in enumerate(runs):
+            db.execute('INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                       ('run%d.stdout' % i, atoms, cores, 'node1', 2.0, ns_per_day, 1, 0.0))
+    return db
+
+
+def test_single_core_count_uses_recorded_cores(tmp_path):
+    # All runs used 16 cores: nothing is known about other core counts.
+    db = make_db(tmp_path, [(2000, 16, 10.0), (3000, 16, 8.0), (4000, 16, 6.5)])
+    speed = perfdb.predict(db, 3000, 16)
+
+    # Without requested cores, the recorded core count is used.
+    choice = perfdb.choose_resources(db, 3000, 20.0, queue_limits={'short': 10800})
+    assert choice['cores'] == 16
+    assert np.isclose(choice['ns_per_day'], speed)
+
+    # Fewer cores asked for explicitly are not predicted to run as fast.
+    choice = perfdb.choose_resources(db, 3000, 20.0, queue_limits={'short': 10800}, cores=1)
+    assert choice['cores'] == 1
+    assert np.isclose(choice['ns_per_day'], speed / 16)
+    assert choice['seconds'] >= 20.0 / (speed / 16) * 86400
+
+
+def test_jobgen_auto_without_cores_uses_recorded_cores(tmp_path):
+    # jobgen writes run dirs next to itself and the database is in ~/.cache.
+    scripts = tmp_path / 'scripts'
+    (scripts / 'data').mkdir(parents=True)
+    for fname in glob.glob(os.path.join(HERE, '*.py')) + [os.path.join(HERE, 'fep.tcl')]:
+        shutil.copy(fname, str(scripts))
+    for suffix in ['.pdb', '.psf', '_alch.pdb', '_fixed.pdb']:
+        shutil.copy(os.path.join(HERE, 'data', '2mx4_p1_s8' + suffix), str(scripts / 'data'))
+    env = dict(os.environ, HOME=str(tmp_path))
+    db = perfdb.connect(os.path.join(str(tmp_path), '.cache', 'disorder', 'perf.sqlite'))
+    with db:
+        for i, (atoms, ns_per_day) in enumerate([(2000, 10.0), (3000, 8.0), (4000, 6.5)]):
+            db.execute('INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                       ('run%d.stdout' % i, atoms, 16, 'node1', 2.0, ns_per_day, 1, 0.0))
+
+    out = subprocess.check_output([sys.executable, 'jobgen.py', '--fep', 'fep.tcl', '--auto',
+                                   '--pdb', os.path.join('data', '2mx4_p1_s8.pdb')],
+                                  cwd=str(scripts), env=env, stderr=subprocess.STDOUT)
+    assert b'--cores 16' in out
+    job = out.split()[-1].decode()
+    with open(job) as f:
+        assert '#$ -pe smp 16\n' in f.read()
+
+
+def test_only_recorded_core_counts_are_chosen(tmp_path):
+    db = make_db(tmp_path, [(3000, 4, 3.0), (3000, 16, 9.0), (2000, 4, 4.0), (2000, 16, 12.0)])
+    choice = perfdb.choose_resources(db, 3000, 20.0, queue_limits={'short': 10800})
+    assert choice['cores'] in [4, 16]
+    assert perfdb.recorded_cores(db, 3000) == [4, 16]
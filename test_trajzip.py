@@ -0,0 +1,57 @@
+"""Tests of the compressed trajectories of trajzip.py."""
+
+import os
+
+import numpy as np
+import pytest
+
+import trajzip
+from dcd import DCD, open_trajectory
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DCD_FILE = os.path.join(HERE, 'psfgen', 'namdrun_run.namdout.dcd')
+PSF = os.path.join(HERE, 'data', '2mx4_p1_p2.psf')
+
+
+def test_strip_round_trip(tmp_path):
+    out = str(tmp_path / 'protein')
+    # Blocks of 3 frames: the 10 frames span 4 blocks, the last one partial.
+    trajzip.strip(DCD_FILE, PSF, out, block_frames=3)
+    with DCD(out + '.dcd') as ref, open_trajectory(out + trajzip.EXTENSION) as traj:
+        assert isinstance(traj, trajzip.CompressedTrajectory)
+        assert (len(traj), traj.n_atoms) == (len(ref), ref.n_atoms)
+        assert (traj.istart, traj.nsavc) == (ref.istart, ref.nsavc)
+        expected = ref.frames()
+        tol = traj.precision / 2 + 1e-4
+        # Random access, out of order and across blocks.
+        for index in [7, 0, 9, 3, 2, -1, -10, -4]:
+            assert np.abs(traj[index] - expected[index]).max() <= tol
+        assert np.abs(traj[::-3] - expected[::-3]).max() <= tol
+        assert np.abs(traj[[8, 1, 5]] - expected[[8, 1, 5]]).max() <= tol
+        assert np.abs(traj.frames() - expected).max() <= tol
+        with pytest.raises(IndexError):
+            traj[len(ref)]
+        with pytest.raises(IndexError):
+            traj[-len(ref) - 1]
+
+
+def test_encoding_keeps_precision(tmp_path):
+    rng = np.random.default_rng(3)
+    xyz = rng.uniform(-80, 80, (25, 50, 3)).astype(np.float32)
+    cells = rng.uniform(60, 70, (25, 6))
+    precision = 0.01
+    data = trajzip.encode_block(xyz, precision)
+    assert np.abs(trajzip.decode_block(data, 25, 50, precision) - xyz).max() <= precision / 2 + 1e-4
+
+    fname = str(tmp_path / 'random.trjz')
+    with trajzip.CompressedWriter(fname, 50, unitcell=True, precision=precision,
+                                  block_frames=4) as writer:
+        # Writes that do not line up with the blocks.
+        for start, stop in [(0, 3), (3, 11), (11, 25)]:
+            writer.write(xyz[start:stop], cells[start:stop])
+    with trajzip.CompressedTrajectory(fname) as traj:
+        assert len(traj) == 25
+        assert traj.precision == precision
+        assert np.abs(traj[-1] - xyz[-1]).max() <= precision / 2 + 1e-4
+        assert np.abs(traj[::-1] - xyz[::-1]).max() <= precision / 2 + 1e-4
+        assert np.array_equal(traj.unitcell, cells)
@@ -0,0 +1,543 @@
+"""Readers for PSF and PDB structure files, and atom selections.
+
+write_psf_subset and write_pdb_subset write the structure of a subset of the
+atoms, e.g. the protein without water for a stripped trajectory.
+
+Parsed files are cached in a .npz file next to them (e.g. data/x.psf.npz),
+which is used as long as the source file has the same size and modification
+time, so loading a topology again is only a few array reads.
+
+Selections are written like in VMD, with the keywords segid (or segname),
+resid, resname, name, index, water, all, combined with and, or, not and
+parentheses, e.g. 'segid A and resid 35 to 43 and name CA' or 'not water'.
+"""
+
+import os
+import re
+import numpy as np
+
+
+# Columns of the atom section of a PSF file.
+PSF_ATOM_DTYPE = np.dtype([('index', 'i4'),
+                           ('segid', 'U4'),
+                           ('resid', 'i4'),
+                           ('resname', 'U4'),
+                           ('name', 'U4'),
+                           ('type', 'U6'),
+                           ('charge', 'f4'),
+                           ('mass', 'f4')])
+
+# Columns of ATOM/HETATM records of a PDB file.
+PDB_ATOM_DTYPE = np.dtype([('index', 'i4'),
+                           ('name', 'U4'),
+                           ('altloc', 'U1'),
+                           ('resname', 'U4'),
+                           ('chain', 'U1'),
+                           ('resid', 'i4'),
+                           ('xyz', 'f4', (3,)),
+                           ('occupancy', 'f4'),
+                           ('beta', 'f4'),
+                           ('segid', 'U4'),
+                           ('element', 'U2')])
+
+# (first, last) columns of the PDB_ATOM_DTYPE fields in a PDB line.
+PDB_COLUMNS = {'name': (12, 16),
+               'altloc': (16, 17),
+               'resname': (17, 21),
+               'chain': (21, 22),
+               'resid': (22, 26),
+               'xyz': (30, 54),
+               'occupancy': (54, 60),
+               'beta': (60, 66),
+               'segid': (72, 76),
+               'element': (76, 78)}
+
+# PSF sections with atom index tuples, and the number of atoms in each tuple.
+PSF_SECTIONS = {'bonds': ('BOND', 2),
+                'angles': ('THETA', 3),
+                'dihedrals': ('PHI', 4),
+                'impropers': ('IMPHI', 4)}
+
+# Sections of atom tuples written by write_psf_subset, with tuple size and
+# tuples per line. Other connectivity sections are written empty.
+PSF_TUPLE_SECTIONS = [('BOND', 'bonds', 2, 4),
+                      ('THETA', 'angles', 3, 3),
+                      ('PHI', 'dihedrals', 4, 2),
+                      ('IMPHI', 'impropers', 4, 2),
+                      ('DON', 'donors', 2, 4),
+                      ('ACC', 'acceptors', 2, 4)]
+
+# Residue names of water molecules.
+WATER_RESNAMES = ['TIP3', 'TIP4', 'TIP5', 'SPC', 'HOH', 'WAT', 'SOL', 'H2O']
+
+# Version of the .npz cache format.
+CACHE_VERSION = 1
+
+
+def _section_header(lines, start):
+    """Return (line number, count, name) of the next '<count> !N<name>' header."""
+    for i in range(start, len(lines)):
+        m = re.match(r'\s*(\d+)(?:\s+\d+)?\s+!N(\w+)', lines[i])
+        if m:
+            return i, int(m.group(1)), m.group(2)
+    return None
+
+
+def parse_psf(psf):
+    """Return atoms and connectivity in a psf file.
+
+    Returns
+    -------
+    topology : dict
+        'atoms': structured array with PSF_ATOM_DTYPE, one row per atom.
+        'bonds', 'angles', 'dihedrals', 'impropers': int32 arrays with
+        0-based atom indices, one row per bond, angle, ...
+    """
+    with open(psf, 'r') as fp:
+        lines = fp.read().split('\n')
+
+    sections = {}
+    i = 0
+    while True:
+        header = _section_header(lines, i)
+        if header is None:
+            break
+        i, count, name = header
+        sections[name] = (i + 1, count)
+        i += 1
+
+    if 'ATOM' not in sections:
+        raise ValueError('No atoms found in psf file %s' % psf)
+    first, natom = sections['ATOM']
+    fields = np.array([line.split()[:8] for line in lines[first:first+natom]])
+    if fields.shape != (natom, 8):
+        raise ValueError('Invalid atom section in psf file %s' % psf)
+    atoms = np.zeros(natom, dtype=PSF_ATOM_DTYPE)
+    atoms['index'] = fields[:, 0].astype(np.int64) - 1
+    for i, column in enumerate(['segid', 'resid', 'resname', 'name', 'type', 'charge', 'mass']):
+        atoms[column] = fields[:, i+1]
+
+    topology = {'atoms': atoms}
+    for key, (section, size) in PSF_SECTIONS.items():
+        values = np.zeros(0, dtype=np.int32)
+        if section in sections:
+            first, count = sections[section]
+            last = first
+            while last < len(lines) and lines[last].strip():
+                last += 1
+            values = np.array(' '.join(lines[first:last]).split(), dtype=np.int32)[:count*size]
+        topology[key] = values.reshape(-1, size) - 1
+    return topology
+
+
+def read_psf(psf):
+    """Return the atoms in a psf file.
+
+    Parameters
+    ----------
+    psf : string
+        psf file path.
+
+    Returns
+    -------
+    atoms : numpy.ndarray
+        structured array with PSF_ATOM_DTYPE, one row per atom. `index` is
+        the 0-based position of the atom in the trajectory.
+    """
+    return load_topology(psf).atoms
+
+
+def iter_pdb_coords(pdb, chunk=100000):
+    """Iterate over coordinates in a pdb file, `chunk` atoms at a time.
+
+    Yields
+    ------
+    xyz : numpy.ndarray
+        float64 array of shape (n, 3), n <= chunk.
+    """
+    with open(pdb, 'rb') as fp:
+        lines = []
+        for line in fp:
+            if line.startswith((b'ATOM', b'HETATM')):
+                lines.append(line)
+                if len(lines) == chunk:
+                    yield _parse_coords(lines)
+                    lines = []
+        if lines:
+            yield _parse_coords(lines)
+
+
+def _parse_coords(lines):
+    # Coordinates are three 8 character columns starting at column 31. Cut
+    # them out of all lines at once and convert them without splitting lines.
+    raw = np.array(lines, dtype='S54').view(np.uint8).reshape(len(lines), 54)
+    fields = np.ascontiguousarray(raw[:, 30:54]).view('S8')
+    return fields.astype(np.float64)
+
+
+def read_pdb_coords(pdb):
+    """Return an array of shape (n_atoms, 3) with coordinates in a pdb file."""
+    blocks = list(iter_pdb_coords(pdb))
+    if not blocks:
+        return np.zeros((0, 3), dtype=np.float32)
+    return np.concatenate(blocks).astype(np.float32)
+
+
+def _column(raw, first, last):
+    """Return fixed width columns first:last of all lines as bytes."""
+    return np.ascontiguousarray(raw[:, first:last]).view('S%d' % (last - first))[:, 0]
+
+
+def _numbers(field, dtype):
+    # Blank fields (short lines) are 0.
+    field = np.char.strip(field)
+    field[field == b''] = b'0'
+    try:
+        return field.astype(dtype)
+    except ValueError:
+        # Programs writing more than 9999 residues use hexadecimal resids.
+        return np.array([int(v, 16) for v in field.tolist()], dtype=dtype)
+
+
+def read_pdb(pdb):
+    """Return the atoms in a pdb file.
+
+    All ATOM and HETATM records are parsed at once as fixed width columns.
+
+    Returns
+    -------
+    atoms : numpy.ndarray
+        structured array with PDB_ATOM_DTYPE, one row per atom.
+    """
+    with open(pdb, 'rb') as fp:
+        lines = [line for line in fp if line.startswith((b'ATOM', b'HETATM'))]
+    atoms = np.zeros(len(lines), dtype=PDB_ATOM_DTYPE)
+    if not lines:
+        return atoms
+    raw = np.array(lines, dtype='S80').view(np.uint8).reshape(len(lines), 80).copy()
+    # Line ends and the padding of short lines become blanks.
+    raw[(raw == 0) | (raw == 10) | (raw == 13)] = 32
+    atoms['index'] = np.arange(len(lines))
+    for name, (first, last) in PDB_COLUMNS.items():
+        if name == 'xyz':
+            fields = np.ascontiguousarray(raw[:, first:last]).view('S8')
+            atoms['xyz'] = _numbers(fields, np.float32)
+        elif atoms.dtype[name].kind == 'U':
+            atoms[name] = np.char.strip(_column(raw, first, last)).astype(atoms.dtype[name])
+        else:
+            atoms[name] = _numbers(_column(raw, first, last), atoms.dtype[name])
+    return atoms
+
+
+def _write_ints(fp, values, per_line, width):
+    fmt = '%' + str(width) + 'd'
+    for i in range(0, len(values), per_line):
+        fp.write(''.join(fmt % v for v in values[i:i+per_line]) + '\n')
+
+
+def write_psf_subset(psf, out, positions):
+    """Write a psf file with only some of the atoms of psf.
+
+    Atoms are renumbered in the order of positions. Bonds, angles, dihedrals,
+    impropers, donors, acceptors and CMAP cross terms with all atoms in the
+    subset are kept. Non-bonded exclusions are not kept, and all atoms are
+    in a single group.
+
+    Parameters
+    ----------
+    psf : string
+        psf file path.
+    out : string
+        output psf file path.
+    positions : array of ints
+        sorted 0-based positions of the atoms to keep, e.g. from
+        Topology.select.
+    """
+    with open(psf, 'r') as fp:
+        lines = fp.read().split('\n')
+    sections = {}
+    i = 0
+    while True:
+        header = _section_header(lines, i)
+        if header is None:
+            break
+        i, count, name = header
+        sections[name] = (i, count)
+        i += 1
+    if 'ATOM' not in sections:
+        raise ValueError('No atoms found in psf file %s' % psf)
+    natom = sections['ATOM'][1]
+    width = 10 if 'EXT' in lines[0].split() else 8
+    positions = np.asarray(positions, dtype=np.int64)
+    remap = np.zeros(natom, dtype=np.int64)
+    remap[positions] = np.arange(1, len(positions) + 1)
+
+    def tuples(name, size):
+        if name not in sections:
+            return np.zeros((0, size), dtype=np.int64)
+        first, count = sections[name]
+        last = first + 1
+        while last < len(lines) and lines[last].strip():
+            last += 1
+        values = np.array(' '.join(lines[first+1:last]).split(), dtype=np.int64)[:count*size]
+        values = remap[values.reshape(-1, size) - 1]
+        return values[(values > 0).all(axis=1)]
+
+    with open(out, 'w') as fp:
+        fp.write(lines[0] + '\n\n')
+        title = []
+        if 'TITLE' in sections:
+            first, count = sections['TITLE']
+            title = lines[first+1:first+1+count]
+        title.append(' REMARKS %d of %d atoms of %s' % (len(positions), natom, os.path.basename(psf)))
+        fp.write('%*d !NTITLE\n' % (width, len(title)) + '\n'.join(title) + '\n\n')
+
+        first = sections['ATOM'][0] + 1
+        fp.write('%*d !NATOM\n' % (width, len(positions)))
+        for new, old in enumerate(positions):
+            line = lines[first + old]
+            m = re.match(r'\s*\d+', line)
+            fp.write(str(new + 1).rjust(m.end()) + line[m.end():] + '\n')
+        fp.write('\n')
+
+        for name, label, size, per_line in PSF_TUPLE_SECTIONS:
+            values = tuples(name, size)
+            fp.write('%*d !N%s: %s\n' % (width, len(values), name, label))
+            _write_ints(fp, values.ravel(), size * per_line, width)
+            fp.write('\n')
+        fp.write('%*d !NNB\n\n' % (width, 0))
+        _write_ints(fp, np.zeros(len(positions), dtype=np.int64), 8, width)
+        fp.write('\n%*d%*d !NGRP\n' % (width, 1, width, 0))
+        _write_ints(fp, [0, 0, 0], 9, width)
+        fp.write('\n')
+        if 'CRTERM' in sections:
+            values = tuples('CRTERM', 8)
+            fp.write('%*d !NCRTERM: cross-terms\n' % (width, len(values)))
+            _write_ints(fp, values.ravel(), 8, width)
+            fp.write('\n')
+    return out
+
+
+def write_pdb_subset(pdb, out, positions):
+    """Write a pdb file with only some of the ATOM/HETATM records of pdb.
+
+    Parameters
+    ----------
+    positions : array of ints
+        sorted 0-based positions of the atoms to keep.
+    """
+    with open(pdb, 'rb') as fp:
+        lines = fp.readlines()
+    is_atom = np.array([line.startswith((b'ATOM', b'HETATM')) for line in lines], dtype=bool)
+    keep = ~is_atom
+    atom_lines = np.flatnonzero(is_atom)
+    keep[atom_lines[positions]] = True
+    with open(out, 'wb') as fp:
+        fp.write(b''.join(line for line, k in zip(lines, keep) if k))
+    return out
+
+
+def _cache_name(fname):
+    return fname + '.npz'
+
+
+def _load_cache(fname):
+    """Return arrays cached for fname, or None if there is no valid cache."""
+    cache = _cache_name(fname)
+    if not os.path.exists(cache):
+        return None
+    stat = os.stat(fname)
+    try:
+        with np.load(cache, allow_pickle=False) as data:
+            arrays = dict(data)
+    except (OSError, ValueError):
+        return None
+    if (arrays.pop('version', None) != CACHE_VERSION or arrays.pop('size', None) != stat.st_size
+            or arrays.pop('mtime', None) != stat.st_mtime_ns):
+        return None
+    return arrays
+
+
+def _save_cache(fname, arrays):
+    stat = os.stat(fname)
+    cache = _cache_name(fname)
+    tmp = '%s.%d.tmp.npz' % (cache, os.getpid())
+    try:
+        np.savez(tmp, version=CACHE_VERSION, size=stat.st_size, mtime=stat.st_mtime_ns, **arrays)
+        os.replace(tmp, cache)
+    except OSError:
+        # The cache is only an optimization, e.g. the directory is read only.
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def load_topology(psf, cache=True):
+    """Return the Topology of a psf file, using its .npz cache if possible."""
+    arrays = _load_cache(psf) if cache else None
+    if arrays is None:
+        arrays = parse_psf(psf)
+        if cache:
+            _save_cache(psf, arrays)
+    return Topology(**arrays)
+
+
+def load_pdb(pdb, cache=True):
+    """Return the Topology of a pdb file, using its .npz cache if possible.
+
+    Its atoms have PDB_ATOM_DTYPE, with coordinates and beta values.
+    """
+    arrays = _load_cache(pdb) if cache else None
+    if arrays is None:
+        arrays = {'atoms': read_pdb(pdb)}
+        if cache:
+            _save_cache(pdb, arrays)
+    return Topology(**arrays)
+
+
+def find_atom(atoms, segid, resid, name):
+    """Return index of the atom with given segid, resid and name.
+
+    Raises a ValueError if there is no such atom in `atoms`.
+    """
+    mask = (atoms['resid'] == resid) & (atoms['name'] == name)
+    if segid:
+        mask &= atoms['segid'] == segid
+    found = np.flatnonzero(mask)
+    if len(found) == 0:
+        raise ValueError('Atom %s:%d:%s not found' % (segid, resid, name))
+    return int(atoms['index'][found[0]])
+
+
+# Selection keywords and the atom fields they match.
+KEYWORDS = {'segid': 'segid',
+            'segname': 'segid',
+            'resid': 'resid',
+            'resname': 'resname',
+            'name': 'name',
+            'index': 'index'}
+
+RESERVED = set(['and', 'or', 'not', '(', ')', 'water', 'all', 'none']) | set(KEYWORDS)
+
+
+class Topology(object):
+    """Atoms of a structure with their connectivity, and atom selections.
+
+    Attributes
+    ----------
+    atoms : numpy.ndarray
+        structured array, with PSF_ATOM_DTYPE or PDB_ATOM_DTYPE.
+    bonds, angles, dihedrals, impropers : numpy.ndarray
+        0-based atom indices, empty for pdb files.
+    """
+
+    def __init__(self, atoms, bonds=None, angles=None, dihedrals=None, impropers=None):
+        self.atoms = atoms
+        empty = {2: np.zeros((0, 2), dtype=np.int32), 3: np.zeros((0, 3), dtype=np.int32),
+                 4: np.zeros((0, 4), dtype=np.int32)}
+        self.bonds = empty[2] if bonds is None else bonds
+        self.angles = empty[3] if angles is None else angles
+        self.dihedrals = empty[4] if dihedrals is None else dihedrals
+        self.impropers = empty[4] if impropers is None else impropers
+        self._indexes = {}
+
+    def __len__(self):
+        return len(self.atoms)
+
+    def index(self, field):
+        """Return a dict with the positions of the atoms having each value of field.
+
+        Indexes are built once per field, with a single sort.
+        """
+        if field not in self._indexes:
+            values, inverse = np.unique(self.atoms[field], return_inverse=True)
+            order = np.argsort(inverse, kind='stable')
+            bounds = np.searchsorted(inverse[order], np.arange(len(values) + 1))
+            self._indexes[field] = {v: order[bounds[i]:bounds[i+1]]
+                                    for i, v in enumerate(values.tolist())}
+        return self._indexes[field]
+
+    @property
+    def water(self):
+        """Boolean mask of water atoms."""
+        return self._mask([i for r in WATER_RESNAMES for i in [self.index('resname').get(r)]
+                           if i is not None])
+
+    def _mask(self, positions):
+        mask = np.zeros(len(self.atoms), dtype=bool)
+        for p in positions:
+            mask[p] = True
+        return mask
+
+    def select(self, selection):
+        """Return positions (sorted) of the atoms in a selection, see module doc.
+
+        Raises a ValueError for invalid selections.
+        """
+        tokens = re.findall(r'\(|\)|[^\s()]+', selection)
+        mask, pos = self._or(tokens, 0)
+        if pos != len(tokens):
+            raise ValueError('Invalid selection %s: unexpected %s' % (selection, tokens[pos]))
+        return np.flatnonzero(mask)
+
+    def _or(self, tokens, pos):
+        mask, pos = self._and(tokens, pos)
+        while pos < len(tokens) and tokens[pos] == 'or':
+            other, pos = self._and(tokens, pos + 1)
+            mask = mask | other
+        return mask, pos
+
+    def _and(self, tokens, pos):
+        mask, pos = self._not(tokens, pos)
+        while pos < len(tokens) and tokens[pos] == 'and':
+            other, pos = self._not(tokens, pos + 1)
+            mask = mask & other
+        return mask, pos
+
+    def _not(self, tokens, pos):
+        if pos >= len(tokens):
+            raise ValueError('Invalid selection: unexpected end')
+        token = tokens[pos]
+        if token == 'not':
+            mask, pos = self._not(tokens, pos + 1)
+            return ~mask, pos
+        if token == '(':
+            mask, pos = self._or(tokens, pos + 1)
+            if pos >= len(tokens) or tokens[pos] != ')':
+                raise ValueError('Invalid selection: missing )')
+            return mask, pos + 1
+        if token == 'water':
+            return self.water, pos + 1
+        if token in ['all', 'none']:
+            return np.full(len(self.atoms), token == 'all'), pos + 1
+        if token not in KEYWORDS:
+            raise ValueError('Invalid selection: unknown keyword %s' % token)
+        field = KEYWORDS[token]
+        values = []
+        pos += 1
+        while pos < len(tokens) and tokens[pos] not in RESERVED:
+            values.append(tokens[pos])
+            pos += 1
+        if not values:
+            raise ValueError('Invalid selection: no values for %s' % token)
+        return self._match(field, values), pos
+
+    def _match(self, field, values):
+        index = self.index(field)
+        if self.atoms.dtype[field].kind in 'iu':
+            # Integers, ranges are written as 'first to last' or 'first:last'.
+            keys = np.array(sorted(index))
+            selected = []
+            i = 0
+            while i < len(values):
+                if i + 2 < len(values) and values[i+1] == 'to':
+                    first, last = int(values[i]), int(values[i+2])
+                    i += 3
+                elif ':' in values[i]:
+                    first, last = [int(v) for v in values[i].split(':')]
+                    i += 1
+                else:
+                    first = last = int(values[i])
+                    i += 1
+                selected += keys[(keys >= first) & (keys <= last)].tolist()
+            return self._mask([index[k] for k in selected])
+        return self._mask([index[v] for v in values if v in index])
@@ -0,0 +1,449 @@
+"""Strip and compress DCD trajectories.
+
+NAMD writes every atom, water included, to the DCD every dcdfreq steps, but
+the measurements only use protein atoms. In a single pass over a trajectory
+this script writes:
+
+- <out>.dcd: a DCD with only the selected atoms (default: all but water),
+  with <out>.psf (and <out>.pdb with --pdb) for the same atoms, so measure.py,
+  cluster.py and VMD read it like the full trajectory.
+- <out>.trjz: the same frames compressed. Coordinates are rounded to a fixed
+  precision (default 0.001 A, like XTC) and stored as integers: differences
+  to the previous frame, or to the previous atom in the first frame of a
+  block, zigzag encoded and byte shuffled, then zlib compressed. Blocks of
+  frames are compressed separately and a frame index at the end of the file
+  gives random access to any frame by decompressing only its block.
+
+dcd.open_trajectory opens both formats with the interface of dcd.DCD.
+
+Layout of a .trjz file: 8 byte magic, the compressed blocks, the compressed
+unit cells (if any), a JSON footer with the metadata and the offset, size and
+number of frames of every block, the 8 byte little-endian footer size, and
+the magic again.
+
+Usage: python trajzip.py strip --psf data/2mx4_p1_s10.psf --dcd p1_s10_run1/namd.dcd --out p1_s10_run1/protein
+       python trajzip.py info p1_s10_run1/protein.trjz
+       python trajzip.py extract p1_s10_run1/protein.trjz p1_s10_run1/protein_decompressed.dcd
+"""
+
+import sys
+import os
+import json
+import zlib
+import argparse
+import numpy as np
+
+from dcd import DCD, DCDWriter
+from topology import load_topology, write_psf_subset, write_pdb_subset
+
+if sys.version_info[0] < 3:
+    print('Needs python3. Load it using: module load python/3.4.3')
+    sys.exit(0)
+
+
+MAGIC = b'DISTRJZ1'
+EXTENSION = '.trjz'
+
+# Default rounding of the coordinates in A, and frames per compressed block.
+PRECISION = 0.001
+BLOCK_FRAMES = 100
+
+DEFAULT_SELECTION = 'not water'
+
+
+def encode_block(xyz, precision):
+    """Return the bytes of a block of frames, before zlib compression.
+
+    Parameters
+    ----------
+    xyz : numpy.ndarray
+        coordinates, shape (n_frames, n_atoms, 3).
+    precision : float
+        coordinates are rounded to multiples of precision.
+    """
+    q = np.rint(np.asarray(xyz, dtype=np.float64) / precision).astype(np.int64)
+    # Axis first: consecutive values are the same coordinate of neighbouring
+    # atoms, which are close in space.
+    q = q.transpose(2, 0, 1)
+    d = q.copy()
+    d[:, 1:] -= q[:, :-1]
+    d[:, 0, 1:] -= q[:, 0, :-1]
+    if np.abs(d).max(initial=0) >= 1 << 30:
+        raise ValueError('Coordinates too large for precision %g' % precision)
+    d = d.astype('<i4')
+    z = ((d << 1) ^ (d >> 31)).astype('<u4')
+    # Byte shuffle: all first bytes, then all second bytes, ... The high
+    # bytes of small values are zero and compress well.
+    return np.ascontiguousarray(z.view(np.uint8).reshape(-1, 4).T).tobytes()
+
+
+def decode_block(data, frames, n_atoms, precision):
+    """Return float32 coordinates of shape (frames, n_atoms, 3) from encode_block bytes."""
+    z = np.ascontiguousarray(np.frombuffer(data, dtype=np.uint8).reshape(4, -1).T).view('<u4')
+    z = z.reshape(3, frames, n_atoms).astype(np.int64)
+    d = (z >> 1) ^ -(z & 1)
+    d[:, 0] = np.cumsum(d[:, 0], axis=1)
+    q = np.cumsum(d, axis=1)
+    return (q.transpose(1, 2, 0) * precision).astype(np.float32)
+
+
+class CompressedWriter(object):
+    """A compressed trajectory file written a block of frames at a time.
+
+    Parameters
+    ----------
+    fname : string
+        path of the .trjz file. It is replaced if it exists.
+    n_atoms : int
+        number of atoms in each frame.
+    istart, nsavc, delta, title : optional
+        metadata of the trajectory, see dcd.DCDWriter.
+    unitcell : bool, optional, default False
+        store the unit cell of every frame.
+    precision : float, optional, default PRECISION
+        coordinates are rounded to multiples of precision (A).
+    block_frames : int, optional, default BLOCK_FRAMES
+        frames per compressed block. Reading a frame decompresses its block.
+    level : int, optional, default 6
+        zlib compression level.
+    """
+
+    def __init__(self, fname, n_atoms, istart=0, nsavc=1, delta=1 / 48.88821, unitcell=False,
+                 title=None, precision=PRECISION, block_frames=BLOCK_FRAMES, level=6):
+        self.fname = fname
+        self.meta = {'n_atoms': n_atoms, 'istart': istart, 'nsavc': nsavc, 'delta': delta,
+                     'has_unitcell': bool(unitcell), 'title': title or [], 'precision': precision,
+                     'codec': 'zlib'}
+        self.block_frames = block_frames
+        self.level = level
+        self.blocks = []
+        self._pending = []
+        self._cells = []
+        self._tmp = '%s.%d.tmp' % (fname, os.getpid())
+        self._fp = open(self._tmp, 'wb')
+        self._fp.write(MAGIC)
+
+    def write(self, xyz, unitcell=None):
+        """Append frames, see dcd.DCDWriter.write."""
+        xyz = np.asarray(xyz, dtype=np.float32)
+        if xyz.ndim == 2:
+            xyz = xyz[None]
+        if xyz.shape[1:] != (self.meta['n_atoms'], 3):
+            raise ValueError('Frames have shape %s, expected (n, %d, 3).'
+                             % (xyz.shape, self.meta['n_atoms']))
+        if self.meta['has_unitcell']:
+            if unitcell is None:
+                raise ValueError('%s needs the unit cell of every frame.' % self.fname)
+            self._cells.append(np.asarray(unitcell, dtype='<f8').reshape(len(xyz), 6))
+        self._pending.append(xyz)
+        pending = sum(len(x) for x in self._pending)
+        if pending >= self.block_frames:
+            frames = np.concatenate(self._pending)
+            full = pending // self.block_frames * self.block_frames
+            for i in range(0, full, self.block_frames):
+                self._flush(frames[i:i+self.block_frames])
+            self._pending = [frames[full:]] if full < pending else []
+
+    def _flush(self, xyz):
+        data = zlib.compress(encode_block(xyz, self.meta['precision']), self.level)
+        self.blocks.append([self._fp.tell(), len(data), len(xyz)])
+        self._fp.write(data)
+
+    def close(self):
+        """Write the remaining frames, the unit cells and the frame index."""
+        if self._fp is None:
+            return
+        if self._pending:
+            self._flush(np.concatenate(self._pending))
+        meta = dict(self.meta)
+        meta['blocks'] = self.blocks
+        meta['n_frames'] = sum(b[2] for b in self.blocks)
+        if self.meta['has_unitcell']:
+            cells = zlib.compress(np.concatenate(self._cells).tobytes(), self.level)
+            meta['unitcell'] = [self._fp.tell(), len(cells)]
+            self._fp.write(cells)
+        footer = json.dumps(meta, sort_keys=True).encode('utf-8')
+        self._fp.write(footer)
+        self._fp.write(np.array([len(footer)], dtype='<u8').tobytes())
+        self._fp.write(MAGIC)
+        self._fp.close()
+        self._fp = None
+        # Readers never see a partial file.
+        os.replace(self._tmp, self.fname)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class CompressedTrajectory(object):
+    """A .trjz file opened for random frame access, with the interface of dcd.DCD.
+
+    Frames are decompressed when they are accessed, one block at a time. The
+    last decompressed blocks are kept, so reading frames in order
+    decompresses every block once.
+
+    Parameters
+    ----------
+    fname : string
+        path of the .trjz file.
+
+    Attributes
+    ----------
+    n_frames, n_atoms, istart, nsavc, delta, title :
+        see dcd.DCD.
+    precision : float
+        rounding of the coordinates (A).
+    xyz : CompressedTrajectory
+        the trajectory itself, so traj.xyz[frames] works like for a DCD.
+    """
+
+    # Number of decompressed blocks kept.
+    CACHED_BLOCKS = 4
+
+    def __init__(self, fname):
+        self.fname = fname
+        with open(fname, 'rb') as fp:
+            if fp.read(len(MAGIC)) != MAGIC:
+                raise ValueError('File %s is not a compressed trajectory.' % fname)
+            fp.seek(-8 - len(MAGIC), os.SEEK_END)
+            size = int(np.frombuffer(fp.read(8), dtype='<u8')[0])
+            if fp.read(len(MAGIC)) != MAGIC:
+                raise ValueError('File %s is incomplete, it has no frame index.' % fname)
+            fp.seek(-8 - len(MAGIC) - size, os.SEEK_END)
+            meta = json.loads(fp.read(size).decode('utf-8'))
+        self.meta = meta
+        self.n_frames = meta['n_frames']
+        self.n_atoms = meta['n_atoms']
+        self.istart = meta['istart']
+        self.nsavc = meta['nsavc']
+        self.delta = meta['delta']
+        self.title = meta['title']
+        self.precision = meta['precision']
+        self.has_unitcell = meta['has_unitcell']
+        blocks = np.array(meta['blocks'], dtype=np.int64).reshape(-1, 3)
+        self._offsets, self._sizes, counts = blocks.T
+        self._first = np.concatenate([[0], np.cumsum(counts)])
+        self._cache = {}
+        self._unitcell = None
+        self._fp = open(fname, 'rb')
+        self.xyz = self
+
+    @property
+    def timestep(self):
+        """Timestep in femtoseconds."""
+        return self.delta * 48.88821
+
+    @property
+    def unitcell(self):
+        """Unit cell of every frame, shape (n_frames, 6), or None."""
+        if not self.has_unitcell:
+            return None
+        if self._unitcell is None:
+            offset, size = self.meta['unitcell']
+            self._fp.seek(offset)
+            data = zlib.decompress(self._fp.read(size))
+            self._unitcell = np.frombuffer(data, dtype='<f8').reshape(self.n_frames, 6)
+        return self._unitcell
+
+    def _block(self, b):
+        if b not in self._cache:
+            if len(self._cache) >= self.CACHED_BLOCKS:
+                self._cache.pop(next(iter(self._cache)))
+            self._fp.seek(self._offsets[b])
+            data = zlib.decompress(self._fp.read(self._sizes[b]))
+            frames = self._first[b+1] - self._first[b]
+            self._cache[b] = decode_block(data, frames, self.n_atoms, self.precision)
+        return self._cache[b]
+
+    def __len__(self):
+        return self.n_frames
+
+    def __getitem__(self, index):
+        """Return coordinates for a frame, or a copy for a slice or array of frames."""
+        if np.isscalar(index):
+            frame = int(index) + (self.n_frames if index < 0 else 0)
+            if not 0 <= frame < self.n_frames:
+                raise IndexError('Frame %d out of range, %s has %d frames'
+                                 % (index, self.fname, self.n_frames))
+            b = np.searchsorted(self._first, frame, side='right') - 1
+            return self._block(b)[frame - self._first[b]].copy()
+        frames = np.arange(self.n_frames)[index]
+        out = np.empty((len(frames), self.n_atoms, 3), dtype=np.float32)
+        blocks = np.searchsorted(self._first, frames, side='right') - 1
+        for b in np.unique(blocks):
+            rows = blocks == b
+            out[rows] = self._block(b)[frames[rows] - self._first[b]]
+        return out
+
+    def frames(self, start=0, stop=None, stride=1):
+        """Return frames start:stop:stride with shape (n, n_atoms, 3)."""
+        return self[start:stop:stride]
+
+    def chunks(self, size=1000, start=0, stop=None, stride=1, atoms=None):
+        """Iterate over blocks of frames, see dcd.DCD.chunks."""
+        indices = np.arange(self.n_frames)[start:stop:stride]
+        for i in range(0, len(indices), size):
+            frames = indices[i:i+size]
+            xyz = self[frames]
+            if atoms is not None:
+                xyz = xyz[:, atoms]
+            yield frames, xyz
+
+    def close(self):
+        """Close the file."""
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+        self._cache = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def strip(dcd, psf, out, selection=DEFAULT_SELECTION, pdb=None, write_dcd=True, compress=True,
+          precision=PRECISION, block_frames=BLOCK_FRAMES, chunk=1000):
+    """Write the selected atoms of a trajectory as a DCD and/or compressed trajectory.
+
+    The trajectory is read once, `chunk` frames at a time.
+
+    Parameters
+    ----------
+    dcd, psf : string
+        trajectory and its psf file.
+    out : string
+        output path without extension: <out>.dcd, <out>.trjz, <out>.psf and
+        <out>.pdb are written.
+    selection : string, optional, default DEFAULT_SELECTION
+        atoms to keep, see topology.py.
+    pdb : string, optional
+        also write the selected atoms of this pdb file.
+    write_dcd, compress : bool, optional, default True
+        write <out>.dcd and <out>.trjz.
+
+    Returns
+    -------
+    files : list of strings
+        written files.
+    """
+    top = load_topology(psf)
+    atoms = top.select(selection)
+    if len(atoms) == 0:
+        raise ValueError('No atoms in selection: %s' % selection)
+    files = [write_psf_subset(psf, out + '.psf', atoms)]
+    if pdb:
+        files.append(write_pdb_subset(pdb, out + '.pdb', atoms))
+
+    with DCD(dcd) as traj:
+        if traj.n_atoms != len(top):
+            raise ValueError('Trajectory %s has %d atoms, psf %s has %d atoms.'
+                             % (dcd, traj.n_atoms, psf, len(top)))
+        title = traj.title + ['REMARKS %d of %d atoms: %s' % (len(atoms), traj.n_atoms, selection)]
+        kwargs = {'istart': traj.istart, 'nsavc': traj.nsavc, 'delta': traj.delta,
+                  'unitcell': traj.has_unitcell, 'title': title}
+        writers = []
+        if write_dcd:
+            writers.append(DCDWriter(out + '.dcd', len(atoms), **kwargs))
+        if compress:
+            writers.append(CompressedWriter(out + EXTENSION, len(atoms), precision=precision,
+                                            block_frames=block_frames, **kwargs))
+        try:
+            for frames, xyz in traj.chunks(chunk, atoms=atoms):
+                cell = traj.unitcell[frames] if traj.has_unitcell else None
+                for writer in writers:
+                    writer.write(xyz, cell)
+        finally:
+            for writer in writers:
+                writer.close()
+        files += [writer.fname for writer in writers]
+    return files
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Strip DCD trajectories to the protein and '
+                                     'compress them with random frame access.')
+    subparsers = parser.add_subparsers(dest='command')
+
+    p = subparsers.add_parser('strip', help='Write the selected atoms as <out>.dcd and <out>.trjz.')
+    p.add_argument('--psf',
+                   type=str,
+                   required=True,
+                   help='PSF file of the trajectory.')
+    p.add_argument('--dcd',
+                   type=str,
+                   required=True,
+                   help='DCD trajectory file.')
+    p.add_argument('--out',
+                   type=str,
+                   required=True,
+                   help='Output path without extension.')
+    p.add_argument('--select',
+                   type=str,
+                   default=DEFAULT_SELECTION,
+                   help='Atoms to keep, see topology.py. Default: %s' % DEFAULT_SELECTION)
+    p.add_argument('--pdb',
+                   type=str,
+                   default=None,
+                   help='Also write the selected atoms of this pdb file to <out>.pdb.')
+    p.add_argument('--precision',
+                   type=float,
+                   default=PRECISION,
+                   help='Precision of the compressed coordinates in A. Default %g.' % PRECISION)
+    p.add_argument('--block',
+                   type=int,
+                   default=BLOCK_FRAMES,
+                   help='Frames per compressed block. Default %d.' % BLOCK_FRAMES)
+    p.add_argument('--no-dcd',
+                   action='store_true',
+                   help='Only write the compressed trajectory.')
+    p.add_argument('--no-compress',
+                   action='store_true',
+                   help='Only write the stripped dcd.')
+
+    p = subparsers.add_parser('info', help='Print information about a compressed trajectory.')
+    p.add_argument('trjz', type=str, help='Compressed trajectory.')
+
+    p = subparsers.add_parser('extract', help='Decompress a compressed trajectory to a dcd.')
+    p.add_argument('trjz', type=str, help='Compressed trajectory.')
+    p.add_argument('dcd', type=str, help='Output dcd file.')
+
+    args = parser.parse_args()
+
+    if args.command == 'strip':
+        for fname in [args.psf, args.dcd, args.pdb]:
+            if fname and not os.path.exists(fname):
+                raise IOError('File %s not found.' % fname)
+        files = strip(args.dcd, args.psf, args.out, args.select, args.pdb, not args.no_dcd,
+                      not args.no_compress, args.precision, args.block)
+        size = os.path.getsize(args.dcd)
+        for fname in files:
+            print('%s: %.1fx smaller' % (fname, size / max(os.path.getsize(fname), 1))
+                  if fname.endswith(('.dcd', EXTENSION)) else fname)
+    elif args.command == 'info':
+        with CompressedTrajectory(args.trjz) as traj:
+            for line in traj.title:
+                print(line)
+            print('atoms: %d' % traj.n_atoms)
+            print('frames: %d in %d blocks' % (traj.n_frames, len(traj._offsets)))
+            print('first step: %d, steps per frame: %d, timestep: %.3f fs'
+                  % (traj.istart, traj.nsavc, traj.timestep))
+            print('precision: %g A' % traj.precision)
+            print('unit cell: %s' % ('yes' if traj.has_unitcell else 'no'))
+    elif args.command == 'extract':
+        with CompressedTrajectory(args.trjz) as traj:
+            with DCDWriter(args.dcd, traj.n_atoms, traj.istart, traj.nsavc, traj.delta,
+                           traj.has_unitcell, traj.title) as out:
+                for frames, xyz in traj.chunks():
+                    out.write(xyz, traj.unitcell[frames] if traj.has_unitcell else None)
+        print(args.dcd)
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()